@@ -0,0 +1,111 @@
+''' Check of the R^2 maps of DTI studies computed as one stack of directions
+(R2MapGenerator.get_R2_stack, used by DTIProcessor.process_DTI) against the
+former per-direction loop, which sliced the volumes of direction d as
+leap[d]+1 to leap[d]+1+n_b_val and computed each map with get_R2_map.
+
+The former slicing only matched the volumes of each direction with 2 basal
+images, so both are compared on simulated data with 2 basal images, for
+several numbers of b values and directions. For other numbers of basal
+images, the directions whose volumes differ between both are reported: their
+R^2 maps are expected to differ from the ones of previous versions.
+
+Usage: python check_R2_stack.py [--seed <N>] [--tol <value>]
+'''
+
+import argparse
+import sys
+import numpy as np
+
+from processing import R2MapGenerator
+from utils import Headermsg as hmg
+
+
+def get_R2_loop(data, residuals, n_basal, n_b_val, n_dirs):
+    ''' R^2 maps of all directions as computed by the former per-direction
+    loop of process_DTI, with shape (x_dim, y_dim, n_slices, n_dirs). '''
+    basal_residuals = residuals[:,:,:,0:n_basal]
+    basal_data = data[:,:,:,0:n_basal]
+    R2_maps = []
+    if n_b_val > 1:
+        leap = [*range(1, n_dirs*n_b_val, n_b_val)]
+        for d in range(0, n_dirs):
+            dir_res = residuals[:,:,:,(leap[d]+1):((leap[d])+(1+n_b_val))]
+            full_res = np.concatenate((basal_residuals, dir_res), axis = -1)
+            dir_data = data[:,:,:,(leap[d]+1):((leap[d])+(1+n_b_val))]
+            full_data = np.concatenate((basal_data, dir_data), axis = -1)
+            R2_maps.append(R2MapGenerator().get_R2_map(full_data, full_res))
+    else:
+        for d in range(n_dirs):
+            dir_res = residuals[:,:,:,(n_basal + d)][:,:,:,np.newaxis]
+            full_res = np.concatenate((basal_residuals, dir_res), axis = -1)
+            dir_data = data[:,:,:,(n_basal + d)][:,:,:,np.newaxis]
+            full_data = np.concatenate((basal_data, dir_data), axis = -1)
+            R2_maps.append(R2MapGenerator().get_R2_map(full_data, full_res))
+    return np.stack(R2_maps, axis=-1)
+
+
+def get_changed_dirs(n_basal, n_b_val, n_dirs):
+    ''' Directions whose volumes differ between the former slicing and
+    R2MapGenerator.get_dir_indexes. '''
+    _, dir_idx = R2MapGenerator().get_dir_indexes(n_basal, n_b_val, n_dirs)
+    n_volumes = n_basal + n_b_val * n_dirs
+    changed = []
+    for d in range(n_dirs):
+        if n_b_val > 1:
+            start = 1 + d * n_b_val + 1
+            old_idx = list(range(n_volumes))[start:start + n_b_val]
+        else:
+            old_idx = [n_basal + d]
+        if old_idx != list(dir_idx[d]):
+            changed.append(d + 1)
+    return changed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Comprueba los mapas de '
+                    'R² de DTI calculados como una sola pila de '
+                    'direcciones frente al bucle anterior por dirección.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='semilla de los datos simulados (por defecto: 0)')
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help='mayor diferencia absoluta de R² aceptada '
+                        '(por defecto: 1e-10)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    passed = True
+    n_basal = 2
+    for n_b_val, n_dirs in [(1, 6), (2, 15), (3, 30)]:
+        shape = (16, 16, 4, n_basal + n_b_val * n_dirs)
+        data = rng.uniform(100.0, 1500.0, shape)
+        data[:4] = 1.0 # background: constant signal, R^2 not defined
+        residuals = rng.normal(0.0, 20.0, shape)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R2_loop = get_R2_loop(data, residuals, n_basal, n_b_val, n_dirs)
+            basal_idx, dir_idx = R2MapGenerator().get_dir_indexes(n_basal,
+                                                        n_b_val, n_dirs)
+            R2_stack = R2MapGenerator().get_R2_stack(data, residuals,
+                                                     basal_idx, dir_idx)
+        same_nan = np.array_equal(np.isnan(R2_loop), np.isnan(R2_stack))
+        max_diff = np.nanmax(np.abs(R2_loop - R2_stack))
+        print(f'{hmg.info}{n_basal} basales, {n_b_val} b valores, {n_dirs} '
+              f'direcciones: diferencia máxima {max_diff:.1e}, '
+              f'vóxeles sin R² {"iguales" if same_nan else "distintos"}.')
+        if max_diff > args.tol or not same_nan:
+            passed = False
+
+    # other numbers of basal images: directions whose R^2 maps change
+    for n_basal, n_b_val, n_dirs in [(1, 2, 15), (3, 2, 15), (1, 1, 6)]:
+        changed = get_changed_dirs(n_basal, n_b_val, n_dirs)
+        print(f'{hmg.warn}{n_basal} basal(es), {n_b_val} b valor(es), '
+              f'{n_dirs} direcciones: {len(changed)} direcciones usan otras '
+              'imágenes que en versiones anteriores.')
+
+    if passed:
+        print(f'\n{hmg.success}Con 2 imágenes basales, la pila de R² '
+              'coincide con el bucle anterior.')
+        sys.exit(0)
+    print(f'\n{hmg.error}Con 2 imágenes basales, la pila de R² difiere '
+          f'del bucle anterior en más de {args.tol}.')
+    sys.exit(1)
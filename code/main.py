@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import warnings
 import multiprocessing
 from pathlib import Path
 import traceback
+from concurrent.futures.process import BrokenProcessPool
 
 import file_system_functions as fs
 from preprocessing import Preprocessing, ask_yes_no_mask, ask_yes_no_preprocessing
 from processing import TimeCollector, TMapProcessor, MTProcessor, DTIProcessor
-from utils import Mask, ask_user
+from utils import Mask, SessionPool, ask_user
 from utils import Headermsg as hmg 
 
 warnings.filterwarnings("ignore")
@@ -58,49 +60,84 @@ def main():
                                         modals_to_process)
         f_time_paths = time_collector.get_times(how='auto')
 
-    # generate parametric maps
-    prev_patient_name = ""
-    for study in studies_to_process: 
-        study_name = study.parts[-1]
-        patient_name = study.parts[-2].split("_")[1:]
-        if patient_name != prev_patient_name:
-            print(f'\n\n\n\n{hmg.new_patient1}{"_".join(patient_name)} {hmg.new_patient2}')
-        prev_patient_name = patient_name[:]
-        current_modal = study_name.split("_")[0]
-        print(f'\n\n{hmg.new_modal}Procesamiento del mapa de {current_modal}')
+    # create the pool of worker processes shared by all the studies of the session
+    n_cpu = multiprocessing.cpu_count() - 1
+    if n_cpu > 1:
+        session_pool = SessionPool(n_cpu)
+        print(f'\n{hmg.info}{n_cpu} procesos de trabajo iniciados en {session_pool.startup_time:.1f} s.')
+    else:
+        session_pool = None
+
+    try:
+        # generate parametric maps
+        prev_patient_name = ""
+        for study in studies_to_process: 
+            study_name = study.parts[-1]
+            patient_name = study.parts[-2].split("_")[1:]
+            if patient_name != prev_patient_name:
+                print(f'\n\n\n\n{hmg.new_patient1}{"_".join(patient_name)} {hmg.new_patient2}')
+            prev_patient_name = patient_name[:]
+            current_modal = study_name.split("_")[0]
+            print(f'\n\n{hmg.new_modal}Procesamiento del mapa de {current_modal}')
+            t_study = time.time()
+            # jobs sent to the session pool before this study
+            n_jobs = session_pool.n_jobs if session_pool is not None else 0
         
-        mask_path = Path('/'.join(study.parts[0:-1])) / 'mask.nii'
-        if mask_path.exists(): 
-            reuse_mask = ask_user('¿Deseas reutilizar la máscara creada para este sujeto?')
-
-        if (not mask_path.exists()) or (not reuse_mask):
-            mask = Mask(study)
-            correct_selection = False
-            while not correct_selection:
-                mask.create_mask()
-                correct_selection = ask_user('¿Es la previsualización de la selección lo que deseas?')
-            print(f'\n{hmg.info}Máscara creada correctamente.')
+            mask_path = Path('/'.join(study.parts[0:-1])) / 'mask.nii'
+            if mask_path.exists(): 
+                reuse_mask = ask_user('¿Deseas reutilizar la máscara creada para este sujeto?')
+
+            if (not mask_path.exists()) or (not reuse_mask):
+                mask = Mask(study)
+                correct_selection = False
+                while not correct_selection:
+                    mask.create_mask()
+                    correct_selection = ask_user('¿Es la previsualización de la selección lo que deseas?')
+                print(f'\n{hmg.info}Máscara creada correctamente.')
         
-        want_preprocess = ask_user('¿Deseas realizar un preprocesado de este estudio?')
-
-        if study_name.startswith('DT'): 
-            dti_map_pro = DTIProcessor(root_path, study)
-            if want_preprocess:
-                Preprocessing([study]).preprocess()
-            dti_map_pro.process_DTI()
+            want_preprocess = ask_user('¿Deseas realizar un preprocesado de este estudio?')
+
+            try:
+                if study_name.startswith('DT'): 
+                    dti_map_pro = DTIProcessor(root_path, study, n_cpu=n_cpu, pool=session_pool)
+                    if want_preprocess:
+                        Preprocessing([study], pool=session_pool).preprocess()
+                    dti_map_pro.process_DTI()
         
-        elif study_name.startswith('MT'):
-            mt_map_pro = MTProcessor(study, mask_path)
-            if want_preprocess:
-                Preprocessing([study]).preprocess()
-            mt_map_pro.process_MT()
-
-        else:
-            n_cpu = multiprocessing.cpu_count() - 1
-            t_map_pro = TMapProcessor(study, mask_path, n_cpu=n_cpu, fitting_mode='nonlinear') 
-            if want_preprocess:
-                Preprocessing([study]).preprocess()
-            t_map_pro.process_T_map(f_time_paths)
+                elif study_name.startswith('MT'):
+                    mt_map_pro = MTProcessor(study, mask_path)
+                    if want_preprocess:
+                        Preprocessing([study], pool=session_pool).preprocess()
+                    mt_map_pro.process_MT()
+
+                else:
+                    t_map_pro = TMapProcessor(study, mask_path, n_cpu=n_cpu, fitting_mode='nonlinear', 
+                                                pool=session_pool) 
+                    if want_preprocess:
+                        Preprocessing([study], pool=session_pool).preprocess()
+                    t_map_pro.process_T_map(f_time_paths)
+            except BrokenProcessPool:
+                # a worker has died: the study is left unfinished and the 
+                # next studies go on with new workers
+                if session_pool is None:
+                    raise
+                print(f'\n{hmg.error}Un proceso de trabajo ha terminado de forma '
+                      f'inesperada: el estudio {study_name} no se ha completado.')
+                session_pool.restart()
+                continue
+
+            # estimate of the time saved by reusing the workers of the session 
+            # pool: a new pool for this study would take about as long to start 
+            # as the session pool did (not measured per study). Only studies 
+            # whose processing has sent jobs to the pool are reported
+            if session_pool is not None and session_pool.n_jobs > n_jobs:
+                print(f'\n{hmg.info}Estudio procesado en {time.time() - t_study:.1f} s. '
+                      f'Se han evitado unos {session_pool.startup_time:.1f} s de arranque de procesos (estimado).')
+
+    finally:
+        # shut down the workers, also if processing is interrupted
+        if session_pool is not None:
+            session_pool.shutdown()
 
     fs_builder.empty_supplfiles()
     print(f'\n{hmg.success}Procesamiento terminado.')
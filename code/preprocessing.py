@@ -14,6 +14,13 @@ from utils import Headermsg as hmg # Added by Raquel
 warnings.filterwarnings("ignore")
 
 
+def denoise_image(image, patch_size=3, patch_distance=7, h=4.5):
+    ''' Non local means denoising of one image. It is a module level 
+    function so that it can be sent to the workers of the session pool.'''
+    return denoise_nl_means(image, patch_size=patch_size, 
+                            patch_distance=patch_distance, h=h)
+
+
 def get_preprocessing_params():
     
     print(f'\n{hmg.ask}Indica los parámetros de preprocesado en la ventana emergente.')
@@ -105,8 +112,10 @@ def ask_yes_no_mask():
 
 
 class Preprocessing:
-    def __init__(self, studies_paths):
+    def __init__(self, studies_paths, pool=None):
         self.studies_paths = studies_paths
+        # session pool (utils.SessionPool) used to denoise images in parallel
+        self.pool = pool
     
 
     def load_nii(self, study_path, is_mt_study=False, scan=0):
@@ -120,12 +129,25 @@ class Preprocessing:
 
 
     def denoise(self, image, patch_size=3, patch_distance=7, h=4.5):
-        d_ima = denoise_nl_means(image, patch_size=patch_size, 
-                                    patch_distance=patch_distance, h=h)
+        d_ima = denoise_image(image, patch_size, patch_distance, h)
         
         return d_ima
 
 
+    def denoise_images(self, images, patch_size=3, patch_distance=7, h=4.5):
+        ''' Denoises a list of images, on the workers of the session pool 
+        if there is one.'''
+        if self.pool is None:
+            return [self.denoise(ima, patch_size, patch_distance, h) 
+                        for ima in images]
+
+        n_imas = len(images)
+        return list(self.pool.executor.map(denoise_image, images, 
+                                            [patch_size]*n_imas, 
+                                            [patch_distance]*n_imas, 
+                                            [h]*n_imas))
+
+
     def save_nii(self, study, array):
         nii_ima = nib.Nifti1Image(array, study.affine, study.header)
         nib.save(nii_ima, str(self.study_full_path))
@@ -156,24 +178,20 @@ class Preprocessing:
                     study_data = study_nii.get_data()
                     if len(study_data.shape) == 4: 
                         for serie in np.moveaxis(study_data, -1, 0):
-                            for ima in np.moveaxis(serie, -1, 0):
-                                # denoise using non local means
-                                d_ima = self.denoise(ima, 
-                                                    denoise_params[0], 
-                                                    denoise_params[1],
-                                                    denoise_params[2]) 
-                                p_serie.append(d_ima)
+                            # denoise using non local means
+                            p_serie = self.denoise_images(list(np.moveaxis(serie, -1, 0)), 
+                                                            denoise_params[0], 
+                                                            denoise_params[1],
+                                                            denoise_params[2]) 
                             p_imas.append(p_serie)
                             p_serie = []
                         r_imas = np.moveaxis(np.array(p_imas), [0,1],[-1, -2])
                     elif len(study_data.shape) == 3: # Caso de la MT - added by Raquel
-                        for ima in np.moveaxis(study_data, -1, 0):
-                            # denoise using non local means
-                            d_ima = self.denoise(ima, 
-                                                denoise_params[0], 
-                                                denoise_params[1],
-                                                denoise_params[2]) 
-                            p_imas.append(d_ima)
+                        # denoise using non local means
+                        p_imas = self.denoise_images(list(np.moveaxis(study_data, -1, 0)), 
+                                                        denoise_params[0], 
+                                                        denoise_params[1],
+                                                        denoise_params[2]) 
                         r_imas = np.moveaxis(np.array(p_imas), 0,-1)
                     else:
                         print(f'{hmg.error}Dimensiones del archivo de imagen no esperadas.')
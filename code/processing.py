@@ -1,12 +1,16 @@
 import os
 import shutil
 import glob
+import time
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import matplotlib.cm as cm
 import warnings
 import re # Added by Raquel
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from tkinter import *
 import tkinter as tk
@@ -14,9 +18,8 @@ import tkinter as tk
 from dipy.io.image import load_nifti, save_nifti
 import dipy.reconst.dti as dti
 from dipy.core.sphere import Sphere
-from dipy.reconst.dti import apparent_diffusion_coef, _nlls_err_func
+from dipy.reconst.dti import apparent_diffusion_coef
 from dipy.reconst.dti import fractional_anisotropy
-from dipy.io.gradients import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 from myrelax import getT2T2star
 from myrelax import getT1TR
@@ -177,12 +180,124 @@ class MTProcessor:
 ###############################################################################
 # DTI PROCESSING
 ###############################################################################
+def fit_tensor_chunk(tensor_model, data):
+    ''' Fits the tensor model on a chunk of voxels (data with shape 
+    (n_vox, n_volumes)) and returns the model parameters (eigenvalues and 
+    eigenvectors) and S0 of each voxel. It is a module level function so 
+    that it can be sent to the workers of the session pool.'''
+    tensor_fit = tensor_model.fit(data)
+    return tensor_fit.model_params, tensor_fit.S0_hat
+
+
 class DTIProcessor:
-    def __init__(self, root_path: str, study_path: str) -> None:
+    # gradient table, design matrix and its pseudo-inverse of each DTI 
+    # protocol already processed in the session, keyed by the content of the 
+    # b values and directions (see get_protocol)
+    protocol_cache = {}
+
+    def __init__(self, root_path: str, study_path: str, n_cpu=None, 
+                    pool=None) -> None:
         self.root_path = root_path
         self.study_path = study_path
+        # session pool (utils.SessionPool) available for the tensor fitting, 
+        # with at most n_cpu chunks of voxels fitted at a time (default: all 
+        # the workers of the pool)
+        self.pool = pool
+        if n_cpu is None:
+            n_cpu = pool.n_cpu if pool is not None else 1
+        self.n_cpu = n_cpu
+
+
+    def fit_tensor(self, tensor_model, vox_data):
+        ''' Fits the tensor model on the masked voxels (vox_data with shape 
+        (n_vox, n_volumes)). With a session pool, voxels are split into 
+        chunks, several per process so that processes that finish early 
+        take over the remaining chunks, and at most n_cpu chunks are fitted 
+        at a time. Chunks are merged back into one TensorFit, with the S0 
+        estimated by each chunk as model_S0, so tensor_model must be built 
+        with return_S0_hat=True. If a chunk fails, the remaining chunks are 
+        cancelled and all voxels are fitted serially. If a process of the 
+        pool dies, the pool is broken: it is restarted with new workers for 
+        the next studies (SessionPool.restart), then all voxels of this study 
+        are fitted serially. '''
+
+        n_vox = vox_data.shape[0]
+        if self.pool is None or self.n_cpu <= 1 or n_vox < 2 * self.n_cpu:
+            return tensor_model.fit(vox_data)
+
+        n_chunks = min(4 * self.n_cpu, n_vox)
+        edges = np.round(np.linspace(0, n_vox, n_chunks + 1)).astype(int)
+        results = [None] * n_chunks
+        jobs = {}
+        next_chunk = 0
+        try:
+            while next_chunk < n_chunks or jobs:
+                # keep n_cpu chunks in the workers
+                while next_chunk < n_chunks and len(jobs) < self.n_cpu:
+                    chunk = vox_data[edges[next_chunk]:edges[next_chunk + 1]]
+                    job = self.pool.executor.submit(fit_tensor_chunk, 
+                                                    tensor_model, chunk)
+                    jobs[job] = next_chunk
+                    next_chunk += 1
+                done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                for job in done:
+                    results[jobs.pop(job)] = job.result()
+        except BrokenProcessPool:
+            # a process has died: the session pool refuses new jobs until 
+            # it is restarted
+            print(f'\n{hmg.warn}Un proceso de trabajo ha terminado de forma '
+                  'inesperada al resolver el tensor. Se va a resolver en serie.')
+            self.pool.restart()
+            return tensor_model.fit(vox_data)
+        except Exception as e:
+            # do not leave chunks of this study queued in the session pool, 
+            # which is shared by the next studies
+            for job in jobs:
+                job.cancel()
+            print(f'\n{hmg.warn}Error al resolver el tensor en paralelo ({e!r}). '
+                  'Se va a resolver en serie.')
+            return tensor_model.fit(vox_data)
+
+        model_params = np.concatenate([res[0] for res in results])
+        S0_hat = np.concatenate([res[1] for res in results])
+        return dti.TensorFit(tensor_model, model_params, model_S0=S0_hat)
     
 
+    def get_protocol(self, b_vals, dirs, indexes_to_rm):
+        ''' Returns the gradient table, the design matrix of the tensor model 
+        and its pseudo-inverse for the b values and directions (dirs with 
+        shape (3, n_volumes)) left after removing indexes_to_rm. They are 
+        built in memory the first time a protocol is found and reused from 
+        protocol_cache for the next studies with the same b values, 
+        directions and removed directions. '''
+
+        b_vals = np.asarray(b_vals, dtype=np.float64)
+        bvecs = np.asarray(dirs, dtype=np.float64).T
+        key = hashlib.sha1(b_vals.tobytes() + bvecs.tobytes() + 
+                           str(sorted(indexes_to_rm)).encode()).hexdigest()
+        if key in DTIProcessor.protocol_cache:
+            print(f'\n{hmg.info}Protocolo de difusión ya procesado: se reutilizan '
+                  'la tabla de gradientes y la matriz de diseño.')
+            return DTIProcessor.protocol_cache[key]
+
+        # create gradient table. You can access gradients with gtab.gradients
+        gtab = gradient_table(b_vals, bvecs=bvecs, atol=1e-0) 
+        # gtab contains bvec and bvals, such as
+        # -0.066   0.9937   -0.089   421.46    Gradient direction and b_val_1
+        # -0.066   0.9937   -0.089   1827.43   Gradient direction and b_val_2
+        #   ...      ...      ...      ...
+
+        # design matrix computed as:
+        #   bi[gxi^2, gyi^2, gzi^2, 2*gxi*gyi, 2*gxi*gzi, 2*gyi*gzi, -1], 
+        # and -1 will be multiplied by ln(S0)
+        design_matrix = dti.design_matrix(gtab)
+        protocol = {'gtab': gtab, 
+                    'design_matrix': design_matrix, 
+                    'inv_design': np.linalg.pinv(design_matrix)}
+        DTIProcessor.protocol_cache[key] = protocol
+        return protocol
+
+
     def ask_dti_info(self):
         '''
         Ask the user to enter b values, number of basal images and number of directions. 
@@ -343,54 +458,102 @@ class DTIProcessor:
         return [b_vals, dirs, n_b_val, n_basal, n_dirs, indexes_to_rm]
 
 
-    def get_residuals(self, design_matrix, data, weighting=None, sigma=None, jac=True):
-        ''' Computes non-liear least squares per each pixel and returns a map 
-        of residual errors.  It uses ordinary least squares (OLS) as starting 
-        point for optimization. The residual error is obtained per direction 
-        and per b value, including basal images (b=0). '''
+    def get_residuals(self, design_matrix, data, weighting=None, sigma=None, 
+                        jac=True, params=None, mask=None, inv_design=None):
+        ''' Computes the residual errors of the tensor model per each pixel 
+        and returns a map of them. The residual error is obtained per 
+        direction and per b value, including basal images (b=0). 
+        
+        The signal predicted for all voxels is exp(params @ design_matrix.T), 
+        computed with one matrix product. params are the tensor parameters 
+        in the order of the design matrix (e.g. the final NLLS parameters, 
+        tensor_fit.lower_triangular(b0=tensor_fit.S0_hat)), with shape 
+        (x_dim, y_dim, n_slices, 7). Without them, the ordinary least squares 
+        (OLS) solution, i.e. the starting point of the NLLS optimization, is 
+        used instead, with the pseudo-inverse of the design matrix inv_design 
+        (computed if not provided). Only voxels within mask are computed (all voxels if 
+        mask is None); the residuals of the other voxels are 0. As in dipy's 
+        NLLS error function, residuals are weighted with weighting='sigma' 
+        or 'gmm' (Geman-McClure M-estimator). '''
 
         # preparing data
         data[data == 0] = 1
         r_data = data.reshape((-1, data.shape[-1])) # vectorize data
-        
-        # OLS parameters are used as the starting point for optimization
-        log_s = np.log(r_data)
-        inv_design = np.linalg.pinv(design_matrix)
-        ols_params = np.dot(inv_design, log_s.T).T 
-
-        # iterate over each voxel and compute non linear least squares error function
-        residuals = np.empty((r_data.shape[0], data.shape[3]))
-        for vox in range(r_data.shape[0]):
-            start_params = ols_params[vox] # 7 params per voxel
-            if jac:
-                # Error func for the non-linear least-squares fit of the tensor.
-                residuals[vox] = _nlls_err_func(start_params, 
-                                                design_matrix, 
-                                                r_data[vox], 
-                                                weighting, 
-                                                sigma)
+        residuals = np.zeros((r_data.shape[0], data.shape[3]))
+        if not jac:
+            residuals.shape = data.shape[:]
+            return residuals
+
+        # voxels to compute
+        if mask is None:
+            vox = np.arange(r_data.shape[0])
+        else:
+            vox = np.flatnonzero(np.asarray(mask).reshape(-1) > 0)
+        vox_data = r_data[vox]
+
+        # tensor parameters of each voxel: final ones if provided, otherwise 
+        # OLS parameters (starting point of the NLLS optimization)
+        if params is None:
+            if inv_design is None:
+                inv_design = np.linalg.pinv(design_matrix)
+            vox_params = np.dot(np.log(vox_data), inv_design.T) 
+        else:
+            vox_params = params.reshape((-1, params.shape[-1]))[vox]
+
+        # predicted signal of all voxels at once, and residuals
+        with np.errstate(over='ignore', invalid='ignore'):
+            vox_res = vox_data - np.exp(np.dot(vox_params, design_matrix.T))
+
+        # weighting of the residuals, as in the NLLS error function
+        if weighting is not None:
+            se = vox_res**2
+            if weighting == 'sigma':
+                if sigma is None:
+                    raise ValueError('Must provide sigma value as input to '
+                                     'use this weighting method')
+                w = 1 / (sigma**2)
+            elif weighting == 'gmm':
+                # scale factor C of each voxel from the median absolute 
+                # deviation of its residuals
+                med = np.median(vox_res, axis=1)[:, np.newaxis]
+                C = 1.4826 * np.median(np.abs(vox_res - med), axis=1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    w = 1 / (se + C[:, np.newaxis]**2)
+                    # weights are normalized to the mean weight of each voxel
+                    w = w / np.mean(w, axis=1)[:, np.newaxis]
+            with np.errstate(invalid='ignore'):
+                vox_res = np.sqrt(w * se)
+
         # reshape to the original shape
+        residuals[vox] = vox_res
         residuals.shape = data.shape[:] 
         
         return residuals
 
 
     def compute_map(self, map_type: str):
+        ''' Computes a scalar map on the voxels of the mask (self.tensor is 
+        the tensor fit of the compact list of masked voxels) and scatters it 
+        into a full volume, where background voxels are 0 as with a tensor 
+        fitted on zero signal. '''
 
         unit_change = 1_000_000  
 
         if map_type == 'AD':
-            pmap = self.tensor.ad * unit_change
-            pmap[pmap < 0.00000001] = float("nan")
+            vox_map = self.tensor.ad * unit_change
         elif map_type == 'RD':
-            pmap = self.tensor.rd * unit_change
-            pmap[pmap < 0.00000001] = float("nan")
+            vox_map = self.tensor.rd * unit_change
         elif map_type == 'MD':
-            pmap = self.tensor.md * unit_change   
-            pmap[pmap < 0.00000001] = float("nan")
+            vox_map = self.tensor.md * unit_change   
         elif map_type == 'FA': 
-            pmap = fractional_anisotropy(self.tensor.evals)
+            vox_map = fractional_anisotropy(self.tensor.evals)
+        pmap = np.zeros(self.mask_vox.shape)
+        pmap[self.mask_vox] = vox_map
+
+        if map_type == 'FA':
             pmap[pmap > 0.95] = float("nan") 
+        else:
+            pmap[pmap < 0.00000001] = float("nan")
         
         if self.f_R2_maps_slc is not None:    
             pmap = pmap * self.f_R2_maps_slc
@@ -404,7 +567,8 @@ class DTIProcessor:
 
         n_b_val, n_basal, n_dirs = self.ask_dti_info()
 
-        # create B values and B dirs files
+        # B values and B dirs files, written for reference: the gradient 
+        # table is built in memory from b_vals and dirs
         f_bvals = self.root_path / 'supplfiles' / 'Bvalues.bval'
         f_dirs = self.root_path / 'supplfiles' / 'Bdirs.bvec'
 
@@ -439,26 +603,33 @@ class DTIProcessor:
             mask, affine = load_nifti(Path('/'.join(self.study_path.parts[:-1])) / 'mask.nii')
 
         # apply mask
-        for i in range(data.shape[3]): # para cada imagen de cada slice
-            data[:,:,:,i] = data[:,:,:,i] * mask
-        
-        # read b values (bvals) and gradient directions (bvecs)
-        bval_path = str(self.root_path / 'supplfiles' / 'bvalues.bval') 
-        bvec_path = str(self.root_path / 'supplfiles' / 'Bdirs.bvec') 
-        bvals, bvecs = read_bvals_bvecs(bval_path, bvec_path)
+        data = data * mask[..., np.newaxis]
+        mask_vox = mask > 0
+        self.mask_vox = mask_vox
         
-        # create gradient table. You can access gradients with gtab.gradients
-        gtab = gradient_table(bvals, bvecs, atol=1e-0) 
-        # gtab contains bvec and bvals, such as
-        # -0.066   0.9937   -0.089   421.46    Gradient direction and b_val_1
-        # -0.066   0.9937   -0.089   1827.43   Gradient direction and b_val_2
-        #   ...      ...      ...      ...
+        # gradient table, design matrix and its pseudo-inverse, shared by 
+        # all the studies acquired with the same protocol
+        protocol = self.get_protocol(b_vals, dirs, indexes_to_rm)
+        gtab = protocol['gtab']
 
         print(f'\n{hmg.info}Se está resolviendo el tensor. Puede tardar unos segundos.')
-        tensor_model = dti.TensorModel(gtab, fit_method='NLLS') 
-
-        tensor_fit = tensor_model.fit(data) 
+        tensor_model = dti.TensorModel(gtab, fit_method='NLLS', return_S0_hat=True) 
+
+        # fit the tensor only on the voxels of the mask, as a compact list 
+        # of voxels: background voxels do not go through the NLLS optimizer. 
+        # Chunks of voxels are fitted in parallel if there is a session pool
+        t_fit = time.time()
+        tensor_fit = self.fit_tensor(tensor_model, data[mask_vox]) 
+        t_fit = time.time() - t_fit
         self.tensor = tensor_fit
+        n_vox, n_total = int(np.sum(mask_vox)), mask_vox.size
+        n_proc = self.n_cpu if self.pool is not None else 1
+        print(f'{hmg.info}Tensor resuelto en {n_vox} de {n_total} vóxeles '
+              f'(máscara) en {t_fit:.1f} s con {n_proc} proceso(s); sin '
+              f'máscara, unos {t_fit * n_total / max(n_vox, 1):.1f} s.')
+        # tensor_fit holds the n_vox masked voxels, in the order of 
+        # data[mask_vox]: maps are scattered back into full volumes with 
+        # full_map[mask_vox] = vox_map.
         # Some documentation of tensor_model and tensor_fit
         # tensor_model.design_matrix:
         #   np.array with shape (n_basals + n_b_val*n_dirs, 6 + 1).
@@ -468,26 +639,28 @@ class DTIProcessor:
         # tensor_model.gtab
         #   gtab contains bvec and bvals
         # tensor_fit.evals 
-        #   np.array with shape (x_dim, y_dim, n_slices, 3) offers 3 eigenvalues
+        #   np.array with shape (n_vox, 3) offers 3 eigenvalues
         #   per pixel sorted from the biggest to the smallest.
         # tensor_fit.evecs
-        #   np.array with shape (x_dim, y_dim, n_slices, 3, 3) offers 3 
+        #   np.array with shape (n_vox, 3, 3) offers 3 
         #   eigenvectors per pixel. Each eigenvector has x, y, z directions, 
         #   so we have a 3-by-3 matrix per pixel. First row corresponds with 
         #   the biggest eigenvalue, and so on.
         # tensor_fit.directions
-        #   np.array with shape (x_dim, y_dim, n_slices, 1, 3) offers the main
+        #   np.array with shape (n_vox, 1, 3) offers the main
         #   direction of each pixel, according to the biggest eigenvalue
         # tensor_fit.model
         #   access to tensor_model
         # tensor_fit.quadratic_form
-        #   returns np.array of shape (x_dim, y_dim, n_slices, 3, 3). 
+        #   returns np.array of shape (n_vox, 3, 3). 
         #   Calculates the 3-by-3 diffusion tensor for each voxel.
 
         # get ADC maps 
         print(f'\n{hmg.info}Se está generando el mapa ADC.')
         my_sphere = Sphere(xyz=gtab.bvecs[~gtab.b0s_mask])
-        ADC_maps = apparent_diffusion_coef(tensor_fit.quadratic_form, my_sphere) 
+        ADC_vox = apparent_diffusion_coef(tensor_fit.quadratic_form, my_sphere) 
+        ADC_maps = np.zeros(mask_vox.shape + ADC_vox.shape[-1:])
+        ADC_maps[mask_vox] = ADC_vox
         
         # ADC matrix has an adc value per bval and direction. For example, 
         # for 2 bvals and 15 directions ADC matrix will have 2*15 adc values per 
@@ -506,68 +679,50 @@ class DTIProcessor:
         save_nifti(str(self.study_path / 'ADC_map'), ADC_maps.astype(np.float32), affine)
     
         # compute R^2 error maps
-        # design matrix computed as:
-        #   bi[gxi^2, gyi^2, gzi^2, 2*gxi*gyi, 2*gxi*gzi, 2*gyi*gzi, -1], 
-        # and -1 will be multiplied by ln(S0)
-        design_matrix = tensor_model.design_matrix 
+        design_matrix = protocol['design_matrix'] 
+        # final NLLS parameters in the order of the design matrix: 6 tensor 
+        # elements and -ln(S0)
+        nlls_params = np.zeros(mask_vox.shape + (design_matrix.shape[-1],))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            nlls_params[mask_vox] = tensor_fit.lower_triangular(b0=tensor_fit.S0_hat)
         # get errors between the real signal and the predicted signal per our model
-        residuals = self.get_residuals(design_matrix, data) 
+        residuals = self.get_residuals(design_matrix, data, params=nlls_params, 
+                                       mask=mask, 
+                                       inv_design=protocol['inv_design']) 
         
-        # get basal information
-        basal_residuals = residuals[:,:,:,0:n_basal]
-        basal_data = data[:,:,:,0:n_basal]
-
-        R2_maps = []
+        # volumes of each direction: the n_basal basal images, shared by all 
+        # directions, and the n_b_val images of the direction, which follow 
+        # the basal images direction after direction. The former slices 
+        # leap[d]+1 to leap[d]+1+n_b_val only matched these volumes with 2 
+        # basal images: R^2 maps of studies with another number of basal 
+        # images differ from the ones of previous versions (check_R2_stack.py 
+        # checks that they are the same with 2 basal images)
+        basal_idx, dir_idx = R2MapGenerator().get_dir_indexes(n_basal, n_b_val, 
+                                                              n_dirs)
+        
+        # R^2 maps of all directions at once, as a (x_dim, y_dim, n_slices, 
+        # n_dirs) stack, saved into one folder per direction
         print(f'\n{hmg.info}Generando mapas de R\u00b2.')
-        if n_b_val > 1: 
-            for d in range(0, n_dirs): 
-                # residuals
-                dir_res = residuals[:,:,:,(leap[d]+1):((leap[d])+(1+n_b_val))] 
-                full_res = np.concatenate((basal_residuals, dir_res), axis = -1)
-
-                # data
-                dir_data = data[:,:,:,(leap[d]+1):((leap[d])+(1+n_b_val))]
-                # concatenates basals with directions
-                full_data = np.concatenate((basal_data, dir_data), axis = -1)  
-
-                # compute R^2 maps
-                R2_map = R2MapGenerator().get_R2_map(full_data, full_res)
-                R2_dir_path = self.study_path / ('Dir_' + str(d + 1))
-                R2_dir_path.mkdir(parents=True) 
-                save_nifti(R2_dir_path / 'R2_map', R2_map.astype(np.float32), affine)
-                R2_maps.append(R2_map)
-
-        else: 
-            for d in range (ADC_maps.shape[3]):
-                dir_res = residuals[:,:,:,(n_basal + d)]
-                # add new axis to keep dimensions consistent
-                dir_res = dir_res[:,:,:,np.newaxis] 
-                full_res = np.concatenate((basal_residuals, dir_res), axis = -1)
-
-                dir_data = data[:,:,:,(n_basal + d)]
-                dir_data = dir_data[:,:,:,np.newaxis]
-                full_data = np.concatenate((basal_data, dir_data), axis = -1) 
-
-                R2_map = R2MapGenerator().get_R2_map(full_data, full_res)
-                R2_dir_path = self.study_path / ('Dir_' + str(d + 1))
-                R2_dir_path.mkdir(parents=True) 
-                save_nifti(R2_dir_path / 'R2_map', R2_map.astype(np.float32), affine)
-                R2_maps.append(R2_map)
+        R2_stack = R2MapGenerator().get_R2_stack(data, residuals, basal_idx, 
+                                                 dir_idx).astype(np.float32)
+        for d in range(n_dirs):
+            R2_dir_path = self.study_path / ('Dir_' + str(d + 1))
+            R2_dir_path.mkdir(parents=True) 
+            save_nifti(R2_dir_path / 'R2_map', R2_stack[..., d], affine)
+        R2_maps = np.moveaxis(R2_stack, -1, 0)
 
         # ask if filtering is desired
         apply_filter = ask_user("¿Quieres usar el filtro de ajuste?") 
 
         # select threshold and create R^2 maps
         if apply_filter:
-            # get R2 maps and apply threshold to them to get the masks/filters
-            R2_map_paths = list(self.study_path.glob('Dir_*/*')) 
-            f_R2_maps = []
-
+            # apply threshold to the R2 maps of all gradient directions, in 
+            # the order of the directions, to get the masks/filters with 
+            # shape (n_dirs, x_dim, y_dim, n_slices). Filters used to be read 
+            # from the Dir_*/ files in glob order (Dir_10 before Dir_2), which 
+            # paired them with the wrong ADC directions beyond 9 directions
             th = R2MapGenerator().select_threshold()
-            for R2_map_path in R2_map_paths: 
-                # f_R2_map shape: (x_dim, y_dim, n_slices) 
-                f_R2_map = R2MapGenerator().get_filtered_R2(R2_map_path, 'DTI', th) 
-                f_R2_maps.append(f_R2_map) # filtered R2 maps for all gradient directions
+            f_R2_maps = np.where(R2_maps >= th, 1., float("nan"))
         else:
             f_R2_maps = np.ones(np.shape(R2_maps)) 
             f_R2_maps_slc = None
@@ -818,12 +973,48 @@ class TimeCollector:
 
 
 class TMapProcessor:
+    # fitting algorithms of myrelax: 'linear' (log-linear fit), 'nonlinear'
+    # (voxel-wise L-BFGS-B), 'lm' (Levenberg-Marquardt on all voxels at once),
+    # 'varpro' (S0 eliminated analytically, 1-D search over T) and 'dict'
+    # (dictionary matching; the dictionary is cached in supplfiles, next to
+    # the times written by TimeCollector.write_times). 'epg' matches T2 
+    # multi-echo spin-echo trains to extended phase graph simulations, so 
+    # that stimulated echoes do not bias T2, and also saves a B1 map; T2E 
+    # and T1 maps fall back to 'dict'. 'arlo' computes T2* (T2E, MGE) or T2 
+    # in closed form from echo integrals, as fast as 'linear'; T1 maps fall 
+    # back to 'linear'
+    fitting_modes = ['linear', 'nonlinear', 'lm', 'varpro', 'dict', 'epg', 'arlo']
+    # floating point precision of the fitting and of the saved maps: 'float32'
+    # halves memory usage and disk traffic (see myrelax/precisionME.py)
+    precisions = ['float64', 'float32']
+
     def __init__(self, study_path: str, mask_path: str, n_cpu: int, \
-                    fitting_mode='nonlinear') -> None:
+                    fitting_mode='nonlinear', pool=None, 
+                    precision='float64', linear_gate=None) -> None:
+        if fitting_mode not in self.fitting_modes:
+            raise ValueError(f'Modo de ajuste "{fitting_mode}" no reconocido. '
+                             f'Opciones: {", ".join(self.fitting_modes)}.')
+        if precision not in self.precisions:
+            raise ValueError(f'Precisión "{precision}" no reconocida. '
+                             f'Opciones: {", ".join(self.precisions)}.')
         self.study_path = study_path
         self.mask_path = mask_path
         self.fitting_mode = fitting_mode
+        self.precision = precision
+        # R^2 from which 'nonlinear' and 'lm' keep the linear fit of a voxel 
+        # instead of refining it (None: every voxel is refined)
+        self.linear_gate = linear_gate
         self.n_cpu = n_cpu
+        # session pool (utils.SessionPool) whose workers fit every map; 
+        # without it, myrelax starts a new pool for each map
+        self.pool = pool
+
+
+    @property
+    def executor(self):
+        ''' Executor of the session pool, read at each map so that maps use 
+        the new workers if the pool has been restarted. '''
+        return self.pool.executor if self.pool is not None else None
 
 
     def process_T_map(self, time_paths): 
@@ -831,6 +1022,13 @@ class TMapProcessor:
         R^2 map is also computed. All maps are saved.  
         '''
 
+        fitting_mode = self.fitting_mode
+        if fitting_mode == 'epg' and 'T2_' not in str(self.study_path):
+            fitting_mode = 'dict'
+        if fitting_mode == 'arlo' and 'T2_' not in str(self.study_path) \
+                and 'T2E' not in str(self.study_path):
+            fitting_mode = 'linear'
+
         if 'T2_' in str(self.study_path):
             method = 'T2'
             print(f'\n{hmg.info}Generando mapa de T2.\n') 
@@ -841,9 +1039,12 @@ class TMapProcessor:
                 getT2T2star.TxyFitME(f_path, 
                                     time_paths[1], 
                                     out_path, 
-                                    self.fitting_mode, 
+                                    fitting_mode, 
                                     self.n_cpu, 
-                                    self.mask_path) 
+                                    self.mask_path,
+                                    pool=self.executor,
+                                    precision=self.precision,
+                                    linear_gate=self.linear_gate) 
 
             except NameError:
                 f_name = self.study_path.parts[-1][3:] + '.nii.gz' 
@@ -852,9 +1053,12 @@ class TMapProcessor:
                 getT2T2star.TxyFitME(f_path, 
                                     time_paths[1], 
                                     out_path, 
-                                    self.fitting_mode, 
+                                    fitting_mode, 
                                     self.n_cpu, 
-                                    self.mask_path) 
+                                    self.mask_path,
+                                    pool=self.executor,
+                                    precision=self.precision,
+                                    linear_gate=self.linear_gate) 
 
         elif 'T2E' in str(self.study_path):
             method = 'T2E'
@@ -866,9 +1070,12 @@ class TMapProcessor:
                 getT2T2star.TxyFitME(f_path, 
                                     time_paths[2], 
                                     out_path, 
-                                    self.fitting_mode, 
+                                    fitting_mode, 
                                     self.n_cpu, 
-                                    self.mask_path) 
+                                    self.mask_path,
+                                    pool=self.executor,
+                                    precision=self.precision,
+                                    linear_gate=self.linear_gate) 
             except NameError:
                 f_name = self.study_path.parts[-1][4:] + '.nii.gz' 
                 f_path = str(self.study_path / f_name)
@@ -876,9 +1083,12 @@ class TMapProcessor:
                 getT2T2star.TxyFitME(f_path, 
                                     time_paths[2], 
                                     out_path, 
-                                    self.fitting_mode, 
+                                    fitting_mode, 
                                     self.n_cpu, 
-                                    self.mask_path) 
+                                    self.mask_path,
+                                    pool=self.executor,
+                                    precision=self.precision,
+                                    linear_gate=self.linear_gate) 
         
         elif 'T1' in str(self.study_path):
             method = 'T1'
@@ -890,9 +1100,12 @@ class TMapProcessor:
                 getT1TR.TxyFitME(f_path, 
                                 time_paths[0], 
                                 out_path, 
-                                self.fitting_mode, 
+                                fitting_mode, 
                                 self.n_cpu, 
-                                self.mask_path)
+                                self.mask_path,
+                                pool=self.executor,
+                                precision=self.precision,
+                                linear_gate=self.linear_gate)
             except NameError:
                 f_name = self.study_path.parts[-1][3:] + '.nii.gz' 
                 f_path = str(self.study_path / f_name)
@@ -900,9 +1113,12 @@ class TMapProcessor:
                 getT1TR.TxyFitME(f_path, 
                                 time_paths[0], 
                                 out_path, 
-                                self.fitting_mode, 
+                                fitting_mode, 
                                 self.n_cpu, 
-                                self.mask_path) 
+                                self.mask_path,
+                                pool=self.executor,
+                                precision=self.precision,
+                                linear_gate=self.linear_gate) 
         
         # create a folder to store useful files
         if not (self.study_path / 'mapas').exists():
@@ -977,6 +1193,58 @@ class R2MapGenerator:
         return R2_map     
 
 
+    def get_dir_indexes(self, n_basal, n_b_val, n_dirs):
+        '''Indexes of the volumes of each direction of a DTI acquisition: the 
+        n_basal basal images, shared by all directions, and the n_b_val images 
+        of each direction, which follow the basal images direction after 
+        direction. Returns basal_idx with shape (n_basal,) and dir_idx with 
+        shape (n_dirs, n_b_val), as used by get_R2_stack.'''
+        basal_idx = np.arange(n_basal)
+        dir_idx = n_basal + np.arange(n_dirs)[:, np.newaxis] * n_b_val \
+                    + np.arange(n_b_val)
+        return basal_idx, dir_idx
+
+
+    def get_R2_stack(self, data, residuals, basal_idx, dir_idx):
+        '''Compute the R^2 maps of all the directions of a DTI acquisition at 
+        once. The R^2 of each direction is computed over the basal images and 
+        the images of that direction, as get_R2_map does on their 
+        concatenation, without copying the basal images for each direction.
+        Parameters
+        ----------
+            data : np.array 
+                original data with shape=(x_dim, y_dim, n_slices, n_volumes).
+            residuals : np.array 
+                Contains differences between predicted signal by our model and
+                the real data, with the same shape as data.
+            basal_idx : np.array
+                indexes of the basal images in the last axis, shape=(n_basal,).
+            dir_idx : np.array
+                indexes of the images of each direction in the last axis, 
+                shape=(n_dirs, n_b_val).
+        Returns
+        -------
+            R2_stack : np.array
+                R^2 maps with shape=(x_dim, y_dim, n_slices, n_dirs).
+        '''
+
+        n_meas = len(basal_idx) + dir_idx.shape[1]
+        basal_data = data[..., basal_idx][..., np.newaxis, :]
+        dir_data = data[..., dir_idx] # (x_dim, y_dim, n_slices, n_dirs, n_b_val)
+
+        # sum of squared errors
+        sse = self.get_sse(residuals[..., basal_idx])[..., np.newaxis] \
+                + np.sum(residuals[..., dir_idx]**2, axis=-1)
+        
+        # total sum of squares around the mean of each direction
+        avg = (np.sum(basal_data, axis=-1) + np.sum(dir_data, axis=-1)) / n_meas
+        sst = np.sum((basal_data - avg[..., np.newaxis])**2, axis=-1) \
+                + np.sum((dir_data - avg[..., np.newaxis])**2, axis=-1)
+        R2_stack = 1 - sse/sst
+
+        return R2_stack
+
+
     def select_threshold(self):
         while True:
             try:
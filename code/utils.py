@@ -1,4 +1,5 @@
 import os
+import time
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
@@ -7,6 +8,7 @@ from pathlib import Path
 
 from dipy.io.image import load_nifti, save_nifti
 from scipy.ndimage import rotate
+from concurrent.futures import ProcessPoolExecutor
 
 # --- Modo de output ---
 class Headermsg:
@@ -58,6 +60,77 @@ def ask_user(question):
             print(f'\n{Headermsg.error}Por favor, introduce una de las dos opciones. [y/n]\n')
 
 
+###############################################################################
+# Session pool
+###############################################################################
+def warm_up_worker(worker_idx):
+    '''Imports the fitting modules in a worker process, so that the first 
+    study does not pay for it.'''
+    import scipy.optimize
+    from myrelax import getT2T2star
+    from myrelax import getT1TR
+    return os.getpid()
+
+
+class SessionExecutor(ProcessPoolExecutor):
+    '''ProcessPoolExecutor that counts the jobs submitted to it (map 
+    submits one job per chunk of arguments).'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.n_jobs = 0
+
+
+    def submit(self, *args, **kwargs):
+        self.n_jobs += 1
+        return super().submit(*args, **kwargs)
+
+
+class SessionPool:
+    '''Pool of worker processes owned by the pipeline. It is created and 
+    warmed up once per session, reused by every study (T1, T2 and T2* maps, 
+    DTI and preprocessing) and shut down at the end of the session. If a 
+    worker dies, the pool is broken (BrokenProcessPool) until restart() 
+    replaces it.'''
+
+    def __init__(self, n_cpu: int) -> None:
+        self.n_cpu = n_cpu
+        # jobs of the executors replaced by restart()
+        self.n_jobs_before = 0
+        self.start()
+        # cost of starting a pool, paid once instead of once per study
+        self.startup_time = self.last_startup_time
+
+
+    @property
+    def n_jobs(self):
+        '''Jobs submitted to the workers of the session so far, to tell 
+        whether a study has used them.'''
+        return self.n_jobs_before + self.executor.n_jobs
+
+
+    def start(self):
+        t_start = time.time()
+        self.executor = SessionExecutor(max_workers=self.n_cpu)
+        list(self.executor.map(warm_up_worker, range(self.n_cpu)))
+        self.last_startup_time = time.time() - t_start
+
+
+    def restart(self):
+        '''Replaces the executor by a new one, warmed up, after a worker 
+        has died (the executor is then broken and refuses new jobs).'''
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.n_jobs_before += self.executor.n_jobs
+        self.start()
+        print(f'\n{Headermsg.warn}Un proceso de trabajo ha terminado de forma '
+              f'inesperada: se han reiniciado los {self.n_cpu} procesos en '
+              f'{self.last_startup_time:.1f} s.')
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
 ###############################################################################
 # Mask creation
 ###############################################################################
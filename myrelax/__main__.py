@@ -0,0 +1,183 @@
+### Batch fitting of relaxometry maps from the command line: python -m myrelax <model> --fit ... / --manifest ...
+#
+# Code released under BSD Two-Clause license
+#
+# Copyright (c) 2019 University College London.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+### Load useful modules
+import argparse, concurrent.futures, multiprocessing, shutil, sys, tempfile, time
+import numpy as np
+import nibabel as nib
+try:
+	from myrelax import relaxengine
+except ImportError:
+	import relaxengine        # Module run from within the myrelax folder
+
+
+def ReadManifest(manifest_text):
+	''' Read the list of maps to fit from a manifest text file
+
+	    INTERFACE
+	    fitlist = ReadManifest(manifest_text)
+
+	    PARAMETERS
+	    - manifest_text: path of a text file with one map per line, made of 3 or 4 fields separated by spaces or tabs:
+			     4D Nifti file, text file of sequence times, output base name and, optionally, fitting mask.
+			     Empty lines and lines starting with # are ignored
+
+	    RETURNS
+	    - fitlist: list of maps to fit, each a list of 3 or 4 strings as in the manifest'''
+
+	fitlist = []
+	try:
+		with open(manifest_text,'r') as fmanifest:
+			for nline, line in enumerate(fmanifest):
+				fields = line.split()
+				if len(fields)==0 or fields[0].startswith('#'):
+					continue
+				if len(fields)!=3 and len(fields)!=4:
+					print('')
+					print('ERROR: line {} of the manifest {} has {} fields instead of 3 or 4. Exiting with 1.'.format(nline + 1,manifest_text,len(fields)))
+					print('')
+					sys.exit(1)
+				fitlist.append(fields)
+	except OSError:
+		print('')
+		print('ERROR: the manifest {} does not exist or cannot be read. Exiting with 1.'.format(manifest_text))
+		print('')
+		sys.exit(1)
+	return fitlist
+
+
+def CountVoxels(sig_nifti,mask_nifti=None):
+	''' Number of voxels fitted in a map: voxels within the mask, or all voxels without mask (0 if files cannot be read) '''
+	try:
+		if mask_nifti is not None:
+			return int(np.sum(nib.load(mask_nifti).get_fdata()>0))
+		return int(np.prod(nib.load(sig_nifti).shape[0:3]))
+	except Exception:
+		return 0
+
+
+# Run the module as a script when required
+if __name__ == "__main__":
+
+	### Print help and parse arguments
+	parser = argparse.ArgumentParser(prog='python -m myrelax', description='Batch voxel-wise fitting of relaxometry maps (T2/T2star from multi-echo data, T1 from multi-repetition time data) on many 4D Nifti files, sharing one pool of workers and one dictionary of signals across all of them. Maps are given as --fit options and/or as lines of a manifest. A map that cannot be fitted is reported and skipped, and the batch exits with 1 at the end. Dependencies (Python packages): numpy, nibabel, scipy (other than standard library).')
+	parser.add_argument('model', help='signal model; choose among "T2" (T2 or T2star) and "T1"')
+	parser.add_argument('--fit', metavar='<file>', nargs='+', action='append', default=[], help='map to fit, as 4D Nifti file, text file of sequence times (TEs or TRs in ms), output base name and, optionally, mask in Nifti format; repeat the option for several maps')
+	parser.add_argument('--manifest', metavar='<file>', help='text file listing the maps to fit, one per line, with the same 3 or 4 fields of --fit separated by spaces; empty lines and lines starting with # are ignored')
+	parser.add_argument('--algo', metavar='<type>', default='linear', help='fitting algorithm; choose among "linear", "nonlinear", "lm", "varpro", "dict", "epg" and "arlo" (the last two for T2/T2star only, "epg" on multi-echo spin-echo trains and "arlo" on evenly spaced echoes; default: "linear")')
+	parser.add_argument('--ncpu', metavar='<N>', type=int, help='number of CPUs to be used for computation (default: half of available CPUs)')
+	parser.add_argument('--grid-refine', metavar='<N>', type=int, default=0, help='coarse-to-fine refinement levels of the grid search run where linear fitting fails, with algo "nonlinear" or "lm" (default: 0)')
+	parser.add_argument('--dict-polish', metavar='<N>', type=int, default=0, help='Levenberg-Marquardt iterations polishing the output of algo "dict" (default: 0)')
+	parser.add_argument('--dict-cache', metavar='<folder>', help='folder where the dictionaries of algo "dict" and "epg" are cached (default: a temporary folder, removed at the end of the batch)')
+	parser.add_argument('--shared-memory', action='store_true', help='keep signals and fitting output in shared memory blocks accessed in place by the workers (only with more than one CPU)')
+	parser.add_argument('--precision', metavar='<type>', default='float64', help='floating point precision of the fitting and of the output files; choose among "float64" and "float32" (default: "float64")')
+	parser.add_argument('--kernels', action='store_true', help='fit two measurements, linear fitting and the iterations of algo "lm" voxel by voxel in Numba-compiled kernels (only if Numba is installed; "nonlinear" is still refined with L-BFGS-B)')
+	parser.add_argument('--warm-start', action='store_true', help='start algo "nonlinear" and "lm" from a low-resolution fit of the neighbourhood of each voxel where it fits better than linear fitting or the grid search')
+	parser.add_argument('--uncertainty', action='store_true', help='also save the Cramer-Rao standard errors of S0 and Txy, in files ending in "_S0SEME.nii" and "_TxySEME.nii"')
+	parser.add_argument('--linear-gate', metavar='<R2>', type=float, help='coefficient of determination of linear fitting from which algo "nonlinear" and "lm" keep it instead of refining it (default: all voxels refined)')
+	args = parser.parse_args()
+
+	### Check the signal model and collect the maps to fit
+	if args.model not in relaxengine.MODELS:
+		print('')
+		print('ERROR: unrecognised signal model {}; choose among {}. Exiting with 1.'.format(args.model,', '.join(sorted(relaxengine.MODELS))))
+		print('')
+		sys.exit(1)
+	fitlist = []
+	for fields in args.fit:
+		if len(fields)!=3 and len(fields)!=4:
+			print('')
+			print('ERROR: --fit takes 3 or 4 files (4D Nifti, sequence times, output base name, optional mask), not {}. Exiting with 1.'.format(len(fields)))
+			print('')
+			sys.exit(1)
+		fitlist.append(fields)
+	if args.manifest is not None:
+		fitlist = fitlist + ReadManifest(args.manifest)
+	if len(fitlist)==0:
+		print('')
+		print('ERROR: no maps to fit; use --fit and/or --manifest. Exiting with 1.')
+		print('')
+		sys.exit(1)
+
+	### Number of CPUs: as in getT1TR.py, half of the available CPUs by default
+	ncpu_physical = multiprocessing.cpu_count()
+	if args.ncpu is None:
+		nprocess = max(int(float(ncpu_physical)/2),1)
+	else:
+		nprocess = max(min(args.ncpu,ncpu_physical),1)
+
+	### Dictionary of algo "dict" and "epg": built once per protocol in one folder shared by all maps
+	dict_cache = args.dict_cache
+	dict_tmp = None
+	if (args.algo=="dict" or args.algo=="epg") and dict_cache is None:
+		dict_tmp = tempfile.mkdtemp(prefix='myrelax_dict_')
+		dict_cache = dict_tmp
+
+	print('')
+	print('********************************************************************************')
+	print('   Batch fitting of {} relaxation times: {} maps, algorithm {}, {} CPUs'.format(args.model,len(fitlist),args.algo,nprocess))
+	print('********************************************************************************')
+	print('')
+
+	### Fit all maps with the same pool of workers, started once for the whole batch
+	report = []
+	time_batch = time.time()
+	pool = None
+	try:
+		if nprocess>1:
+			pool = concurrent.futures.ProcessPoolExecutor(max_workers=nprocess)
+		for ff, fields in enumerate(fitlist):
+			print('Map {} of {}: {}'.format(ff + 1,len(fitlist),fields[0]))
+			time_map = time.time()
+			try:
+				relaxengine.TxyFitME(args.model,fields[0],fields[1],fields[2],args.algo,nprocess,*fields[3:],grid_refine=args.grid_refine,dict_polish=args.dict_polish,dict_cache=dict_cache,shared_memory=args.shared_memory,pool=pool,precision=args.precision,kernels=args.kernels,warm_start=args.warm_start,uncertainty=args.uncertainty,linear_gate=args.linear_gate)
+				status = 'done'
+			except SystemExit:
+				status = 'FAILED'     # The fitting routine has reported the error: move on to the next map
+			except concurrent.futures.process.BrokenProcessPool:
+				print('')
+				print('ERROR: some processes died while fitting {}.'.format(fields[0]))
+				print('')
+				status = 'FAILED'
+			time_map = time.time() - time_map
+			nvox = CountVoxels(fields[0],*fields[3:]) if status=='done' else 0
+			report.append([fields[2],status,nvox,time_map])
+
+			# A worker that died while fitting the map breaks the pool for all the following maps: after a failure, start a new pool
+			if status!='done' and pool is not None and ff<len(fitlist) - 1:
+				pool.shutdown(wait=True,cancel_futures=True)
+				pool = concurrent.futures.ProcessPoolExecutor(max_workers=nprocess)
+	finally:
+		if pool is not None:
+			pool.shutdown(wait=True,cancel_futures=True)
+		if dict_tmp is not None:
+			shutil.rmtree(dict_tmp,ignore_errors=True)
+	time_batch = time.time() - time_batch
+
+	### Report the throughput of each map and of the whole batch
+	nfailed = sum([1 for entry in report if entry[1]!='done'])
+	nvox_batch = sum([entry[2] for entry in report])
+	print('')
+	print('Summary (output base name, status, voxels, wall time, throughput):')
+	for outroot, status, nvox, time_map in report:
+		print('    {}   {}   {} voxels   {:.1f} s   {:.0f} voxels/s'.format(outroot,status,nvox,time_map,nvox/max(time_map,1e-12)))
+	print('    total: {} maps fitted, {} failed, {} voxels in {:.1f} s ({:.0f} voxels/s)'.format(len(report) - nfailed,nfailed,nvox_batch,time_batch,nvox_batch/max(time_batch,1e-12)))
+	print('')
+	if nfailed>0:
+		sys.exit(1)
+	sys.exit(0)
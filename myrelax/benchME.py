@@ -0,0 +1,125 @@
+### Benchmark of the voxel-wise non-linear fitting in getT2T2star and getT1TR: finite-difference vs analytic gradients
+#
+# The script simulates noisy multi-echo (T2/T2star) and multi-repetition time (T1) signals and runs the L-BFGS-B
+# refinement of TxyFitMEslice() twice on every voxel, once estimating the gradient of MEFobj() by finite differences
+# and once with the analytic gradient of MEFobjGrad(). It reports the number of objective function evaluations and
+# the wall time per map for both options. When Numba is installed, it also runs the compiled Levenberg-Marquardt kernel
+# of relaxkernels (algo "lm" with the kernels option, voxel by voxel) from the same starting points, for reference:
+# "nonlinear" is always refined with L-BFGS-B (see precisionME.py for the agreement of kernels and NumPy/scipy).
+#
+# Usage: python benchME.py [--nvox <N>] [--nslices <N>] [--snr <value>] [--seed <N>]
+
+### Load useful modules
+import argparse, time
+import numpy as np
+from scipy.optimize import minimize
+import getT2T2star
+import getT1TR
+import relaxengine
+import relaxkernels
+
+
+def SimulateME(model,mri_te,nvox,snr,seed):
+	''' Simulate noisy measurements for a given relaxometry model
+
+	    INTERFACE
+	    meas = SimulateME(model,mri_te,nvox,snr,seed)
+
+	    PARAMETERS
+	    - model: module implementing the signal model (getT2T2star or getT1TR)
+	    - mri_te: array of sequence times (TE or TR, in ms)
+	    - nvox: number of voxels to simulate
+	    - snr: signal-to-noise ratio of the simulated S0
+	    - seed: seed of the random number generator
+
+	    RETURNS
+	    - meas: 2D numpy array of size nvox x Nmeas storing the simulated measurements'''
+
+	rng = np.random.default_rng(seed)
+	s0_vox = rng.uniform(500.0,1500.0,nvox)
+	if model is getT1TR:
+		txy_vox = rng.uniform(800.0,3000.0,nvox)
+	else:
+		txy_vox = rng.uniform(20.0,150.0,nvox)
+	meas = model.MEsignalBatch(mri_te,s0_vox,txy_vox)
+	meas = meas + rng.normal(0.0,np.mean(s0_vox)/snr,meas.shape)
+	return meas
+
+
+def BenchFit(model,mri_te,meas,s0_max_factor,txy_max):
+	''' Run the L-BFGS-B refinement of TxyFitMEslice() on all voxels with and without analytic gradients
+
+	    INTERFACE
+	    stats = BenchFit(model,mri_te,meas,s0_max_factor,txy_max)
+
+	    RETURNS
+	    - stats: dictionary storing total function evaluations, wall times and final objective functions
+		     for the finite-difference ("fd") and analytic ("analytic") options, and for the compiled kernel
+		     ("compiled", only if Numba is installed; function evaluations are not counted there)'''
+
+	s0_lin, txy_lin, exit_lin, sse_lin = model.MELinearFitBatch(mri_te,meas)
+	stats = {}
+	if relaxkernels.NUMBA_AVAILABLE:
+		kind = relaxengine.MODELS['T1' if model is getT1TR else 'T2']['kernel']
+		s0_init = np.copy(s0_lin)
+		txy_init = np.copy(txy_lin)
+		fobj_init = np.copy(sse_lin)
+		for vv in np.where(exit_lin==-1)[0]:
+			param_init, fobj_init[vv] = model.MEGridSearch(mri_te,meas[vv,:])
+			s0_init[vv], txy_init[vv] = param_init
+		out = [np.zeros(meas.shape[0]) for pp in range(0, 4)]
+		nit = np.zeros(meas.shape[0],'int64')
+		relaxkernels.KernelLMFit(kind,mri_te,meas[0:1,:],s0_init,txy_init,fobj_init,s0_max_factor*s0_lin,txy_max,*out,nit,100,1e-12,1e-10)   # Compile first
+		tstart = time.time()
+		relaxkernels.KernelLMFit(kind,mri_te,meas,s0_init,txy_init,fobj_init,s0_max_factor*s0_lin,txy_max,*out,nit,100,1e-12,1e-10)
+		stats['compiled'] = [0, time.time() - tstart, np.sum(out[3])]
+	for option in ['fd', 'analytic']:
+		nfev = 0
+		fobj = 0.0
+		tstart = time.time()
+		for vv in range(0, meas.shape[0]):
+			if exit_lin[vv]==-1:
+				param_init, fobj_init = model.MEGridSearch(mri_te,meas[vv,:])
+			else:
+				param_init = [s0_lin[vv],txy_lin[vv]]
+			param_bound = ((0,s0_max_factor*s0_lin[vv]),(0,txy_max),)
+			if option=='fd':
+				modelfit = minimize(model.MEFobj, param_init, method='L-BFGS-B', args=tuple([mri_te,meas[vv,:]]), bounds=param_bound)
+			else:
+				modelfit = minimize(model.MEFobjGrad, param_init, method='L-BFGS-B', jac=True, args=tuple([mri_te,meas[vv,:]]), bounds=param_bound)
+			nfev = nfev + modelfit.nfev
+			fobj = fobj + modelfit.fun
+		stats[option] = [nfev, time.time() - tstart, fobj]
+	return stats
+
+
+# Run the module as a script when required
+if __name__ == "__main__":
+
+	### Print help and parse arguments
+	parser = argparse.ArgumentParser(description='Benchmark of finite-difference vs analytic gradients in the voxel-wise non-linear fitting of myrelax (T2/T2star and T1).')
+	parser.add_argument('--nvox', metavar='<N>', type=int, default=2000, help='number of voxels per simulated slice (default: 2000)')
+	parser.add_argument('--nslices', metavar='<N>', type=int, default=20, help='number of slices of the map used to extrapolate wall times (default: 20)')
+	parser.add_argument('--snr', metavar='<value>', type=float, default=50.0, help='signal-to-noise ratio of the simulated data (default: 50)')
+	parser.add_argument('--seed', metavar='<N>', type=int, default=0, help='seed of the random number generator (default: 0)')
+	args = parser.parse_args()
+
+	protocols = [ ['T2/T2star', getT2T2star, np.linspace(10.0,120.0,12), 2.0, 1200.0],
+	              ['T1', getT1TR, np.array([300.0, 600.0, 1000.0, 1500.0, 2500.0, 4000.0, 6000.0]), 5.0, 5000.0] ]
+
+	print('')
+	print('Voxels per slice: {}; slices per map: {}; SNR: {}'.format(args.nvox,args.nslices,args.snr))
+	for name, model, mri_te, s0_max_factor, txy_max in protocols:
+		meas = SimulateME(model,mri_te,args.nvox,args.snr,args.seed)
+		stats = BenchFit(model,mri_te,meas,s0_max_factor,txy_max)
+		nfev_fd, time_fd, fobj_fd = stats['fd']
+		nfev_an, time_an, fobj_an = stats['analytic']
+		print('')
+		print('{} ({} measurements)'.format(name,mri_te.size))
+		print('    function evaluations per voxel:  finite differences {:.1f}  analytic {:.1f}  ({:.1f}x fewer)'.format(nfev_fd/args.nvox,nfev_an/args.nvox,nfev_fd/nfev_an))
+		print('    wall time per map (s):           finite differences {:.1f}  analytic {:.1f}  ({:.1f}x faster)'.format(time_fd*args.nslices,time_an*args.nslices,time_fd/time_an))
+		print('    total sum of squared errors:     finite differences {:.6g}  analytic {:.6g}'.format(fobj_fd,fobj_an))
+		if 'compiled' in stats:
+			nfev_co, time_co, fobj_co = stats['compiled']
+			print('    compiled "lm" kernel (Numba):    wall time per map {:.2f} s ({:.0f}x faster than analytic); total sum of squared errors {:.6g}'.format(time_co*args.nslices,time_an/time_co,fobj_co))
+	print('')
@@ -0,0 +1,150 @@
+### Accuracy check of the single-precision (float32) fitting of getT2T2star and getT1TR against the double-precision one
+#
+# The script simulates noisy multi-echo (T2/T2star) and multi-repetition time (T1) signals and fits them with every
+# fitting algorithm of relaxengine twice, once in double precision (float64) and once in single precision (float32,
+# see the precision option of TxyFitME()). For each algorithm, it reports the largest and median relative difference of
+# S0 and Txy between the two precisions in voxels fitted successfully in both, the fraction of voxels whose exit code
+# differs, and the wall time of both options. When Numba is installed, it also compares the compiled kernels of
+# relaxkernels (TxyFitME() option kernels) with the NumPy/scipy fitting in double precision, in the same way, on
+# "linear", "nonlinear" and "lm" and on two measurements.
+#
+# Usage: python precisionME.py [--nvox <N>] [--snr <value>] [--seed <N>] [--tol <value>]
+
+### Load useful modules
+import argparse, sys, time
+import numpy as np
+import relaxengine
+import relaxkernels
+
+
+def CompareME(model,mri_te,meas,algo):
+	''' Fit the same measurements in double and single precision and compare the fitted parameters
+
+	    INTERFACE
+	    stats = CompareME(model,mri_te,meas,algo)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" or "T1"; see relaxengine.RegisterModel())
+	    - mri_te: array of sequence times (TE or TR, in ms)
+	    - meas: 2D numpy array of size Nvox x Nmeas storing the measurements (double precision)
+	    - algo: fitting algorithm (see relaxengine.TxyFitME())
+
+	    RETURNS
+	    - stats: list storing the largest and median relative differences of S0 and Txy between the two precisions
+		     (voxels fitted successfully in both), the fraction of voxels with different exit codes and the wall
+		     times of the double- and single-precision fitting'''
+
+	tstart = time.time()
+	fit64 = relaxengine.TxyFitMEvoxels(model,[meas,mri_te,algo,0])
+	time64 = time.time() - tstart
+	tstart = time.time()
+	fit32 = relaxengine.TxyFitMEvoxels(model,[meas.astype('float32'),mri_te,algo,0])
+	time32 = time.time() - tstart
+
+	both_ok = (fit64[2]==1) & (fit32[2]==1)
+	with np.errstate(divide='ignore',invalid='ignore'):
+		reldiff_s0 = np.abs(np.float64(fit32[0][both_ok]) - fit64[0][both_ok]) / np.abs(fit64[0][both_ok])
+		reldiff_txy = np.abs(np.float64(fit32[1][both_ok]) - fit64[1][both_ok]) / np.abs(fit64[1][both_ok])
+	if np.sum(both_ok)==0:
+		reldiff_s0 = np.zeros(1)
+		reldiff_txy = np.zeros(1)
+	exit_diff = np.mean(fit64[2]!=fit32[2])
+	return [np.max(reldiff_s0), np.median(reldiff_s0), np.max(reldiff_txy), np.median(reldiff_txy), exit_diff, time64, time32]
+
+
+def CompareKernelsME(model,mri_te,meas,algo):
+	''' Fit the same measurements with the NumPy/scipy implementation and with the Numba-compiled kernels and compare the fitted parameters
+
+	    INTERFACE
+	    stats = CompareKernelsME(model,mri_te,meas,algo)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" or "T1"; see relaxengine.RegisterModel())
+	    - mri_te: array of sequence times (TE or TR, in ms)
+	    - meas: 2D numpy array of size Nvox x Nmeas storing the measurements (double precision)
+	    - algo: fitting algorithm (see relaxengine.TxyFitME())
+
+	    RETURNS
+	    - stats: list storing the largest and median relative differences of S0 and Txy between the two implementations
+		     (voxels fitted successfully in both), the fraction of voxels with different exit codes and the wall
+		     times of the NumPy/scipy and compiled fitting (compilation excluded)'''
+
+	relaxengine.TxyFitMEvoxels(model,[meas[0:2,:],mri_te,algo,0,0,0,None,True])     # Compile the kernels first
+	tstart = time.time()
+	fitpy = relaxengine.TxyFitMEvoxels(model,[meas,mri_te,algo,0,0,0,None,False])
+	timepy = time.time() - tstart
+	tstart = time.time()
+	fitnb = relaxengine.TxyFitMEvoxels(model,[meas,mri_te,algo,0,0,0,None,True])
+	timenb = time.time() - tstart
+
+	both_ok = (fitpy[2]==1) & (fitnb[2]==1)
+	with np.errstate(divide='ignore',invalid='ignore'):
+		reldiff_s0 = np.abs(fitnb[0][both_ok] - fitpy[0][both_ok]) / np.abs(fitpy[0][both_ok])
+		reldiff_txy = np.abs(fitnb[1][both_ok] - fitpy[1][both_ok]) / np.abs(fitpy[1][both_ok])
+	if np.sum(both_ok)==0:
+		reldiff_s0 = np.zeros(1)
+		reldiff_txy = np.zeros(1)
+	exit_diff = np.mean(fitpy[2]!=fitnb[2])
+	return [np.max(reldiff_s0), np.median(reldiff_s0), np.max(reldiff_txy), np.median(reldiff_txy), exit_diff, timepy, timenb]
+
+
+# Run the module as a script when required
+if __name__ == "__main__":
+
+	### Print help and parse arguments
+	parser = argparse.ArgumentParser(description='Accuracy check of the single-precision (float32) fitting of myrelax (T2/T2star and T1) against the double-precision (float64) one.')
+	parser.add_argument('--nvox', metavar='<N>', type=int, default=5000, help='number of simulated voxels (default: 5000)')
+	parser.add_argument('--snr', metavar='<value>', type=float, default=50.0, help='signal-to-noise ratio of the simulated data (default: 50)')
+	parser.add_argument('--seed', metavar='<N>', type=int, default=0, help='seed of the random number generator (default: 0)')
+	parser.add_argument('--tol', metavar='<value>', type=float, default=1e-3, help='largest median relative difference of S0 and Txy accepted between the two precisions (default: 1e-3)')
+	args = parser.parse_args()
+
+	protocols = [ ['T2/T2star', 'T2', np.linspace(10.0,120.0,12), [20.0, 150.0]],
+	              ['T1', 'T1', np.array([300.0, 600.0, 1000.0, 1500.0, 2500.0, 4000.0, 6000.0]), [800.0, 3000.0]] ]
+
+	print('')
+	print('Voxels: {}; SNR: {}'.format(args.nvox,args.snr))
+	passed = True
+	kernels_passed = True
+	for name, model, mri_te, txy_range in protocols:
+		rng = np.random.default_rng(args.seed)
+		s0_vox = rng.uniform(500.0,1500.0,args.nvox)
+		txy_vox = rng.uniform(txy_range[0],txy_range[1],args.nvox)
+		meas = relaxengine.MEsignalBatch(model,mri_te,s0_vox,txy_vox)
+		meas = meas + rng.normal(0.0,np.mean(s0_vox)/args.snr,meas.shape)
+		print('')
+		print('{} ({} measurements)'.format(name,mri_te.size))
+		print('    algo         S0 rel. diff. (max / median)   Txy rel. diff. (max / median)   exit codes differing   wall time float64 / float32 (s)')
+		for algo in ['linear', 'nonlinear', 'lm', 'varpro', 'dict']:
+			stats = CompareME(model,mri_te,meas,algo)
+			print('    {:<10}   {:.1e} / {:.1e}              {:.1e} / {:.1e}               {:.2f}%                  {:.2f} / {:.2f}'.format(algo,stats[0],stats[1],stats[2],stats[3],100.0*stats[4],stats[5],stats[6]))
+			if stats[1]>args.tol or stats[3]>args.tol:
+				passed = False
+
+		# Compiled kernels against NumPy/scipy, on all measurements and on the first and last one
+		if relaxkernels.NUMBA_AVAILABLE:
+			print('    compiled kernels (Numba) vs NumPy/scipy, double precision:')
+			for algo, meas_cols in [['linear', slice(None)], ['nonlinear', slice(None)], ['lm', slice(None)], ['linear', [0,-1]]]:
+				stats = CompareKernelsME(model,mri_te[meas_cols],meas[:,meas_cols],algo)
+				label = algo if meas_cols==slice(None) else 'two meas.'
+				print('    {:<10}   {:.1e} / {:.1e}              {:.1e} / {:.1e}               {:.2f}%                  {:.2f} / {:.2f}'.format(label,stats[0],stats[1],stats[2],stats[3],100.0*stats[4],stats[5],stats[6]))
+				if stats[1]>args.tol or stats[3]>args.tol:
+					kernels_passed = False
+	print('')
+	if passed:
+		print('Single-precision fitting is within a median relative difference of {} of double-precision fitting.'.format(args.tol))
+	else:
+		print('ERROR: single-precision fitting differs from double-precision fitting by more than {}.'.format(args.tol))
+	if relaxkernels.NUMBA_AVAILABLE:
+		if kernels_passed:
+			print('Compiled kernels are within a median relative difference of {} of NumPy/scipy fitting.'.format(args.tol))
+		else:
+			print('ERROR: compiled kernels differ from NumPy/scipy fitting by more than {}.'.format(args.tol))
+	else:
+		print('Numba is not installed: compiled kernels not checked.')
+	print('')
+	if passed and kernels_passed:
+		sys.exit(0)
+	print('Exiting with 1.')
+	print('')
+	sys.exit(1)
@@ -0,0 +1,2207 @@
+### Fitting engine shared by the voxel-wise relaxometry models of myrelax (T2/T2star on multi-echo data, T1 on multi-repetition time data)
+#
+# Each signal model is registered once in MODELS (see RegisterModel()) with its basis function and derivative, grid
+# search, bounds and closed-form initialiser, and all fitting algorithms, the batched/parallel backend and TxyFitME()
+# take the name of the model as first argument. getT2T2star and getT1TR expose the engine for their own model.
+#
+# Author: Francesco Grussu, University College London
+#		    CDSQuaMRI Project 
+#		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>
+#
+# Code released under BSD Two-Clause license
+#
+# Copyright (c) 2019 University College London. 
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+### Load useful modules
+import contextlib, functools, hashlib, os, sys, time
+import multiprocessing
+import multiprocessing.shared_memory
+import concurrent.futures
+import numpy as np
+from scipy.optimize import minimize
+import nibabel as nib
+try:
+	from myrelax import relaxkernels
+except ImportError:
+	import relaxkernels       # Module run from within the myrelax folder
+
+
+### Registry of the signal models fitted by the engine (filled in at the end of the module)
+MODELS = {}
+
+
+def RegisterModel(model,basis,dbasis,txy_grid,s0_grid,s0_bound,txy_max,init,relaxation,kernel=None,epg=False,arlo=False):
+	''' Register a signal model  signal = S0 * f(t,Txy)  so that it can be fitted by the engine
+		
+	    INTERFACE
+	    RegisterModel(model,basis,dbasis,txy_grid,s0_grid,s0_bound,txy_max,init,relaxation,kernel=None,epg=False,arlo=False)
+	    
+	    PARAMETERS
+	    - model: name of the signal model (e.g. "T2" or "T1"), passed as first argument to all functions of the engine
+	    - basis: function f(t,Txy) returning the signal with S0 = 1 (it must broadcast numpy arrays of sequence times t and Txy)
+	    - dbasis: function returning the derivative df(t,Txy)/d(Txy) (same broadcasting as basis)
+	    - txy_grid: list of Txy values (ms) of the grid search (see MEGridSearchBatch())
+	    - s0_grid: list [k, N] defining the S0 values of the grid search as N values from 0 to k times the maximum signal
+	    - s0_bound: factor k such that S0 is bounded within [0, k*S0] of the initialisation in non-linear fitting
+	    - txy_max: largest possible Txy value (ms), used as upper bound of non-linear fitting and where fitting fails
+	    - init: closed-form initialiser, i.e. a function with the interface of MELinearFitBatch()
+	    - relaxation: description of the relaxation time printed when fitting (e.g. "transverse")
+	    - kernel: basis function of the Numba-compiled kernels equal to basis (relaxkernels.KERNEL_DECAY or
+		      relaxkernels.KERNEL_RECOVERY), or None if the model cannot be fitted with the compiled kernels (default).
+		      The compiled kernels replace init with weighted log-linear fitting, so they require init = MELinearFitBatch
+	    - epg: True if the relaxation time of the model can also be fitted on multi-echo spin-echo trains with the extended
+		   phase graph dictionary of algo "epg" (see MEEPGFitBatch()), False otherwise (default)
+	    - arlo: True if the basis function is the mono-exponential decay exp(-t/Txy), so that Txy can be estimated from the
+		    integrals of evenly spaced echoes with algo "arlo" (see MEARLOFitBatch()), False otherwise (default)
+
+	    Dependencies (Python packages): numpy'''
+
+	MODELS[model] = {'basis': basis, 'dbasis': dbasis, 'txy_grid': np.array(txy_grid,'float64'), 's0_grid': s0_grid, 
+	                 's0_bound': s0_bound, 'txy_max': txy_max, 'init': init, 'relaxation': relaxation,
+	                 'kernel': kernel, 'epg': epg, 'arlo': arlo}
+
+
+def DecayBasis(mri_te,txy):
+	''' Basis function of the transverse relaxation model ("T2"):  f(TE,Txy) = exp(-TE/Txy) '''
+	return np.exp((-1.0)*mri_te/txy)
+
+
+def DecayBasisDeriv(mri_te,txy):
+	''' Derivative of DecayBasis() with respect to Txy:  exp(-TE/Txy) * TE / Txy^2 '''
+	return np.exp((-1.0)*mri_te/txy)*mri_te/(txy*txy)
+
+
+def RecoveryBasis(mri_tr,txy):
+	''' Basis function of the longitudinal relaxation model ("T1"):  f(TR,Txy) = k * (1 - exp(-TR/Txy)), with k = 1.7315068493150685 '''
+	return (1 - np.exp((-1.0)*mri_tr/txy)) * 1.7315068493150685
+
+
+def RecoveryBasisDeriv(mri_tr,txy):
+	''' Derivative of RecoveryBasis() with respect to Txy:  -k * exp(-TR/Txy) * TR / Txy^2 '''
+	return (-1.0)*np.exp((-1.0)*mri_tr/txy)*mri_tr/(txy*txy) * 1.7315068493150685
+
+
+def EPGEchoTrain(esp,nechoes,t2,b1,t1=1000.0):
+	''' Echo amplitudes of a multi-echo spin-echo (CPMG) train, simulated with the extended phase graph (EPG) formalism
+
+	    INTERFACE
+	    echoes = EPGEchoTrain(esp,nechoes,t2,b1,t1=1000.0)
+
+	    PARAMETERS
+	    - esp: echo spacing (ms); echo n is acquired at TE = n*esp
+	    - nechoes: number of echoes
+	    - t2, b1: 1D numpy arrays of N elements storing T2 (ms) and the refocusing factor, i.e. the ratio between the actual
+		      and the nominal (180 degrees) refocusing flip angle, of each train to simulate
+	    - t1: T1 (ms) used for the relaxation of the longitudinal states (default 1000)
+
+	    RETURNS
+	    - echoes: 2D numpy array of size N x nechoes storing the echo amplitudes with S0 = 1 (ideal 90 degree excitation)
+
+		    All trains are simulated at once: the transverse (F+, F-) and longitudinal (Z) configuration states are
+		    relaxed, dephased and mixed by the refocusing pulses (Weigel M, J Magn Reson Imaging 2015, 41:266-295).
+		    With b1 = 1 the echoes decay as exp(-TE/T2); with b1 < 1 stimulated echoes make them deviate from it.'''
+
+	### Configuration states of all trains after the excitation (90 degrees about y, so that refocusing about x meets the CPMG condition)
+	t2 = np.array(t2,'float64').flatten()
+	b1 = np.array(b1,'float64').flatten()
+	nstates = 2*nechoes + 2
+	fplus = np.zeros((t2.size,nstates),'complex128')
+	fminus = np.zeros((t2.size,nstates),'complex128')
+	zlong = np.zeros((t2.size,nstates),'complex128')
+	fplus[:,0] = 1.0
+	fminus[:,0] = 1.0
+
+	### Relaxation over half an echo spacing and mixing of the states by the refocusing pulse (about x)
+	e2 = np.exp((-0.5)*esp/t2)[:,np.newaxis]
+	e1 = np.exp((-0.5)*esp/t1)
+	alpha = np.pi*b1[:,np.newaxis]
+	cos2 = np.cos(0.5*alpha)**2
+	sin2 = np.sin(0.5*alpha)**2
+	sina = np.sin(alpha)
+	cosa = np.cos(alpha)
+
+	def relax_and_dephase(fplus,fminus,zlong):
+		fplus = fplus*e2
+		fminus = fminus*e2
+		zlong = zlong*e1
+		zlong[:,0] = zlong[:,0] + (1.0 - e1)
+		fplus = np.concatenate((np.zeros((fplus.shape[0],1),'complex128'),fplus[:,0:-1]),axis=1)    # F+(k) --> F+(k+1)
+		fminus = np.concatenate((fminus[:,1:],np.zeros((fminus.shape[0],1),'complex128')),axis=1)   # F-(k) --> F-(k-1)
+		fplus[:,0] = np.conj(fminus[:,0])
+		return fplus, fminus, zlong
+
+	### Simulate the echo train
+	echoes = np.zeros((t2.size,nechoes),'float64')
+	for nn in range(0, nechoes):
+		fplus, fminus, zlong = relax_and_dephase(fplus,fminus,zlong)
+		fplus, fminus, zlong = ( cos2*fplus + sin2*fminus - 1j*sina*zlong,
+		                         sin2*fplus + cos2*fminus + 1j*sina*zlong,
+		                         -0.5j*sina*fplus + 0.5j*sina*fminus + cosa*zlong )
+		fplus, fminus, zlong = relax_and_dephase(fplus,fminus,zlong)
+		echoes[:,nn] = np.abs(fplus[:,0])
+	return echoes
+
+
+def MEPrecision(*arrays):
+	''' Floating point precision of the batched fitting functions: "float32" if all arrays are stored as
+	    single-precision floating point values (see the precision option of TxyFitME()), "float64" otherwise '''
+	if all(np.asarray(arr).dtype==np.float32 for arr in arrays):
+		return 'float32'
+	return 'float64'
+
+
+def MEsignal(model,mri_te,tissue_par):
+	''' Generate the signal of a relaxometry experiment according to a registered signal model
+		
+		
+	    INTERFACE
+	    signal = MEsignal(model,mri_te,tissue_par)
+	    
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - tissue_par: list/array of tissue parameters, in the following order:
+                          tissue_par[0] = S0 (T1-weighted proton density)
+             		  tissue_par[1] = Txy (relaxation time of the model, in ms)
+		
+	    RETURNS
+	    - signal: a numpy array of measurements generated according to the signal model,
+			
+		         signal  =  S0 * f(t,Txy) 
+		
+		      where t is the sequence time, f is the basis function of the model (see RegisterModel()) and where
+		      S0 and Txy are the tissue parameters (S0 is the T1-weighted proton density, and Txy is the relaxation
+		      time, i.e. T2 or T2* for model "T2" and T1 for model "T1").
+		
+		
+	    Dependencies (Python packages): numpy
+	    
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group
+	     
+	    Author: Francesco Grussu, University College London
+		    CDSQuaMRI Project 
+		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>'''
+	
+
+	### Handle inputs
+	te_values = np.array(mri_te,'float64')  # Make sure sequence times are stored as a numpy array
+	s0_value = tissue_par[0]         # S0
+	txy_value = tissue_par[1]        # Txy
+
+	### Calculate signal
+	with np.errstate(divide='raise',invalid='raise'):
+		try:
+			signal = s0_value * MODELS[model]['basis'](te_values,txy_value)
+		except FloatingPointError:
+			signal = 0.0 * te_values      # Just output zeros when txy_value is 0.0			
+
+	### Output signal
+	return signal
+	
+
+
+def MEFobj(model,tissue_par,mri_te,meas):
+	''' Fitting objective function for the relaxometry signal models		
+		
+	    INTERFACE
+	    fobj = MEFobj(model,tissue_par,mri_te,meas)
+	    
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - tissue_par: list/array of tissue parameters, in the following order:
+                          tissue_par[0] = S0 (T1-weighted proton density)
+             		  tissue_par[1] = Txy (relaxation time of the model, in ms)
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: list/array of measurements
+		
+	    RETURNS
+	    - fobj: objective function measured as sum of squared errors between measurements and predictions, i.e.
+			
+				 fobj = SUM_OVER_n( (prediction - measurement)^2 )
+		
+		     Above, the prediction are obtained using the signal model implemented by function MEsignal().
+	    
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group
+	     
+	    Author: Francesco Grussu, University College London
+		    CDSQuaMRI Project 
+		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>'''
+	
+	
+	### Predict signals given tissue and sequence parameters
+	pred = MEsignal(model,mri_te,tissue_par)
+
+	### Calculate objective function and return
+	fobj = np.sum( (np.array(pred) - np.array(meas))**2 )
+	return fobj
+
+
+def MEjacobian(model,mri_te,tissue_par):
+	''' Jacobian of the relaxometry signal models with respect to the tissue parameters
+
+	    INTERFACE
+	    jac = MEjacobian(model,mri_te,tissue_par)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - tissue_par: list/array of tissue parameters, in the following order:
+                          tissue_par[0] = S0 (T1-weighted proton density)
+             		  tissue_par[1] = Txy (relaxation time of the model, in ms)
+
+	    RETURNS
+	    - jac: numpy array of size Nmeas x 2 storing the derivatives of the signal model of MEsignal(), i.e.
+
+		         jac[:,0] = d(signal)/d(S0)  = f(t,Txy)
+		         jac[:,1] = d(signal)/d(Txy) = S0 * df(t,Txy)/d(Txy)
+
+		   with f the basis function of the model (see RegisterModel())
+
+		   The Jacobian is 0.0 when Txy is 0.0 (MEsignal() outputs zeros in that case)
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	te_values = np.array(mri_te,'float64')  # Make sure sequence times are stored as a numpy array
+	s0_value = tissue_par[0]         # S0
+	txy_value = tissue_par[1]        # Txy
+
+	### Calculate derivatives
+	jac = np.zeros((te_values.size,2),'float64')
+	if txy_value!=0:
+		jac[:,0] = MODELS[model]['basis'](te_values,txy_value)
+		jac[:,1] = s0_value*MODELS[model]['dbasis'](te_values,txy_value)
+
+	### Output Jacobian
+	return jac
+
+
+def MEFobjGrad(model,tissue_par,mri_te,meas):
+	''' Fitting objective function for the relaxometry signal models and its analytic gradient
+
+	    INTERFACE
+	    fobj, grad = MEFobjGrad(model,tissue_par,mri_te,meas)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - tissue_par: list/array of tissue parameters, in the following order:
+                          tissue_par[0] = S0 (T1-weighted proton density)
+             		  tissue_par[1] = Txy (relaxation time of the model, in ms)
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: list/array of measurements
+
+	    RETURNS
+	    - fobj: sum of squared errors between measurements and predictions, as in MEFobj()
+	    - grad: numpy array with the derivatives of fobj with respect to S0 and Txy, i.e.
+
+			 grad = 2 * jac' * (prediction - measurement)
+
+		    where jac is the Jacobian of the signal model (see MEjacobian()). The function can be passed to
+		    scipy.optimize.minimize() with jac=True, so that gradients are not estimated by finite differences.
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	te_values = np.array(mri_te,'float64')  # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,'float64')
+	s0_value = tissue_par[0]         # S0
+	txy_value = tissue_par[1]        # Txy
+
+	### Predict signals and calculate the objective function with its gradient (signal and derivatives are zeros when txy_value is 0.0)
+	if txy_value!=0:
+		basis = MODELS[model]['basis'](te_values,txy_value)
+		res = s0_value*basis - meas
+		grad = np.array([ 2.0*np.sum(res*basis), 2.0*np.sum(res*s0_value*MODELS[model]['dbasis'](te_values,txy_value)) ])
+	else:
+		res = (-1.0)*meas
+		grad = np.zeros(2,'float64')
+	fobj = np.sum(res*res)
+
+	### Return objective function and gradient
+	return fobj, grad
+
+
+def MEGridSearch(model,mri_te,meas):
+	''' Grid search for non-linear fitting of the relaxometry signal models		
+		
+	    INTERFACE
+	    tissue_estimate, fobj_grid = MEGridSearch(model,mri_te,meas)
+	    
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: list/array of measurements
+		
+	    RETURNS
+	    - tissue_estimate: estimate of tissue parameters that explain the measurements reasonably well. The parameters are
+			       estimated sampling the fitting objective function MEFobj() over a grid; the output is
+                               tissue_estimate[0] = S0 (T1-weighted proton density)
+             		       tissue_estimate[1] = Txy (relaxation time of the model, in ms)
+	    - fobj_grid:       value of the objective function when the tissue parameters equal tissue_estimate
+	    
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group
+	     
+	    Author: Francesco Grussu, University College London
+		    CDSQuaMRI Project 
+		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>'''
+	
+	### Run grid search on the only voxel as a batch of one voxel
+	s0_best, txy_best, fobj_best = MEGridSearchBatch(model,mri_te,np.reshape(np.array(meas,'float64'),(1,-1)))
+	s0_best = s0_best[0]
+	txy_best = txy_best[0]
+	fobj_best = fobj_best[0]
+
+	### Return output
+	paramsgrid = np.array([s0_best, txy_best])
+	fobjgrid = fobj_best
+	return paramsgrid, fobjgrid
+
+
+def MEGridSearchBatch(model,mri_te,meas,nrefine=0,nfine=8,nchunk=1024):
+	''' Grid search for non-linear fitting of the relaxometry signal models, run on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, fobj_vox = MEGridSearchBatch(model,mri_te,meas,nrefine=0,nfine=8,nchunk=1024)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+	    - nrefine: number of coarse-to-fine refinement levels (default 0, i.e. grid of MEGridSearch() only). At each
+		       level, a new grid of nfine x nfine points is sampled between the neighbours of the best grid point
+	    - nfine: number of points along each parameter of the refinement grids (default 8)
+	    - nchunk: number of voxels whose (Txy grid x S0 grid x sequence time) objective function tensor is evaluated
+		      in one numpy operation (default 1024; it limits memory usage)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) minimising the objective function on the grid, for each voxel
+	    - txy_vox:  Txy (relaxation time of the model, in ms) minimising the objective function on the grid
+	    - fobj_vox: value of the objective function MEFobj() at s0_vox and txy_vox
+
+		    Outputs are single-precision floating point values if meas is (see MEPrecision()). With nrefine = 0 the output equals that of MEGridSearch() called voxel-by-voxel (same grid,
+		    same order of evaluation in case of ties).
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,precision)           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x Nmeas array
+	Nvox = meas.shape[0]
+
+	### Prepare grid for grid search (one row of grid values per voxel)
+	txy_grid = np.tile(np.array(MODELS[model]['txy_grid'],precision),(Nvox,1))              # Grid of Txy values of the model
+	s0_factor, s0_num = MODELS[model]['s0_grid']
+	s0_grid = np.linspace(np.zeros(Nvox,precision),s0_factor*np.max(meas,axis=1),num=s0_num,axis=1,dtype=precision)    # Grid of S0 values: from 0 up to a multiple of the maximum signal of each voxel
+
+	### Initialise objective function to infinity and parameters for grid search
+	fobj_vox = np.inf*np.ones(Nvox,precision)
+	s0_vox = np.zeros(Nvox,precision)
+	txy_vox = np.zeros(Nvox,precision)
+
+	### Run grid search, followed by the requested refinement levels
+	for level in range(0, nrefine + 1):
+
+		# Sample a finer grid between the neighbours of the best point of the previous level
+		if level>0:
+			Ntxy = txy_grid.shape[1]
+			Ns0 = s0_grid.shape[1]
+			txy_grid = np.linspace(txy_grid[np.arange(Nvox),np.maximum(idx_txy - 1,0)],txy_grid[np.arange(Nvox),np.minimum(idx_txy + 1,Ntxy - 1)],num=nfine,axis=1,dtype=precision)
+			s0_grid = np.linspace(s0_grid[np.arange(Nvox),np.maximum(idx_s0 - 1,0)],s0_grid[np.arange(Nvox),np.minimum(idx_s0 + 1,Ns0 - 1)],num=nfine,axis=1,dtype=precision)
+		Ntxy = txy_grid.shape[1]
+		Ns0 = s0_grid.shape[1]
+		idx_txy = np.zeros(Nvox,'int64')
+		idx_s0 = np.zeros(Nvox,'int64')
+		fobj_level = np.inf*np.ones(Nvox,precision)
+
+		# Evaluate the objective function on the whole (voxels x Txy grid x S0 grid x sequence time) tensor, one chunk of voxels at a time
+		for vstart in range(0, Nvox, nchunk):
+			vend = min(vstart + nchunk,Nvox)
+			basis = MEsignalBatch(model,te_values,np.ones(Ntxy*(vend - vstart),precision),txy_grid[vstart:vend,:].flatten())
+			basis = np.reshape(basis,(vend - vstart,Ntxy,1,te_values.size))
+			pred = s0_grid[vstart:vend,np.newaxis,:,np.newaxis]*basis
+			fobj_tensor = np.sum( (pred - meas[vstart:vend,np.newaxis,np.newaxis,:])**2, axis=3 )
+			fobj_tensor[~(fobj_tensor<np.inf)] = np.inf          # Objective functions that are not numbers are never selected
+			fobj_tensor = np.reshape(fobj_tensor,(vend - vstart,Ntxy*Ns0))
+			idx_best = np.argmin(fobj_tensor,axis=1)               # First minimum in the order Txy (outer) and S0 (inner)
+			fobj_level[vstart:vend] = fobj_tensor[np.arange(vend - vstart),idx_best]
+			idx_txy[vstart:vend] = idx_best // Ns0
+			idx_s0[vstart:vend] = idx_best % Ns0
+
+		# Check if objective function is smaller than previous value
+		better = fobj_level<fobj_vox
+		fobj_vox[better] = fobj_level[better]
+		s0_vox[better] = s0_grid[better,idx_s0[better]]
+		txy_vox[better] = txy_grid[better,idx_txy[better]]
+
+	### Return output
+	return s0_vox, txy_vox, fobj_vox
+
+
+def MELinearFitBatch(model,mri_te,meas):
+	''' Weighted log-linear fitting of the signal model on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox = MELinearFitBatch(model,mri_te,meas)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (relaxation time of the model, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel, as provided by MEFobj()
+
+		    The linearised model log(signal) = log(S0) - t/Txy is fitted with weights equal to the measured signals,
+		    i.e. coefficients are ( W * Q )^-1 * (W * log(m)), as done voxel-by-voxel in TxyFitMEslice(). Here the
+		    2x2 normal equations are solved in closed form for all voxels simultaneously. Plausibility checks and
+		    exit codes are the same as those of the voxel-wise fitting: voxels with non-positive signals fail with
+		    S0 = Txy = SSE = 0.0, while voxels providing Txy < 0 get S0 = mean signal and Txy = txy_max of the model
+		    (1200 ms for "T2", 5000 ms for "T1"). This is the closed-form initialiser of both registered models.
+		    Outputs are single-precision floating point values if meas is (see MEPrecision()); the five sums of the
+		    normal equations of each voxel are accumulated in double precision all the same, as their determinant
+		    would otherwise lose most of its significant digits.
+
+	    Dependencies (Python packages): numpy
+
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,precision)           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x Nmeas array
+	Nvox = meas.shape[0]
+
+	### Allocate outputs: by default fitting has failed
+	s0_vox = np.zeros(Nvox,precision)
+	txy_vox = np.zeros(Nvox,precision)
+	exit_vox = -1.0*np.ones(Nvox,precision)
+	sse_vox = np.zeros(Nvox,precision)
+
+	### Voxels where the logarithm of the signal is defined (voxel-wise fitting fails with a FloatingPointError otherwise)
+	valid = np.all(meas>0,axis=1)
+	if np.sum(valid)==0:
+		return s0_vox, txy_vox, exit_vox, sse_vox
+	sig_valid = meas[valid,:]
+
+	### Calculate linear regression coefficients solving the normal equations ( Q' * W^2 * Q ) * coeffs = Q' * W^2 * log(m)
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+		Yvals = np.log(sig_valid)                # Independent variable of linearised model
+		Xvals = (-1.0)*te_values                 # Dependent variable of linearised model
+		wsq = sig_valid*sig_valid                # Squared weights
+		a11 = np.sum(wsq,axis=1,dtype='float64')
+		a12 = np.sum(wsq*Xvals,axis=1,dtype='float64')
+		a22 = np.sum(wsq*Xvals*Xvals,axis=1,dtype='float64')
+		b1 = np.sum(wsq*Yvals,axis=1,dtype='float64')
+		b2 = np.sum(wsq*Xvals*Yvals,axis=1,dtype='float64')
+		det = a11*a22 - a12*a12
+		coeff0 = (a22*b1 - a12*b2) / det
+		coeff1 = (a11*b2 - a12*b1) / det
+
+		# Retrieve signal model parameters from linear regression coefficients (1/coeff1 fails when coeff1 is 0)
+		ok = np.isfinite(coeff0) & np.isfinite(coeff1) & (coeff1!=0.0)
+		s0_fit = np.array(np.exp(coeff0),precision)
+		txy_fit = np.array(1.0 / coeff1,precision)
+		exit_fit = np.ones(coeff1.shape,precision)
+
+		# Check whether the solution is plausible: if not, declare fitting failed
+		neg = txy_fit<0
+		s0_fit[neg] = np.mean(sig_valid[neg,:],axis=1)
+		txy_fit[neg] = MODELS[model]['txy_max']    # We fix Txy to the maximum possible value of the model
+		exit_fit[neg] = -1.0
+
+		# Measure of quality of fit
+		sse_fit = np.sum( (MEsignalBatch(model,te_values,s0_fit,txy_fit) - sig_valid)**2, axis=1 )
+
+	### Store results of voxels that could be fitted
+	valid_idx = np.where(valid)[0][ok]
+	s0_vox[valid_idx] = s0_fit[ok]
+	txy_vox[valid_idx] = txy_fit[ok]
+	exit_vox[valid_idx] = exit_fit[ok]
+	sse_vox[valid_idx] = sse_fit[ok]
+
+	### Return output
+	return s0_vox, txy_vox, exit_vox, sse_vox
+
+
+def METwoPointBatch(model,mri_te,meas,txy_max=None):
+	''' Analytic solution of the signal model for two measurements, on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox = METwoPointBatch(model,mri_te,meas,txy_max=None)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the two sequence times (TEs or TRs, in ms) used for the experiment
+	    - meas: 2D numpy array of measurements of size Nvox x 2 (one row per voxel, one column per sequence time)
+	    - txy_max: Txy (ms) assigned where the solution is negative (default None, i.e. txy_max of the model)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (relaxation time of the model, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel, as provided by MEFobj()
+
+		    Txy = (t2 - t1) / log(m1/m2) and S0 = m1 / exp(-t1/Txy) are calculated for all voxels simultaneously.
+		    Voxels where the solution is not defined (division by zero or logarithm of a non-positive number, which
+		    raise a FloatingPointError when the solution is calculated voxel by voxel) fail with S0 = Txy = SSE = 0.0.
+		    Voxels providing Txy < 0 get S0 = mean signal and Txy = txy_max, and voxels providing S0 < 0 get S0 = 0.0,
+		    both with exit code -1. Apart from the ratio m1/m2, the solution is calculated in double precision, and it is
+		    returned as single-precision floating point values if meas is stored as such (see MEPrecision()).
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,'float64')           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x 2 array
+	sig_vox = np.array(meas,'float64')
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+
+	### Calculate the solution analytically on all voxels at once (the ratio of the measurements in their own precision, the rest in double precision)
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore',under='ignore'):
+		ratio = np.array(meas[:,0] / meas[:,1],precision)
+		txy_vox = ( te_values[1] - te_values[0] ) / np.array(np.log( ratio ),'float64')
+		decay = np.exp( (-1.0)*te_values[0] / txy_vox )
+		s0_vox = sig_vox[:,0] / decay
+	exit_vox = np.ones(txy_vox.shape,'float64')
+
+	### Check whether the solution is plausible
+	neg = txy_vox<0
+	s0_vox[neg] = np.mean(sig_vox[neg,:],axis=1)
+	txy_vox[neg] = txy_max     # We fix Txy to the maximum possible value of the model
+	exit_vox[neg] = -1.0
+	neg = s0_vox<0
+	s0_vox[neg] = 0.0
+	exit_vox[neg] = -1.0
+
+	### Measure of quality of fit (0 when the solution provides Txy > 0 and S0 > 0 at the first attempt). As in MEsignal(), the predicted
+	### signal is 0.0 where it is not defined, i.e. where a NaN appears although S0 and Txy are not NaN
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore',under='ignore'):
+		pred = s0_vox[:,np.newaxis]*MODELS[model]['basis'](te_values[np.newaxis,:],txy_vox[:,np.newaxis])
+		pred[(txy_vox==0) | ( ~np.isnan(s0_vox) & ~np.isnan(txy_vox) & np.any(np.isnan(pred),axis=1) ),:] = 0.0
+		sse_vox = np.sum( (pred - sig_vox)**2, axis=1 )
+
+	### Voxels where the solution is not defined: fitting has failed. These are the voxels where a division by zero or an invalid
+	### operation occurs, i.e. where a NaN appears although the measurements are not NaN (operations on NaN do not raise any error)
+	notnan = ~np.isnan(sig_vox[:,0]) & ~np.isnan(sig_vox[:,1])
+	undefined = ( (sig_vox[:,1]==0) & ~np.isnan(sig_vox[:,0]) ) | (ratio<=0) | (ratio==1) | (txy_vox==0) | ( (decay==0) & ~np.isnan(sig_vox[:,0]) )
+	undefined = undefined | ( notnan & ( np.isnan(s0_vox) | np.isnan(txy_vox) ) )
+	s0_vox[undefined] = 0.0
+	txy_vox[undefined] = 0.0
+	exit_vox[undefined] = -1.0
+	sse_vox[undefined] = 0.0
+
+	### Return output
+	return np.array(s0_vox,precision), np.array(txy_vox,precision), np.array(exit_vox,precision), np.array(sse_vox,precision)
+
+
+def MEEvenSpacing(mri_te):
+	''' Spacing (ms) of sequence times TE1, TE1 + dTE, TE1 + 2*dTE, ..., or None if the sequence times are not spaced evenly '''
+	te_values = np.array(mri_te,'float64').flatten()
+	if te_values.size<2:
+		return None
+	dte = te_values[1] - te_values[0]
+	if dte<=0 or not np.allclose(te_values,te_values[0] + dte*np.arange(0,te_values.size),rtol=1e-3,atol=0.0):
+		return None
+	return dte
+
+
+def MEARLOFitBatch(model,mri_te,meas,txy_max=None):
+	''' Auto-regression on linear operations (ARLO): closed-form estimation of Txy from echo integrals, on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox = MEARLOFitBatch(model,mri_te,meas,txy_max=None)
+
+	    PARAMETERS
+	    - model: name of the signal model (a model registered with arlo=True, i.e. "T2"; see RegisterModel())
+	    - mri_te: list/array indicating at least 3 evenly spaced sequence times (TEs, in ms) used for the experiment
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+	    - txy_max: upper bound of Txy (ms), also assigned where the estimate is not positive (default None, i.e. txy_max of the model)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (relaxation time of the model, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel, as provided by MEFobj()
+
+		    With echo spacing dTE, the integral of the decay between echoes i-2 and i is approximated with Simpson's rule,
+		    I_i = dTE/3 * (m_i-2 + 4*m_i-1 + m_i), and since d(signal)/dt = -signal/Txy, m_i-2 - m_i = I_i / Txy. Txy is
+		    the ARLO estimate of Pei et al., a linear regression of this Simpson-rule recursion over all i,
+
+		         Txy  =  ( sum I_i^2 + dTE/3 * sum I_i*d_i ) / ( dTE/3 * sum d_i^2 + sum I_i*d_i ),   d_i = m_i-2 - m_i
+
+		    This is not a least-squares fit of the exponential decay to the signals: on noisy data (or with echo spacings
+		    that are long compared to Txy, where Simpson's rule is less accurate), Txy differs from the output of "linear"
+		    and "nonlinear". S0 is then the least-squares S0 of the model for that Txy. No logarithm is taken, so that voxels with
+		    noisy late echoes close to 0 are also fitted. Voxels providing Txy <= 0 (or no decay at all) get
+		    S0 = mean signal and Txy = txy_max with exit code -1, as with linear fitting, and Txy is capped at txy_max;
+		    voxels where Txy is not defined fail with S0 = Txy = SSE = 0.0. Sums are accumulated in double precision,
+		    and outputs are single-precision floating point values if meas is (see MEPrecision()).
+
+	    Dependencies (Python packages): numpy
+
+	    References: Pei M et al, Magnetic Resonance in Medicine 2015, 73(2): 843-850'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,'float64')           # Make sure sequence times are stored as a numpy array
+	sig_vox = np.array(meas,'float64')               # Measurements as a Nvox x Nmeas array
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+	dte = te_values[1] - te_values[0]                # Echo spacing
+
+	### Echo integrals (Simpson's rule) and echo differences over each set of three consecutive echoes, and auto-regression on all voxels at once
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+		integral = (dte/3.0)*( sig_vox[:,0:-2] + 4.0*sig_vox[:,1:-1] + sig_vox[:,2:] )
+		delta = sig_vox[:,0:-2] - sig_vox[:,2:]
+		cross = (dte/3.0)*np.sum(integral*delta,axis=1)
+		txy_vox = ( np.sum(integral*integral,axis=1) + cross ) / ( (dte/3.0)*np.sum(delta*delta,axis=1) + np.sum(integral*delta,axis=1) )
+	exit_vox = np.ones(txy_vox.shape,'float64')
+
+	### Check whether the solution is plausible
+	undefined = np.isnan(txy_vox)
+	neg = ~undefined & ( (txy_vox<=0) | np.isinf(txy_vox) )
+	txy_vox[neg] = txy_max     # We fix Txy to the maximum possible value of the model
+	exit_vox[neg] = -1.0
+	txy_vox[txy_vox>txy_max] = txy_max
+
+	### Least-squares S0 for the estimated Txy (mean signal where the solution is not plausible), and measure of quality of fit
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore',under='ignore'):
+		basis = MODELS[model]['basis'](te_values[np.newaxis,:],txy_vox[:,np.newaxis])
+		s0_vox = np.maximum(np.sum(basis*sig_vox,axis=1),0.0) / np.sum(basis*basis,axis=1)
+		s0_vox[neg] = np.mean(sig_vox[neg,:],axis=1)
+		sse_vox = np.sum( (s0_vox[:,np.newaxis]*basis - sig_vox)**2, axis=1 )
+
+	### Voxels where the solution is not defined: fitting has failed
+	undefined = undefined | np.isnan(s0_vox) | np.isnan(sse_vox)
+	s0_vox[undefined] = 0.0
+	txy_vox[undefined] = 0.0
+	exit_vox[undefined] = -1.0
+	sse_vox[undefined] = 0.0
+
+	### Return output
+	return np.array(s0_vox,precision), np.array(txy_vox,precision), np.array(exit_vox,precision), np.array(sse_vox,precision)
+
+
+def MEsignalBatch(model,mri_te,s0_vox,txy_vox):
+	''' Generate the signal of a relaxometry experiment for many voxels at once
+
+	    INTERFACE
+	    signal = MEsignalBatch(model,mri_te,s0_vox,txy_vox)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - s0_vox: array of S0 values (T1-weighted proton density), one per voxel
+	    - txy_vox: array of Txy values (relaxation time of the model, in ms), one per voxel
+
+	    RETURNS
+	    - signal: 2D numpy array of size Nvox x Nmeas storing the signals S0 * f(t,Txy) (see MEsignal()).
+		      As in MEsignal(), the signal is 0.0 in voxels where Txy is 0.0
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(s0_vox,txy_vox)
+	te_values = np.array(mri_te,precision)
+	s0_vox = np.array(s0_vox,precision)
+	txy_vox = np.array(txy_vox,precision)
+
+	### Calculate signal
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+		basis = MODELS[model]['basis'](te_values[np.newaxis,:],txy_vox[:,np.newaxis])
+	basis[txy_vox<=0,:] = 0.0
+	signal = s0_vox[:,np.newaxis]*basis
+
+	### Output signal
+	return signal
+
+
+def MEjacobianBatch(model,mri_te,s0_vox,txy_vox):
+	''' Jacobian of the relaxometry signal models with respect to the tissue parameters, for many voxels at once
+
+	    INTERFACE
+	    jac = MEjacobianBatch(model,mri_te,s0_vox,txy_vox)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - s0_vox: array of S0 values (T1-weighted proton density), one per voxel
+	    - txy_vox: array of Txy values (relaxation time of the model, in ms), one per voxel
+
+	    RETURNS
+	    - jac: 3D numpy array of size Nvox x Nmeas x 2, such that
+		   jac[:,:,0] = d(signal)/d(S0)  = f(t,Txy)
+		   jac[:,:,1] = d(signal)/d(Txy) = S0 * df(t,Txy)/d(Txy)
+		   The Jacobian is 0.0 in voxels where Txy is 0.0
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(s0_vox,txy_vox)
+	te_values = np.array(mri_te,precision)
+	s0_vox = np.array(s0_vox,precision)
+	txy_vox = np.array(txy_vox,precision)
+
+	### Calculate derivatives
+	jac = np.zeros((s0_vox.size,te_values.size,2),precision)
+	with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+		jac[:,:,0] = MODELS[model]['basis'](te_values[np.newaxis,:],txy_vox[:,np.newaxis])
+		jac[:,:,1] = s0_vox[:,np.newaxis]*MODELS[model]['dbasis'](te_values[np.newaxis,:],txy_vox[:,np.newaxis])
+	jac[txy_vox<=0,:,:] = 0.0
+
+	### Output Jacobian
+	return jac
+
+
+def MEUncertaintyBatch(model,mri_te,s0_vox,txy_vox,sse_vox,nchunk=65536):
+	''' Cramer-Rao standard errors of the fitted S0 and Txy, for many voxels at once
+
+	    INTERFACE
+	    s0se_vox, txyse_vox = MEUncertaintyBatch(model,mri_te,s0_vox,txy_vox,sse_vox,nchunk=65536)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - s0_vox, txy_vox: arrays of fitted S0 and Txy values, one per voxel
+	    - sse_vox: array of fitting sums of squared errors, one per voxel (see MEFobj())
+	    - nchunk: number of voxels processed at once, which bounds the memory used (default 65536)
+
+	    RETURNS
+	    - s0se_vox:  standard error of S0 for each voxel (1D array of Nvox elements)
+	    - txyse_vox: standard error of Txy (ms) for each voxel
+
+		    The noise variance of each voxel is estimated from the residuals as SSE / (Nmeas - 2), and the covariance
+		    of the fitted parameters is approximated by the noise variance times the inverse of J'*J, where J is the
+		    Jacobian of the signal model at the fitted parameters (see MEjacobianBatch()). The 2x2 matrix J'*J is
+		    accumulated in double precision and inverted in closed form for all voxels simultaneously. Standard errors
+		    are 0.0 where they are not defined, i.e. with 2 measurements (no residual degrees of freedom), where Txy or
+		    S0 is 0.0 or where J'*J is singular. Outputs are single-precision floating point values if the fitted
+		    parameters are (see MEPrecision()).
+
+	    Dependencies (Python packages): numpy
+
+	    References: Kay SM, "Fundamentals of statistical signal processing: estimation theory", Prentice Hall (1993)'''
+
+	### Handle inputs
+	precision = MEPrecision(s0_vox,txy_vox,sse_vox)
+	te_values = np.array(mri_te,'float64')
+	s0_vox = np.array(s0_vox,precision)
+	txy_vox = np.array(txy_vox,precision)
+	sse_vox = np.array(sse_vox,precision)
+	Nvox = s0_vox.size
+	Nmeas = te_values.size
+
+	### Allocate outputs: by default standard errors are not defined
+	s0se_vox = np.zeros(Nvox,precision)
+	txyse_vox = np.zeros(Nvox,precision)
+	if Nmeas<=2:
+		return s0se_vox, txyse_vox
+
+	### Invert J'*J and scale it by the noise variance, one chunk of voxels at a time
+	for vstart in range(0, Nvox, nchunk):
+		vend = min(vstart + nchunk,Nvox)
+		jac = MEjacobianBatch(model,te_values,np.array(s0_vox[vstart:vend],'float64'),np.array(txy_vox[vstart:vend],'float64'))
+		a11 = np.sum(jac[:,:,0]*jac[:,:,0],axis=1)
+		a12 = np.sum(jac[:,:,0]*jac[:,:,1],axis=1)
+		a22 = np.sum(jac[:,:,1]*jac[:,:,1],axis=1)
+		det = a11*a22 - a12*a12
+		noisevar = np.array(sse_vox[vstart:vend],'float64') / (Nmeas - 2)
+		with np.errstate(divide='ignore',invalid='ignore'):
+			s0var = noisevar*a22/det
+			txyvar = noisevar*a11/det
+		ok = np.isfinite(s0var) & np.isfinite(txyvar) & (det>0) & (s0var>=0) & (txyvar>=0)
+		s0se_vox[vstart:vend] = np.where(ok,np.sqrt(np.where(ok,s0var,0.0)),0.0)
+		txyse_vox[vstart:vend] = np.where(ok,np.sqrt(np.where(ok,txyvar,0.0)),0.0)
+
+	### Return output
+	return s0se_vox, txyse_vox
+
+
+def MELMFitBatch(model,mri_te,meas,s0_init,txy_init,s0_max,txy_max,niter=100,ftol=1e-12,xtol=1e-10):
+	''' Bounded Levenberg-Marquardt fitting of the signal model on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, fobj_vox, success_vox, nit_vox = MELMFitBatch(model,mri_te,meas,s0_init,txy_init,s0_max,txy_max)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+	    - s0_init, txy_init: arrays of Nvox elements with the starting values of S0 and Txy
+	    - s0_max: upper bound for S0 (scalar or array of Nvox elements; the lower bound is 0)
+	    - txy_max: upper bound for Txy in ms (scalar or array of Nvox elements; the lower bound is 0)
+	    - niter: maximum number of iterations (default 100)
+	    - ftol: relative decrease of the objective function below which a voxel is considered converged
+	    - xtol: relative parameter change below which a voxel is considered converged
+
+	    RETURNS
+	    - s0_vox, txy_vox: fitted S0 and Txy for each voxel
+	    - fobj_vox:        sum of squared errors at the fitted parameters (see MEFobj())
+	    - success_vox:     boolean array, True where the optimisation converged within niter iterations
+	    - nit_vox:         number of iterations performed in each voxel
+
+		    All voxels are iterated simultaneously as numpy arrays: at each iteration the damped 2x2 Gauss-Newton
+		    system is solved in closed form, steps are projected onto the bounds and only accepted if they decrease
+		    the sum of squared errors. Voxels that have converged are frozen and not evaluated any further.
+		    Iterations run in single precision if meas is stored as single-precision floating point values (see
+		    MEPrecision()): voxels then converge when steps no longer change the parameters or are all rejected.
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,precision)
+	meas = np.array(meas,precision)
+	Nvox = meas.shape[0]
+	s0_max = np.broadcast_to(np.array(s0_max,precision),(Nvox,))
+	txy_max = np.broadcast_to(np.array(txy_max,precision),(Nvox,))
+	s0_vox = np.clip(np.array(s0_init,precision),0.0,s0_max)       # Starting point projected onto the bounds
+	txy_vox = np.clip(np.array(txy_init,precision),0.0,txy_max)
+
+	### Initialise objective function, damping and convergence flags
+	fobj_vox = np.sum( (MEsignalBatch(model,te_values,s0_vox,txy_vox) - meas)**2, axis=1 )
+	lam_vox = 1e-3*np.ones(Nvox,precision)
+	success_vox = np.zeros(Nvox,'bool')
+	nit_vox = np.zeros(Nvox,'int64')
+	active = np.ones(Nvox,'bool')
+
+	### Iterate all voxels that have not converged yet
+	for it in range(0, niter):
+
+		idx = np.where(active)[0]
+		if idx.size==0:
+			break
+		s0_act = s0_vox[idx]
+		txy_act = txy_vox[idx]
+		fobj_act = fobj_vox[idx]
+		lam_act = lam_vox[idx]
+
+		# Gradient and Gauss-Newton approximation of the Hessian
+		res = MEsignalBatch(model,te_values,s0_act,txy_act) - meas[idx,:]
+		jac = MEjacobianBatch(model,te_values,s0_act,txy_act)
+		g0 = np.sum(jac[:,:,0]*res,axis=1)
+		g1 = np.sum(jac[:,:,1]*res,axis=1)
+		h00 = np.sum(jac[:,:,0]*jac[:,:,0],axis=1)
+		h01 = np.sum(jac[:,:,0]*jac[:,:,1],axis=1)
+		h11 = np.sum(jac[:,:,1]*jac[:,:,1],axis=1)
+
+		# Solve the damped 2x2 system in closed form and project the new point onto the bounds
+		with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+			d00 = h00*(1.0 + lam_act)
+			d11 = h11*(1.0 + lam_act)
+			det = d00*d11 - h01*h01
+			step0 = (-1.0)*( d11*g0 - h01*g1 ) / det
+			step1 = (-1.0)*( d00*g1 - h01*g0 ) / det
+		step0[~np.isfinite(step0)] = 0.0
+		step1[~np.isfinite(step1)] = 0.0
+		s0_new = np.clip(s0_act + step0,0.0,s0_max[idx])
+		txy_new = np.clip(txy_act + step1,0.0,txy_max[idx])
+		fobj_new = np.sum( (MEsignalBatch(model,te_values,s0_new,txy_new) - meas[idx,:])**2, axis=1 )
+
+		# Accept steps that decrease the objective function and adapt the damping
+		accept = fobj_new<fobj_act
+		small_step = ( np.abs(s0_new - s0_act)<=xtol*(np.abs(s0_act) + xtol) ) & ( np.abs(txy_new - txy_act)<=xtol*(np.abs(txy_act) + xtol) )
+		converged = ( accept & ((fobj_act - fobj_new)<=ftol*fobj_act) ) | small_step | (lam_act>1e12)
+		s0_vox[idx[accept]] = s0_new[accept]
+		txy_vox[idx[accept]] = txy_new[accept]
+		fobj_vox[idx[accept]] = fobj_new[accept]
+		lam_vox[idx] = np.where(accept,np.maximum(0.1*lam_act,1e-12),10.0*lam_act)
+		nit_vox[idx] = nit_vox[idx] + 1
+
+		# Freeze voxels that have converged
+		success_vox[idx[converged]] = True
+		active[idx[converged]] = False
+
+	### Return output
+	return s0_vox, txy_vox, fobj_vox, success_vox, nit_vox
+
+
+def MEVarProFitBatch(model,mri_te,meas,txy_max=None,ngrid=64,niter=50):
+	''' Variable projection fitting of the signal model on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox = MEVarProFitBatch(model,mri_te,meas,txy_max=None,ngrid=64,niter=50)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+	    - txy_max: upper bound for Txy in ms (default None, i.e. txy_max of the model)
+	    - ngrid: number of log-spaced Txy values used to bracket the minimum (default 64)
+	    - niter: number of golden-section iterations used to refine the bracketed minimum (default 50)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (relaxation time of the model, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel (see MEFobj())
+
+		    The signal model is linear in S0: for a given Txy, the best S0 is SUM(f*m)/SUM(f^2), where
+		    f = f(t,Txy) is the basis function of the model, and the sum of squared errors becomes SUM(m^2) - SUM(f*m)^2/SUM(f^2).
+		    This projected objective depends on Txy only and is minimised over (0, txy_max] for all voxels
+		    simultaneously: the minimum is bracketed on a grid and refined with a golden-section search.
+		    S0 is constrained to be non-negative. Fitting is declared unsuccessful where the minimum lies at
+		    txy_max (no relaxation can be detected) or where S0 is 0.
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,precision)           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x Nmeas array
+	Nvox = meas.shape[0]
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+	allones = np.ones(Nvox,precision)
+	msq = np.sum(meas*meas,axis=1)
+
+	### Bracket the minimum of the projected objective function on a grid of Txy values
+	txy_grid = np.geomspace(1.0,txy_max,num=ngrid,dtype=precision)
+	basis_grid = MEsignalBatch(model,te_values,np.ones(ngrid,precision),txy_grid)           # Signal with S0 = 1 for each grid value
+	proj_grid = np.matmul(meas,basis_grid.T)                                  # SUM(f*m) for each voxel and grid value
+	fobj_grid = msq[:,np.newaxis] - np.maximum(proj_grid,0.0)**2 / np.sum(basis_grid*basis_grid,axis=1)[np.newaxis,:]
+	idx_best = np.argmin(fobj_grid,axis=1)
+	txy_low = txy_grid[np.maximum(idx_best - 1,0)]
+	txy_high = txy_grid[np.minimum(idx_best + 1,ngrid - 1)]
+
+	### Refine the minimum with a golden-section search run on all voxels at once
+	def projected_fobj(txy_vox):
+		basis = MEsignalBatch(model,te_values,allones,txy_vox)
+		return msq - np.maximum(np.sum(basis*meas,axis=1),0.0)**2 / np.sum(basis*basis,axis=1)
+
+	gratio = (np.sqrt(5.0) - 1.0) / 2.0
+	txy_c = txy_high - gratio*(txy_high - txy_low)
+	txy_d = txy_low + gratio*(txy_high - txy_low)
+	fobj_c = projected_fobj(txy_c)
+	fobj_d = projected_fobj(txy_d)
+	for it in range(0, niter):
+		left = fobj_c<fobj_d       # The minimum lies within [txy_low, txy_d]
+		txy_high = np.where(left,txy_d,txy_high)
+		txy_low = np.where(left,txy_low,txy_c)
+		txy_new = np.where(left,txy_high - gratio*(txy_high - txy_low),txy_low + gratio*(txy_high - txy_low))
+		fobj_new = projected_fobj(txy_new)
+		txy_c, txy_d = np.where(left,txy_new,txy_d), np.where(left,txy_c,txy_new)
+		fobj_c, fobj_d = np.where(left,fobj_new,fobj_d), np.where(left,fobj_c,fobj_new)
+	txy_vox = 0.5*(txy_low + txy_high)
+
+	### Keep the grid value where it is better than the refined one (e.g. minimum at the edge of the grid)
+	grid_better = fobj_grid[np.arange(Nvox),idx_best]<projected_fobj(txy_vox)
+	txy_vox[grid_better] = txy_grid[idx_best[grid_better]]
+
+	### Recover S0 analytically and measure the quality of fit
+	basis = MEsignalBatch(model,te_values,allones,txy_vox)
+	s0_vox = np.maximum(np.sum(basis*meas,axis=1),0.0) / np.sum(basis*basis,axis=1)
+	sse_vox = np.sum( (s0_vox[:,np.newaxis]*basis - meas)**2, axis=1 )
+
+	### Check whether the solution is plausible: if not, declare fitting failed
+	exit_vox = np.ones(Nvox,precision)
+	exit_vox[(txy_vox>=(1.0 - 1e-6)*txy_max) | (s0_vox<=0)] = -1.0
+
+	### Return output
+	return s0_vox, txy_vox, exit_vox, sse_vox
+
+
+def MEDictionary(model,mri_te,txy_max=None,ngrid=4096,cache_dir=None):
+	''' Dictionary of normalised signals of a relaxometry model for dictionary matching, optionally cached on disk
+
+	    INTERFACE
+	    txy_dict, atoms_dict, norms_dict = MEDictionary(model,mri_te,txy_max=None,ngrid=4096,cache_dir=None)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - txy_max: largest Txy value in ms of the dictionary (default None, i.e. txy_max of the model)
+	    - ngrid: number of log-spaced Txy values between 1 ms and txy_max (default 4096)
+	    - cache_dir: folder where the dictionary is stored as a .npz file, whose name is derived from the model, the sequence times,
+			 txy_max and ngrid (default None, i.e. no caching). If a dictionary for the same sequence times is
+			 already there it is loaded instead of being computed (e.g. the folder of the text file of sequence times,
+			 so that all studies acquired with the same protocol share the dictionary)
+
+	    RETURNS
+	    - txy_dict:   Txy values of the dictionary (1D array of ngrid elements)
+	    - atoms_dict: 2D numpy array of size ngrid x Nmeas storing the signals with S0 = 1 divided by their norm
+	    - norms_dict: norm of the signals with S0 = 1 (1D array of ngrid elements)
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	te_values = np.array(mri_te,'float64').flatten()     # Make sure sequence times are stored as a numpy array
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+	txy_dict = np.geomspace(1.0,txy_max,num=ngrid)
+
+	### Look for the dictionary in the cache folder first
+	if cache_dir is not None:
+		cache_key = hashlib.sha1(np.concatenate((np.array([txy_max,ngrid],'float64'),te_values)).tobytes()).hexdigest()
+		cache_file = os.path.join(cache_dir,'MEdict_{}_{}.npz'.format(model,cache_key[0:16]))
+		try:
+			with np.load(cache_file) as cache:
+				if np.array_equal(cache['te'],te_values) and np.array_equal(cache['txy'],txy_dict):
+					return cache['txy'], cache['atoms'], cache['norms']
+		except (OSError, KeyError, ValueError):
+			pass      # Dictionary not cached yet (or unreadable): compute it
+
+	### Compute the dictionary
+	atoms_dict = MEsignalBatch(model,te_values,np.ones(ngrid),txy_dict)        # Signal with S0 = 1 for each Txy value
+	norms_dict = np.sqrt(np.sum(atoms_dict*atoms_dict,axis=1))
+	atoms_dict = atoms_dict / norms_dict[:,np.newaxis]
+
+	### Store the dictionary in the cache folder, writing to a temporary file first so that the cache is never left half-written
+	if cache_dir is not None:
+		try:
+			with open(cache_file + '.tmp','wb') as fcache:
+				np.savez(fcache,te=te_values,txy=txy_dict,atoms=atoms_dict,norms=norms_dict)
+			os.replace(cache_file + '.tmp',cache_file)
+		except OSError:
+			print('')
+			print('WARNING: the dictionary could not be cached in {}. Continuing without cache...'.format(cache_dir))
+			print('')
+
+	### Return output
+	return txy_dict, atoms_dict, norms_dict
+
+
+def MEDictFitBatch(model,mri_te,meas,txy_max=None,ngrid=4096,npolish=0,cache_dir=None,nchunk=4096):
+	''' Dictionary matching fitting of the signal model on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox = MEDictFitBatch(model,mri_te,meas,txy_max=None,ngrid=4096,npolish=0,cache_dir=None,nchunk=4096)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per sequence time)
+	    - txy_max: largest Txy value in ms of the dictionary (default None, i.e. txy_max of the model)
+	    - ngrid: number of entries of the dictionary (default 4096; see MEDictionary())
+	    - npolish: number of Gauss-Newton (Levenberg-Marquardt) iterations used to polish the matched parameters
+		       (default 0, i.e. dictionary matching only; see MELMFitBatch())
+	    - cache_dir: folder where the dictionary is cached (default None, i.e. no caching; see MEDictionary())
+	    - nchunk: number of voxels matched in one matrix product (default 4096; it limits memory usage)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (relaxation time of the model, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel (see MEFobj())
+
+		    Each voxel is matched to the dictionary entry with the largest projection SUM(a*m), where a are
+		    the normalised signals of the dictionary: this is the entry minimising the sum of squared errors
+		    once S0 = SUM(a*m)/||f|| is computed in closed form (as in MEVarProFitBatch()). The polishing
+		    iterations keep S0 within [0, k*S0] of the matched S0 (k = s0_bound of the model) and Txy within [0, txy_max], and are
+		    accepted only where they decrease the objective function. Fitting is declared unsuccessful where
+		    the match lies at txy_max or where S0 is 0.
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,'float64')           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x Nmeas array
+	Nvox = meas.shape[0]
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+
+	### Get the dictionary (cached in double precision, and used in the precision of the measurements)
+	txy_dict, atoms_dict, norms_dict = MEDictionary(model,te_values,txy_max,ngrid,cache_dir)
+	txy_dict = np.array(txy_dict,precision)
+	atoms_dict = np.array(atoms_dict,precision)
+	norms_dict = np.array(norms_dict,precision)
+
+	### Match all voxels to the dictionary with one matrix product per chunk of voxels
+	s0_vox = np.zeros(Nvox,precision)
+	txy_vox = np.zeros(Nvox,precision)
+	for vstart in range(0, Nvox, nchunk):
+		vend = min(vstart + nchunk,Nvox)
+		proj = np.matmul(meas[vstart:vend,:],atoms_dict.T)       # SUM(a*m) for each voxel and dictionary entry
+		idx_best = np.argmax(proj,axis=1)
+		s0_vox[vstart:vend] = np.maximum(proj[np.arange(vend - vstart),idx_best],0.0) / norms_dict[idx_best]
+		txy_vox[vstart:vend] = txy_dict[idx_best]
+	sse_vox = np.sum( (MEsignalBatch(model,te_values,s0_vox,txy_vox) - meas)**2, axis=1 )
+
+	### Check whether the solution is plausible: if not, declare fitting failed
+	exit_vox = np.ones(Nvox,precision)
+	exit_vox[(txy_vox>=(1.0 - 1e-6)*txy_max) | (s0_vox<=0)] = -1.0
+
+	### Polish the matched parameters where required, keeping the match unless the objective function decreases
+	if npolish>0:
+		s0_fit, txy_fit, fobj_fit, fit_exit, nit_fit = MELMFitBatch(model,te_values,meas,s0_vox,txy_vox,MODELS[model]['s0_bound']*s0_vox,txy_max,niter=npolish)
+		fit_ok = (exit_vox==1) & (fobj_fit<sse_vox)
+		s0_vox = np.where(fit_ok,s0_fit,s0_vox)
+		txy_vox = np.where(fit_ok,txy_fit,txy_vox)
+		sse_vox = np.where(fit_ok,fobj_fit,sse_vox)
+
+	### Return output
+	return s0_vox, txy_vox, exit_vox, sse_vox
+
+
+def MEEchoSpacing(mri_te):
+	''' Echo spacing (ms) of a multi-echo spin-echo train with TEs = esp, 2*esp, 3*esp, ..., or None if the TEs are not spaced so '''
+	te_values = np.array(mri_te,'float64').flatten()
+	esp = te_values[0]
+	if esp<=0 or not np.allclose(te_values,esp*np.arange(1,te_values.size + 1),rtol=1e-3,atol=0.0):
+		return None
+	return esp
+
+
+def MEDictionaryEPG(model,mri_te,txy_max=None,ngrid=400,b1_range=(0.5,1.2),nb1=36,t1=1000.0,cache_dir=None):
+	''' Dictionary of multi-echo spin-echo trains simulated with the extended phase graph formalism, cached on disk
+
+	    INTERFACE
+	    txy_dict, b1_dict, atoms_dict, norms_dict = MEDictionaryEPG(model,mri_te,txy_max=None,ngrid=400,b1_range=(0.5,1.2),nb1=36,t1=1000.0,cache_dir=None)
+
+	    PARAMETERS
+	    - model: name of the signal model (a model registered with epg=True; see RegisterModel())
+	    - mri_te: list/array of echo times (ms), equal to esp, 2*esp, 3*esp, ... (see MEEchoSpacing())
+	    - txy_max: largest Txy (T2) value in ms of the dictionary (default None, i.e. txy_max of the model)
+	    - ngrid: number of log-spaced Txy values between 1 ms and txy_max (default 400)
+	    - b1_range, nb1: range and number of linearly spaced refocusing factors (default: 36 values from 0.5 to 1.2)
+	    - t1: T1 (ms) of the simulation (default 1000; see EPGEchoTrain())
+	    - cache_dir: folder where the dictionary is cached (default None, i.e. no caching). Dictionaries are cached per
+			 echo spacing and number of echoes (and per grid of the dictionary), as done in MEDictionary()
+
+	    RETURNS
+	    - txy_dict, b1_dict: Txy and refocusing factor of each entry of the dictionary (1D arrays of ngrid x nb1 elements)
+	    - atoms_dict: signals of the dictionary with S0 = 1, normalised to unit norm (2D array of size ngrid*nb1 x Nmeas)
+	    - norms_dict: norm of the signals with S0 = 1 (1D array of ngrid x nb1 elements)
+
+	    Dependencies (Python packages): numpy'''
+
+	### Handle inputs
+	te_values = np.array(mri_te,'float64').flatten()     # Make sure sequence times are stored as a numpy array
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+	esp = MEEchoSpacing(te_values)
+	txy_dict, b1_dict = np.meshgrid(np.geomspace(1.0,txy_max,num=ngrid),np.linspace(b1_range[0],b1_range[1],num=nb1),indexing='ij')
+	txy_dict = txy_dict.flatten()
+	b1_dict = b1_dict.flatten()
+
+	### Look for the dictionary in the cache folder first
+	if cache_dir is not None:
+		cache_key = hashlib.sha1(np.array([esp,te_values.size,txy_max,ngrid,b1_range[0],b1_range[1],nb1,t1],'float64').tobytes()).hexdigest()
+		cache_file = os.path.join(cache_dir,'MEdictEPG_{}_{}.npz'.format(model,cache_key[0:16]))
+		try:
+			with np.load(cache_file) as cache:
+				if np.array_equal(cache['te'],te_values) and np.array_equal(cache['txy'],txy_dict) and np.array_equal(cache['b1'],b1_dict):
+					return cache['txy'], cache['b1'], cache['atoms'], cache['norms']
+		except (OSError, KeyError, ValueError):
+			pass      # Dictionary not cached yet (or unreadable): compute it
+
+	### Compute the dictionary
+	atoms_dict = EPGEchoTrain(esp,te_values.size,txy_dict,b1_dict,t1)          # Echo train with S0 = 1 for each entry
+	norms_dict = np.sqrt(np.sum(atoms_dict*atoms_dict,axis=1))
+	atoms_dict = atoms_dict / norms_dict[:,np.newaxis]
+
+	### Store the dictionary in the cache folder, writing to a temporary file first so that the cache is never left half-written
+	if cache_dir is not None:
+		try:
+			with open(cache_file + '.tmp','wb') as fcache:
+				np.savez(fcache,te=te_values,txy=txy_dict,b1=b1_dict,atoms=atoms_dict,norms=norms_dict)
+			os.replace(cache_file + '.tmp',cache_file)
+		except OSError:
+			print('')
+			print('WARNING: the dictionary could not be cached in {}. Continuing without cache...'.format(cache_dir))
+			print('')
+
+	### Return output
+	return txy_dict, b1_dict, atoms_dict, norms_dict
+
+
+def MEEPGFitBatch(model,mri_te,meas,txy_max=None,cache_dir=None,nchunk=4096):
+	''' Extended phase graph dictionary fitting of multi-echo spin-echo trains on many voxels at once
+
+	    INTERFACE
+	    s0_vox, txy_vox, exit_vox, sse_vox, b1_vox = MEEPGFitBatch(model,mri_te,meas,txy_max=None,cache_dir=None,nchunk=4096)
+
+	    PARAMETERS
+	    - model: name of the signal model (a model registered with epg=True; see RegisterModel())
+	    - mri_te: list/array of echo times (ms), equal to esp, 2*esp, 3*esp, ... (see MEEchoSpacing())
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas (one row per voxel, one column per echo)
+	    - txy_max: largest Txy value in ms of the dictionary (default None, i.e. txy_max of the model)
+	    - cache_dir: folder where the dictionary is cached (default None, i.e. no caching; see MEDictionaryEPG())
+	    - nchunk: number of voxels matched in one matrix product (default 4096; it limits memory usage)
+
+	    RETURNS
+	    - s0_vox:   S0 (T1-weighted proton density) for each voxel (1D array of Nvox elements)
+	    - txy_vox:  Txy (T2, in ms) for each voxel
+	    - exit_vox: exit code for each voxel (1: successful fitting; -1: unsuccessful fitting)
+	    - sse_vox:  fitting sum of squared errors for each voxel
+	    - b1_vox:   refocusing factor (actual/nominal refocusing flip angle) for each voxel
+
+		    As in MEDictFitBatch(), each voxel is matched to the dictionary entry with the largest projection SUM(a*m)
+		    with one matrix product per chunk of voxels, and S0 is computed in closed form. The entries are echo trains
+		    simulated for pairs of T2 and refocusing factor (see MEDictionaryEPG()), so that the stimulated echoes
+		    caused by imperfect refocusing do not bias T2. Fitting is declared unsuccessful where the match lies at
+		    txy_max or where S0 is 0.
+
+	    Dependencies (Python packages): numpy
+
+	    References: Lebel RM and Wilman AH, Magn Reson Med 2010, 64:1005-1014'''
+
+	### Handle inputs
+	precision = MEPrecision(meas)
+	te_values = np.array(mri_te,'float64')           # Make sure sequence times are stored as a numpy array
+	meas = np.array(meas,precision)                  # Measurements as a Nvox x Nmeas array
+	Nvox = meas.shape[0]
+	if txy_max is None:
+		txy_max = MODELS[model]['txy_max']
+
+	### Get the dictionary (cached in double precision, and used in the precision of the measurements)
+	txy_dict, b1_dict, atoms_dict, norms_dict = MEDictionaryEPG(model,te_values,txy_max,cache_dir=cache_dir)
+	txy_dict = np.array(txy_dict,precision)
+	b1_dict = np.array(b1_dict,precision)
+	atoms_dict = np.array(atoms_dict,precision)
+	norms_dict = np.array(norms_dict,precision)
+
+	### Match all voxels to the dictionary with one matrix product per chunk of voxels
+	s0_vox = np.zeros(Nvox,precision)
+	txy_vox = np.zeros(Nvox,precision)
+	b1_vox = np.zeros(Nvox,precision)
+	sse_vox = np.zeros(Nvox,precision)
+	for vstart in range(0, Nvox, nchunk):
+		vend = min(vstart + nchunk,Nvox)
+		proj = np.matmul(meas[vstart:vend,:],atoms_dict.T)       # SUM(a*m) for each voxel and dictionary entry
+		idx_best = np.argmax(proj,axis=1)
+		proj_best = np.maximum(proj[np.arange(vend - vstart),idx_best],0.0)
+		s0_vox[vstart:vend] = proj_best / norms_dict[idx_best]
+		txy_vox[vstart:vend] = txy_dict[idx_best]
+		b1_vox[vstart:vend] = b1_dict[idx_best]
+		sse_vox[vstart:vend] = np.sum( (proj_best[:,np.newaxis]*atoms_dict[idx_best,:] - meas[vstart:vend,:])**2, axis=1 )
+
+	### Check whether the solution is plausible: if not, declare fitting failed
+	exit_vox = np.ones(Nvox,precision)
+	exit_vox[(txy_vox>=(1.0 - 1e-6)*txy_max) | (s0_vox<=0)] = -1.0
+
+	### Return output
+	return s0_vox, txy_vox, exit_vox, sse_vox, b1_vox
+
+
+def MEWarmStart(model,mri_te,sig_data,mask_data,block=2):
+	''' Low-resolution fitting of the signal model, used to warm-start the optimisation of neighbouring voxels
+
+	    INTERFACE
+	    txy_warm = MEWarmStart(model,mri_te,sig_data,mask_data,block=2)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - mri_te: list/array indicating the sequence times (TEs or TRs, in ms) used for the experiment (one measurement per time)
+	    - sig_data: 4D numpy array storing the measurements (last dimension: one measurement per sequence time)
+	    - mask_data: 3D numpy array storing the fitting mask (1 where the model is fitted, 0 otherwise)
+	    - block: in-plane size of the blocks of voxels averaged into one low-resolution voxel (default 2)
+
+	    RETURNS
+	    - txy_warm: Txy (ms) of the low-resolution voxel containing each voxel within the fitting mask (1D array,
+			voxels ordered as in numpy.where(mask_data==1))
+
+		    The signals of the voxels within the fitting mask are averaged within blocks of block x block voxels
+		    of each slice, and the averaged signals are fitted with variable projection (see MEVarProFitBatch()).
+		    Averaging raises the signal-to-noise ratio, so that the low-resolution Txy is a starting point close
+		    to the minimum of most voxels of the block, and is obtained fitting one voxel out of block x block.
+
+	    Dependencies (Python packages): numpy'''
+
+	### Assign each voxel within the fitting mask to its block
+	vox_idx = np.where(mask_data==1)
+	Nmeas = sig_data.shape[3]
+	blocksize = ( (sig_data.shape[0] - 1)//block + 1, (sig_data.shape[1] - 1)//block + 1, sig_data.shape[2] )
+	block_id = np.ravel_multi_index((vox_idx[0]//block,vox_idx[1]//block,vox_idx[2]),blocksize)
+	block_list, block_vox = np.unique(block_id,return_inverse=True)
+	block_vox = block_vox.ravel()
+
+	### Average the signals within each block
+	sig_vox = sig_data[vox_idx]
+	block_nvox = np.bincount(block_vox,minlength=block_list.size)
+	sig_block = np.zeros((block_list.size,Nmeas),'float64')
+	for mm in range(0, Nmeas):
+		sig_block[:,mm] = np.bincount(block_vox,weights=sig_vox[:,mm],minlength=block_list.size) / block_nvox
+
+	### Fit the low-resolution signals and assign the low-resolution Txy to each voxel of the block
+	s0_block, txy_block, exit_block, sse_block = MEVarProFitBatch(model,mri_te,sig_block)
+	txy_warm = np.array(txy_block[block_vox],MEPrecision(sig_data))
+
+	### Return output
+	return txy_warm
+
+
+def TxyFitMEvoxels(model,data):
+	''' Fit Txy on a chunk of voxels stored as a 2D numpy array (one row per voxel)
+
+	    INTERFACE
+	    data_out = TxyFitMEvoxels(model,data)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - data: a list of 4 to 10 elements, such that
+	            data[0] is a 2D numpy array of size Nvox x Nmeas containing the signals to fit (one row per voxel,
+			    one column per sequence time)
+		    data[1] is a numpy monodimensional array storing the sequence times (ms)
+		    data[2] is a string describing the fitting algorithm ("linear", "nonlinear", "lm", "varpro", "dict", "epg" or "arlo", see TxyFitME())
+		    data[3] is a scalar containing the position of the first voxel of the chunk among all voxels to fit
+		    data[4] (optional) is the number of coarse-to-fine refinement levels of the grid search run where
+		            linear fitting fails (see MEGridSearchBatch(); default 0)
+		    data[5] (optional) is the number of iterations polishing the output of "dict" (see MEDictFitBatch(); default 0)
+		    data[6] (optional) is the folder where the dictionary of "dict" and "epg" is cached (see MEDictionary(); default None)
+		    data[7] (optional) is True to fit two measurements, linear fitting (also the starting point of "nonlinear" and
+		            "lm") and the iterations of "lm" with the Numba-compiled kernels of relaxkernels; "nonlinear" is still
+		            refined with L-BFGS-B (default False; ignored if Numba is not installed or the model has no kernel)
+		    data[8] (optional) is an array of Nvox elements storing the Txy (ms) used to warm-start "nonlinear" and "lm"
+		            where it fits better than linear fitting or the grid search (see MEWarmStart(); default None)
+		    data[9] (optional) is the coefficient of determination R2 of linear fitting from which "nonlinear" and "lm"
+			    keep the output of linear fitting instead of refining it (see TxyFitME(); default None, i.e. no voxel skipped)
+
+	    RETURNS
+	    - data_out: a list of 13 elements, such that
+		    data_out[0] is the parameter S0 (see TxyFitME()) of each voxel (1D array of Nvox elements)
+	            data_out[1] is the parameter Txy (see TxyFitME()) of each voxel
+                    data_out[2] is the exit code of the fitting (see TxyFitME()) of each voxel
+		    data_out[3] is the fitting sum of squared errors of each voxel
+                    data_out[4] equals data[3]
+		    data_out[5] is the process identification (PID) of the process that fitted the chunk
+		    data_out[6] is the time (in s) spent fitting the chunk
+		    data_out[7] is the total number of iterations of the optimisation of "nonlinear" and "lm" (0 otherwise)
+		    data_out[8] and data_out[9] are the numbers of voxels where the grid search was run and whose optimisation
+			    was initialised with the warm start
+		    data_out[10] is the refocusing factor of each voxel with "epg" (see MEEPGFitBatch()), None otherwise
+		    data_out[11] is the number of voxels where the refinement of "nonlinear" and "lm" was skipped as linear
+			    fitting passed the quality gate data[9], and data_out[12] is the time (in s) spent refining the others
+
+		    Fitted parameters in data_out will be stored as double-precision floating point (FLOAT64), or as
+		    single-precision floating point (FLOAT32) if data[0] is (see MEPrecision())
+
+	    Dependencies (Python packages): numpy, scipy'''
+
+	### Extract signals and sequence information from the input list
+	time_start = time.time()
+	precision = MEPrecision(data[0])          # Precision of signals and fitted parameters
+	sig_vox = np.array(data[0],precision)     # Signals as a Nvox x Nmeas array
+	te_value = np.array(data[1])              # Make sure the sequence times are an array
+	fit_algo = data[2]                        # fitting algorithm
+	idx_chunk = data[3]                       # Position of the chunk
+	spec = MODELS[model]                      # Signal model
+	grid_refine = 0
+	dict_polish = 0
+	dict_cache = None
+	if len(data)>4:
+		grid_refine = data[4]             # Refinement levels of the grid search
+	if len(data)>5:
+		dict_polish = data[5]             # Polishing iterations of dictionary matching
+	if len(data)>6:
+		dict_cache = data[6]              # Cache folder of dictionary matching
+	use_kernels = False
+	if len(data)>7:
+		use_kernels = data[7] and relaxkernels.NUMBA_AVAILABLE and spec['kernel'] is not None   # Compiled kernels
+	txy_warm = None
+	if len(data)>8 and data[8] is not None:
+		txy_warm = np.array(data[8],precision)    # Warm start of "nonlinear" and "lm"
+	linear_gate = None
+	if len(data)>9:
+		linear_gate = data[9]             # Quality gate of linear fitting
+
+	### Check whether a sensible algorithm has been requested
+	if fit_algo!="linear" and fit_algo!="nonlinear" and fit_algo!="lm" and fit_algo!="varpro" and fit_algo!="dict" and fit_algo!="epg" and fit_algo!="arlo":
+		print('')
+		print('ERROR: unrecognised fitting algorithm. Exiting with 1.')
+		print('')
+		sys.exit(1)
+
+	### Allocate output variables
+	Nvox = sig_vox.shape[0]    # Number of voxels
+	Nmeas = sig_vox.shape[1]   # Number of measurements
+	s0_vox = np.zeros(Nvox,precision)
+	txy_vox = np.zeros(Nvox,precision)
+	exit_vox = np.zeros(Nvox,precision)
+	mse_vox = np.zeros(Nvox,precision)
+	nit_vox = np.zeros(Nvox,'int64')   # Iterations of the optimisation of "nonlinear" and "lm"
+	ngrid = 0                          # Voxels where the grid search is run
+	b1_vox = None                      # Refocusing factor of "epg"
+	nwarm = 0                          # Voxels initialised with the warm start
+	nskip = 0                          # Voxels whose linear fitting passes the quality gate, not refined
+	time_refine = 0.0                  # Time spent refining linear fitting with "nonlinear" and "lm"
+
+	## Simplest case: there are only two measurements --> get the solution analytically, in a compiled loop if required
+	if(Nmeas==2) and use_kernels:
+		relaxkernels.KernelTwoPoint(spec['kernel'],np.array(te_value,'float64'),sig_vox,spec['txy_max'],s0_vox,txy_vox,exit_vox,mse_vox)
+
+	## Simplest case: there are only two measurements --> get the solution analytically, on all voxels at once
+	elif(Nmeas==2):
+		s0_vox, txy_vox, exit_vox, mse_vox = METwoPointBatch(model,te_value,sig_vox,spec['txy_max'])
+
+	## Auto-regression on linear operations: Txy is calculated in closed form from echo integrals, on all voxels at once
+	elif fit_algo=="arlo":
+		s0_vox, txy_vox, exit_vox, mse_vox = MEARLOFitBatch(model,te_value,sig_vox,spec['txy_max'])
+
+	## Variable projection: S0 is eliminated analytically and only Txy is searched, on all voxels at once
+	elif fit_algo=="varpro":
+		s0_vox, txy_vox, exit_vox, mse_vox = MEVarProFitBatch(model,te_value,sig_vox,spec['txy_max'])
+
+	## Dictionary matching: all voxels are matched to a dictionary of signals at once
+	elif fit_algo=="dict":
+		s0_vox, txy_vox, exit_vox, mse_vox = MEDictFitBatch(model,te_value,sig_vox,spec['txy_max'],npolish=dict_polish,cache_dir=dict_cache)
+
+	## Extended phase graph dictionary matching: all voxels are matched to a dictionary of spin-echo trains at once
+	elif fit_algo=="epg":
+		s0_vox, txy_vox, exit_vox, mse_vox, b1_vox = MEEPGFitBatch(model,te_value,sig_vox,spec['txy_max'],cache_dir=dict_cache)
+
+	## General case: there are more than two measurements --> get the solution minimising an objective function
+	else:
+
+		# Perform linear fitting on all voxels at once as first thing - if non-linear fitting is required, the linear fitting will be used to initialise the non-linear optimisation afterwards
+		if use_kernels:
+			relaxkernels.KernelLinearFit(spec['kernel'],np.array(te_value,'float64'),sig_vox,spec['txy_max'],s0_vox,txy_vox,exit_vox,mse_vox)
+		else:
+			s0_vox, txy_vox, exit_vox, mse_vox = spec['init'](model,te_value,sig_vox)
+
+		# Quality gate: where linear fitting succeeded and explains the signal with R2 of at least linear_gate, its output is kept and not refined
+		if fit_algo=="nonlinear" or fit_algo=="lm":
+			time_refine = time.time()
+			refine_vox = np.ones(Nvox,dtype=bool)
+			if linear_gate is not None:
+				with np.errstate(divide='ignore',invalid='ignore'):
+					sst_vox = np.sum( (sig_vox - np.mean(sig_vox,axis=1)[:,np.newaxis])**2, axis=1 )     # Total sum of squares
+					r2_vox = 1.0 - mse_vox/sst_vox
+				refine_vox = ~( (exit_vox==1) & (r2_vox>=linear_gate) )                                # Refined where R2 is not finite
+				nskip = Nvox - int(np.sum(refine_vox))
+			fit_idx = np.where(refine_vox)[0]
+
+		# Starting point of the optimisation of "nonlinear" and "lm": linear fitting output or, where linear fitting has failed, a grid search.
+		# With a warm start, the low-resolution Txy of the neighbourhood of the voxel (see MEWarmStart()) is used instead wherever it fits the voxel better
+		if fit_algo=="nonlinear" or fit_algo=="lm":
+			s0_init = np.copy(s0_vox)
+			txy_init = np.copy(txy_vox)
+			fobj_init = np.copy(mse_vox)
+			grid_idx = np.where(exit_vox==-1)[0]
+			s0_init[grid_idx], txy_init[grid_idx], fobj_init[grid_idx] = MEGridSearchBatch(model,te_value,sig_vox[grid_idx,:],nrefine=grid_refine)
+			ngrid = grid_idx.size
+			if txy_warm is not None:
+				basis_warm = MEsignalBatch(model,te_value,np.ones(Nvox,precision),txy_warm)             # S0 = 1 at the low-resolution Txy
+				with np.errstate(divide='ignore',invalid='ignore'):
+					s0_warm = np.maximum(np.sum(basis_warm*sig_vox,axis=1),0.0) / np.sum(basis_warm*basis_warm,axis=1)   # Best S0 for that Txy
+				fobj_warm = np.sum( (s0_warm[:,np.newaxis]*basis_warm - sig_vox)**2, axis=1 )
+				warm_vox = (fobj_warm<fobj_init) & refine_vox                                         # False where fobj_warm is not finite
+				s0_init[warm_vox] = s0_warm[warm_vox]
+				txy_init[warm_vox] = txy_warm[warm_vox]
+				fobj_init[warm_vox] = fobj_warm[warm_vox]
+				nwarm = int(np.sum(warm_vox))
+
+		# Refine the starting point with non-linear optimisation if the selected algorithm is "nonlinear"
+		if fit_algo=="nonlinear":
+
+			# Minimise the objective function voxel by voxel with L-BFGS-B (also with the compiled kernels, which have no L-BFGS-B)
+			fobj_grad = functools.partial(MEFobjGrad,model)       # Objective function and gradient of the model
+
+			for vv in fit_idx:
+
+				sig_voxel = sig_vox[vv,:]       # Extract signals for current voxel
+				s0_voxel = s0_vox[vv]           # Output of linear fitting
+				param_init = [s0_init[vv],txy_init[vv]]   # Starting point of the non-linear optimisation
+				fobj_init_voxel = fobj_init[vv]
+			
+				# Minimise the objective function numerically, providing the analytic gradient to the optimiser
+				param_bound = ((0,spec['s0_bound']*s0_voxel),(0,spec['txy_max']),)          # Range for S0 and Txy of the model
+				modelfit = minimize(fobj_grad, param_init, method='L-BFGS-B', jac=True, args=tuple([te_value,sig_voxel]), bounds=param_bound)   # Analytic gradient (see MEFobjGrad())
+				fit_exit = modelfit.success
+				fobj_fit = modelfit.fun
+				nit_vox[vv] = modelfit.nit
+
+				# Get fitting output if non-linear optimisation was successful and if succeeded in providing a smaller value of the objective function as compared to the starting point
+				if fit_exit==True and fobj_fit<fobj_init_voxel:
+					param_fit = modelfit.x
+					s0_voxel = param_fit[0]
+					txy_voxel = param_fit[1]
+					exit_voxel = 1
+					mse_voxel = fobj_fit
+
+				# Otherwise, output the starting point, i.e. the best we could find with linear fitting, the warm start or the grid search (note that grid search cannot fail by implementation)
+				else:
+					s0_voxel = param_init[0]
+					txy_voxel = param_init[1]
+					exit_voxel = -1
+					mse_voxel = fobj_init_voxel
+
+				# Store fitting results for current voxel
+				s0_vox[vv] = s0_voxel
+				txy_vox[vv] = txy_voxel
+				exit_vox[vv] = exit_voxel
+				mse_vox[vv] = mse_voxel
+
+		# Refine the starting point with a Levenberg-Marquardt optimisation run on all voxels at once if the selected algorithm is "lm"
+		elif fit_algo=="lm":
+
+			# Minimise the objective function of the voxels to refine voxel by voxel in a compiled loop if required, with the same iterations as MELMFitBatch()
+			if use_kernels:
+				s0_max = spec['s0_bound']*s0_vox[fit_idx]               # Same range for S0 and Txy as L-BFGS-B
+				s0_fit = s0_vox[fit_idx]
+				txy_fit = txy_vox[fit_idx]
+				exit_fit = exit_vox[fit_idx]
+				mse_fit = mse_vox[fit_idx]
+				nit_fit = nit_vox[fit_idx]
+				relaxkernels.KernelLMFit(spec['kernel'],np.array(te_value,'float64'),sig_vox[fit_idx,:],s0_init[fit_idx],txy_init[fit_idx],fobj_init[fit_idx],s0_max,spec['txy_max'],s0_fit,txy_fit,exit_fit,mse_fit,nit_fit,100,1e-12,1e-10)
+				s0_vox[fit_idx] = s0_fit
+				txy_vox[fit_idx] = txy_fit
+				exit_vox[fit_idx] = exit_fit
+				mse_vox[fit_idx] = mse_fit
+				nit_vox[fit_idx] = nit_fit
+
+			# Otherwise, minimise the objective function numerically within the same range used by L-BFGS-B for S0 and Txy
+			elif fit_idx.size>0:
+				s0_fit, txy_fit, fobj_fit, fit_exit, nit_vox[fit_idx] = MELMFitBatch(model,te_value,sig_vox[fit_idx,:],s0_init[fit_idx],txy_init[fit_idx],spec['s0_bound']*s0_vox[fit_idx],spec['txy_max'])
+
+				# Keep the optimisation output where it converged to a smaller value of the objective function; otherwise, output the starting point
+				fit_ok = fit_exit & (fobj_fit<fobj_init[fit_idx])
+				s0_vox[fit_idx] = np.where(fit_ok,s0_fit,s0_init[fit_idx])
+				txy_vox[fit_idx] = np.where(fit_ok,txy_fit,txy_init[fit_idx])
+				exit_vox[fit_idx] = np.where(fit_ok,1.0,-1.0)
+				mse_vox[fit_idx] = np.where(fit_ok,fobj_fit,fobj_init[fit_idx])
+
+		if fit_algo=="nonlinear" or fit_algo=="lm":
+			time_refine = time.time() - time_refine
+
+	### Create output list storing the fitted parameters and the iterations of the optimisation, and then return
+	data_out = [s0_vox, txy_vox, exit_vox, mse_vox, idx_chunk, os.getpid(), time.time() - time_start, int(np.sum(nit_vox)), ngrid, nwarm, b1_vox, nskip, time_refine]
+	return data_out
+
+
+def TxyFitMEshared(model,data):
+	''' Fit Txy on a chunk of voxels stored in shared memory, writing the fitting output in place
+
+	    INTERFACE
+	    data_out = TxyFitMEshared(model,data)
+
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - data: a list of 13 to 15 elements, such that
+	            data[0] is the name of the shared memory block storing the signals of all voxels to fit as a
+			    Nvox x Nmeas array of floating point values (one row per voxel)
+		    data[1] is the name of the shared memory block storing the fitting output of all voxels as a 4 x Nvox array
+			    of floating point values (S0, Txy, exit code and sum of squared errors), or as a 5 x Nvox array with
+			    "epg" (refocusing factor in the fifth row)
+		    data[2] is Nvox
+		    data[3] is Nmeas
+		    data[4] and data[5] are the positions of the first and one past the last voxel of the chunk
+		    data[6] to data[10] are the sequence times (ms), the fitting algorithm, the grid search refinement levels,
+			    the polishing iterations and the cache folder of "dict" (see TxyFitMEvoxels())
+		    data[11] is the precision of the floating point values of both blocks ("float64" or "float32")
+		    data[12] is True to fit with the Numba-compiled kernels of relaxkernels (see TxyFitMEvoxels())
+		    data[13] (optional) is the Txy used to warm-start the voxels of the chunk (see TxyFitMEvoxels(); default None)
+		    data[14] (optional) is the quality gate of linear fitting (see TxyFitMEvoxels(); default None)
+
+	    RETURNS
+	    - data_out: a list of 13 elements formatted as the output of TxyFitMEvoxels(), where data_out[0] to data_out[3]
+			and data_out[10] are None as the fitting output has been written to the shared memory block data[1]
+
+	    Dependencies (Python packages): numpy, scipy'''
+
+	### Attach to the shared memory blocks
+	shm_sig = multiprocessing.shared_memory.SharedMemory(name=data[0])
+	shm_out = multiprocessing.shared_memory.SharedMemory(name=data[1])
+	sig_vox = np.ndarray((data[2],data[3]),data[11],buffer=shm_sig.buf)
+	nout = 5 if data[7]=="epg" else 4     # Rows of the fitting output
+	out_vox = np.ndarray((nout,data[2]),data[11],buffer=shm_out.buf)
+	vstart = data[4]
+	vend = data[5]
+
+	### Fit the chunk of voxels and write the output in place
+	txy_warm = None
+	if len(data)>13:
+		txy_warm = data[13]
+	linear_gate = None
+	if len(data)>14:
+		linear_gate = data[14]
+	fitchunk = TxyFitMEvoxels(model,[sig_vox[vstart:vend,:],data[6],data[7],vstart,data[8],data[9],data[10],data[12],txy_warm,linear_gate])
+	for pp in range(0, 4):
+		out_vox[pp,vstart:vend] = fitchunk[pp]
+	if nout==5:
+		out_vox[4,vstart:vend] = fitchunk[10]
+
+	### Detach from the shared memory blocks
+	del sig_vox, out_vox
+	shm_sig.close()
+	shm_out.close()
+
+	### Create output list and then return
+	data_out = [None, None, None, None, vstart] + fitchunk[5:10] + [None] + fitchunk[11:13]
+	return data_out
+
+
+def TxyFitMEslice(model,data):
+	''' Fit Txy on one MRI slice stored as a 2D numpy array  
+	    
+	    INTERFACE
+	    data_out = TxyFitMEslice(model,data)
+	     
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - data: a list of 5 to 7 elements, such that
+	            data[0] is a 3D numpy array contaning the data to fit. The first and second dimensions of data[0]
+		            are the slice first and second dimensions, whereas the third dimension of data[0] stores
+                            measurements obtained with different flip angles
+		    data[1] is a numpy monodimensional array storing the sequence times (ms) 
+		    data[2] is a string describing the fitting algorithm ("linear", "nonlinear", "lm", "varpro", "dict", "epg" or "arlo", see TxyFitME())
+		    data[3] is a 2D numpy array contaning the fitting mask within the MRI slice (see TxyFitME())
+		    data[4] is a scalar containing the index of the MRI slice in the 3D volume
+		    data[5] (optional) is the number of coarse-to-fine refinement levels of the grid search run where
+		            linear fitting fails (see MEGridSearchBatch(); default 0)
+		    data[6] (optional) is True to fit with the Numba-compiled kernels of relaxkernels (see TxyFitMEvoxels();
+		            default False)
+	    
+	    RETURNS
+	    - data_out: a list of 4 elements, such that
+		    data_out[0] is the parameter S0 (see TxyFitME()) within the MRI slice
+	            data_out[1] is the parameter Txy (see TxyFitME()) within the MRI slice
+                    data_out[2] is the exit code of the fitting (see TxyFitME()) within the MRI slice
+		    data_out[3] is the fitting sum of squared errors withint the MRI slice
+                    data_out[4] equals data[4]
+	
+		    Fitted parameters in data_out will be stored as double-precision floating point (FLOAT64)
+	    
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group
+	     
+	    Author: Francesco Grussu, University College London
+		    CDSQuaMRI Project 
+		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>'''
+
+	
+	### Extract signals and sequence information from the input list
+	signal_slice = data[0]      # Signal
+	te_value = data[1]          # Sequence times (in ms)
+	fit_algo = data[2]          # fitting algorithm
+	mask_slice = data[3]        # fitting mask
+	idx_slice = data[4]         # Slice index
+	if len(data)>5:
+		grid_refine = data[5]   # Refinement levels of the grid search
+	else:
+		grid_refine = 0
+	if len(data)>6:
+		use_kernels = data[6]   # Compiled kernels
+	else:
+		use_kernels = False
+	slicesize = signal_slice.shape    # Get number of voxels of current MRI slice along each dimension
+	te_value = np.array(te_value)     # Make sure the sequence times are an array
+	
+	### Allocate output variables
+	s0_slice = np.zeros(slicesize[0:2],'float64')
+	txy_slice = np.zeros(slicesize[0:2],'float64')
+	exit_slice = np.zeros(slicesize[0:2],'float64')      # Background voxels keep exit code 0
+	mse_slice = np.zeros(slicesize[0:2],'float64')
+
+	### Fit the voxels within the fitting mask as one chunk and scatter fitting results back into the MRI slice
+	vox_idx = np.where(mask_slice==1)
+	fitchunk = TxyFitMEvoxels(model,[signal_slice[vox_idx],te_value,fit_algo,0,grid_refine,0,None,use_kernels])
+	s0_slice[vox_idx] = fitchunk[0]
+	txy_slice[vox_idx] = fitchunk[1]
+	exit_slice[vox_idx] = fitchunk[2]
+	mse_slice[vox_idx] = fitchunk[3]
+
+	### Create output list storing the fitted parameters and then return
+	data_out = [s0_slice, txy_slice, exit_slice, mse_slice, idx_slice]
+	return data_out
+	
+
+
+def TxyFitME(model,*argv,grid_refine=0,dict_polish=0,dict_cache=None,shared_memory=False,pool=None,precision='float64',kernels=False,warm_start=False,uncertainty=False,linear_gate=None):
+	''' Fit Txy of a registered signal model on relaxometry data
+	    
+	    INTERFACES
+	    TxyFitME(model, me_nifti, te_text, output_basename, algo, ncpu)
+	    TxyFitME(model, me_nifti, te_text, output_basename, algo, ncpu, mask_nifti)
+	    TxyFitME(model, ..., grid_refine=N, dict_polish=N, dict_cache=folder, shared_memory=True, pool=executor, precision='float32', kernels=True, warm_start=True, uncertainty=True, linear_gate=R2)
+	     
+	    PARAMETERS
+	    - model: name of the signal model ("T2" for T2/T2star, "T1" for T1; see RegisterModel())
+	    - me_nifti: path of a Nifti file storing the relaxometry data as 4D data.
+	    - te_text: path of a text file storing the sequence times (TEs or TRs, in ms) used to acquire the data.
+	    - output_basename: base name of output files. Output files will end in 
+                            "_S0ME.nii"   --> T1-weighted proton density, with receiver coil field bias
+		            "_TxyME.nii"  --> Txy map (ms)
+			    "_ExitME.nii" --> exit code (1: successful fitting; 0 background; -1: unsuccessful fitting)
+			    "_SSEME.nii"  --> fitting sum of squared errors
+			    "_S0SEME.nii", "_TxySEME.nii" --> standard errors of S0 and Txy (ms), with uncertainty=True
+			    "_B1ME.nii"   --> refocusing factor (actual/nominal refocusing flip angle), with algo "epg"
+			    
+			    Note that in the background and where fitting fails, S0, Txy and MSE are set to 0.0
+			    Output files will be stored as double-precision floating point (FLOAT64), or as single-precision
+			    floating point (FLOAT32) with precision='float32'
+			
+	    - algo: fitting algorithm ("linear", "nonlinear", "lm", "varpro", "dict", "epg" or "arlo"). "nonlinear" refines the linear fitting
+		    voxel-by-voxel with L-BFGS-B, while "lm" refines each chunk of masked voxels at once with a bounded
+		    Levenberg-Marquardt solver (see MELMFitBatch()), using the same bounds and exit codes. "varpro"
+		    eliminates S0 analytically and searches Txy only, on all voxels at once (see MEVarProFitBatch())
+		    "dict" matches all voxels to a dictionary of signals, cached on disk (see MEDictFitBatch()). "epg" matches
+		    multi-echo spin-echo trains (TEs = esp, 2*esp, ...) to a dictionary of extended phase graph simulations over T2
+		    and refocusing factor, cached on disk as that of "dict" (see MEEPGFitBatch()); the refocusing factor is saved
+		    in an additional file ending in "_B1ME.nii". "arlo" calculates Txy in closed form from the integrals of at least
+		    3 evenly spaced echoes (e.g. multi-echo gradient echo for T2*), on all voxels at once (see MEARLOFitBatch())
+	    - ncpu: number of processors to be used for computation
+	    - mask_nifti: path of a Nifti file storing a binary mask, where 1 flgas voxels where the 
+			  signal model needs to be fitted, and 0 otherwise
+	    - grid_refine: number of coarse-to-fine refinement levels of the grid search that initialises "nonlinear" and
+			   "lm" where linear fitting fails (keyword-only; default 0, i.e. original grid only; see MEGridSearchBatch())
+	    - dict_polish: number of Levenberg-Marquardt iterations polishing the output of "dict" (keyword-only; default 0)
+	    - dict_cache: folder where the dictionary of "dict" and "epg" is cached (keyword-only; default: folder of the text file of
+			  sequence times, so that studies acquired with the same protocol reuse it; see MEDictionary())
+	    - shared_memory: if True and ncpu > 1, signals and fitting output are stored in shared memory blocks that
+			     workers read and write in place, instead of being copied to and from each worker (keyword-only;
+			     default False; see TxyFitMEshared())
+	    - pool: concurrent.futures executor whose workers are used for parallel fitting instead of starting a new pool of
+		    ncpu workers (keyword-only; default None). It is left running, so that the caller can reuse it; if one of its
+		    processes dies, BrokenProcessPool is raised instead of exiting, so that the caller can start a new pool
+	    - precision: floating point precision of signals, intermediate arrays of the fitting and output files, "float64" or
+			 "float32" (keyword-only; default "float64"). "float32" halves memory usage and the size of the output files
+			 (see precisionME.py for the accuracy of the single-precision maps as compared to the double-precision ones)
+	    - kernels: if True, two measurements, linear fitting (also the starting point of "nonlinear" and "lm") and the
+		       Levenberg-Marquardt iterations of "lm" run voxel by voxel in the Numba-compiled kernels of relaxkernels, with the
+		       same steps and stopping rules as NumPy; "nonlinear" is still refined with L-BFGS-B of scipy (keyword-only;
+		       default False). NumPy and scipy are used if Numba is not installed (see benchME.py for timings and
+		       precisionME.py for the agreement of the two)
+	    - warm_start: if True, "nonlinear" and "lm" start from the Txy of a low-resolution fit of the neighbourhood of each voxel
+			  wherever it fits the voxel better than linear fitting or, where linear fitting fails, the grid search
+			  (keyword-only; default False; see MEWarmStart()). The number of iterations per voxel is reported
+	    - uncertainty: if True, maps of the Cramer-Rao standard errors of S0 and Txy are also saved, calculated from the Jacobian
+			   of the model and the residual variance of each voxel (keyword-only; default False; see MEUncertaintyBatch())
+	    - linear_gate: coefficient of determination R2 = 1 - SSE/SST between 0 and 1 from which "nonlinear" and "lm" keep the output
+			   of linear fitting instead of refining it, where linear fitting succeeds (keyword-only; default None, i.e. all voxels
+			   are refined). The fraction of voxels not refined and an estimate of the fitting time saved are reported
+	    
+	    References: "Quantitative MRI of the brain", 2nd edition, Tofts, Cercignani and Dowell editors, Taylor and Francis Group
+	     
+	    Dependencies: numpy, nibabel, scipy (other than standard library)
+	    Author: Francesco Grussu, University College London
+		    CDSQuaMRI Project 
+		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>'''
+	
+	### Get input parametrs
+	Nargv = len(argv)
+	sig_nifti = argv[0]
+	seq_text = argv[1]
+	output_rootname = argv[2]
+	algo = argv[3]
+	ncpu = argv[4]
+	if model not in MODELS:
+		print('')
+		print('ERROR: unrecognised signal model {}. Exiting with 1.'.format(model))
+		print('')
+		sys.exit(1)
+	spec = MODELS[model]
+	ncpu_physical = multiprocessing.cpu_count()
+	if ncpu>ncpu_physical:
+		print('')
+		print('WARNING: {} CPUs were requested. Using {} instead (all available CPUs)...'.format(ncpu,ncpu_physical))					 
+		print('')
+		ncpu = ncpu_physical     # Do not open more workers than the physical number of CPUs
+
+	### Check whether the requested fitting algorithm makes sense or not
+	if algo!="linear" and algo!="nonlinear" and algo!="lm" and algo!="varpro" and algo!="dict" and algo!="epg" and algo!="arlo":
+		print('')
+		print('ERROR: unrecognised fitting algorithm. Exiting with 1.')
+		print('')
+		sys.exit(1)
+
+	### Check whether the quality gate of linear fitting makes sense or not
+	if linear_gate is not None:
+		if not (0.0<=linear_gate<=1.0):
+			print('')
+			print('ERROR: the quality gate of linear fitting must be a coefficient of determination between 0 and 1, not {}. Exiting with 1.'.format(linear_gate))
+			print('')
+			sys.exit(1)
+		if algo!="nonlinear" and algo!="lm":
+			print('')
+			print('WARNING: the quality gate of linear fitting only applies to the fitting algorithms nonlinear and lm. Ignoring it...')
+			print('')
+			linear_gate = None
+
+	### Check whether the compiled kernels can be used
+	if kernels and (not relaxkernels.NUMBA_AVAILABLE or spec['kernel'] is None):
+		print('')
+		print('WARNING: the compiled kernels require Numba and are not available. Using NumPy and scipy instead...')
+		print('')
+		kernels = False
+
+	### Check whether the requested floating point precision makes sense or not
+	if precision!="float64" and precision!="float32":
+		print('')
+		print('ERROR: unrecognised floating point precision {}. Exiting with 1.'.format(precision))
+		print('')
+		sys.exit(1)
+
+	### Load MRI data
+	print('    ... loading input data')
+	
+	# Make sure MRI data exists
+	try:
+		sig_obj = nib.load(sig_nifti)
+	except:
+		print('')
+		print('ERROR: the 4D input NIFTI file {} does not exist or is not in NIFTI format. Exiting with 1.'.format(sig_nifti))					 
+		print('')
+		sys.exit(1)
+	
+	# Get image dimensions and convert to the requested precision
+	sig_data = sig_obj.get_fdata(dtype=precision)
+	imgsize = sig_data.shape
+	imgsize = np.array(imgsize)
+	
+	# Make sure that the text file with sequence parameters exists and makes sense
+	try:
+		seqarray = np.loadtxt(seq_text)
+		seqarray = np.array(seqarray,'float64')
+		seqarray_size = seqarray.size
+	except:
+		print('')
+		print('ERROR: the sequence time file {} does not exist or is not a numeric text file. Exiting with 1.'.format(seq_text))					 
+		print('')
+		sys.exit(1)
+			
+	# Check consistency of sequence parameter file and number of measurements
+	if imgsize.size!=4:
+		print('')
+		print('ERROR: the input file {} is not a 4D nifti. Exiting with 1.'.format(sig_nifti))					 
+		print('')
+		sys.exit(1)
+	if seqarray_size!=imgsize[3]:
+		print('')
+		print('ERROR: the number of measurements in {} does not match the number of sequence times in {}. Exiting with 1.'.format(sig_nifti,seq_text))					 
+		print('')
+		sys.exit(1)
+	seq = seqarray
+
+	# Check that extended phase graph fitting is possible: model of spin-echo trains, at least 3 echoes spaced evenly
+	if algo=="epg":
+		if not spec['epg']:
+			print('')
+			print('ERROR: the fitting algorithm epg is not available for the signal model {}. Exiting with 1.'.format(model))
+			print('')
+			sys.exit(1)
+		if seq.size<3 or MEEchoSpacing(seq) is None:
+			print('')
+			print('ERROR: the fitting algorithm epg requires at least 3 echo times equal to esp, 2*esp, 3*esp, ... in {}. Exiting with 1.'.format(seq_text))
+			print('')
+			sys.exit(1)
+		if uncertainty:
+			print('')
+			print('WARNING: standard errors are not available with the fitting algorithm epg. Ignoring uncertainty...')
+			print('')
+			uncertainty = False
+
+	# Check that auto-regression on linear operations is possible: mono-exponential decay, at least 3 evenly spaced echoes
+	if algo=="arlo":
+		if not spec['arlo']:
+			print('')
+			print('ERROR: the fitting algorithm arlo is not available for the signal model {}. Exiting with 1.'.format(model))
+			print('')
+			sys.exit(1)
+		if seq.size<3 or MEEvenSpacing(seq) is None:
+			print('')
+			print('ERROR: the fitting algorithm arlo requires at least 3 evenly spaced echo times in {}. Exiting with 1.'.format(seq_text))
+			print('')
+			sys.exit(1)
+
+	### Deal with optional arguments: mask
+	if Nargv==6:
+		mask_nifti = argv[5]
+		try:
+			mask_obj = nib.load(mask_nifti)
+		except:
+			print('')
+			print('ERROR: the mask file {} does not exist or is not in NIFTI format. Exiting with 1.'.format(mask_nifti))					 
+			print('')
+			sys.exit(1)
+		
+		# Make sure that the mask has header information that is consistent with the input data containing the VFA measurements
+		sig_header = sig_obj.header
+		sig_affine = sig_header.get_best_affine()
+		sig_dims = sig_obj.shape
+		mask_dims = mask_obj.shape		
+		mask_header = mask_obj.header
+		mask_affine = mask_header.get_best_affine()			
+		# Make sure the mask is a 3D file
+		mask_data = mask_obj.get_fdata()
+		masksize = mask_data.shape
+		masksize = np.array(masksize)
+		if masksize.size!=3:
+			print('')
+			print('WARNING: the mask file {} is not a 3D Nifti file. Ignoring mask...'.format(mask_nifti))				 
+			print('')
+			mask_data = np.ones(imgsize[0:3],'float64')
+		elif ( (np.sum(sig_affine==mask_affine)!=16) or (sig_dims[0]!=mask_dims[0]) or (sig_dims[1]!=mask_dims[1]) or (sig_dims[2]!=mask_dims[2]) ):
+			print('')
+			print('WARNING: the geometry of the mask file {} does not match that of the input data. Ignoring mask...'.format(mask_nifti))					 
+			print('')
+			mask_data = np.ones(imgsize[0:3],'float64')
+		else:
+			mask_data = np.array(mask_data,'float64')
+			# Make sure mask data is a numpy array
+			mask_data[mask_data>0] = 1
+			mask_data[mask_data<=0] = 0
+	else:
+		mask_data = np.ones(imgsize[0:3],'float64')
+	
+
+	### Allocate memory for outputs
+	s0_data = np.zeros(imgsize[0:3],precision)	       # T1-weighted proton density with receiver field bias (floating point of the requested precision)
+	txy_data = np.zeros(imgsize[0:3],precision)	       # Txy (floating point of the requested precision)
+	exit_data = np.zeros(imgsize[0:3],precision)           # Exit code (floating point of the requested precision)
+	mse_data = np.zeros(imgsize[0:3],precision)            # Fitting sum of squared errors (MSE) (floating point of the requested precision)
+	if algo=="epg":
+		b1_data = np.zeros(imgsize[0:3],precision)     # Refocusing factor of "epg" (floating point of the requested precision)
+
+	#### Fitting
+	print('    ... {} relaxation time estimation'.format(spec['relaxation']))
+
+	# Split the voxels within the fitting mask into chunks of balanced size, several per worker, so that workers that finish early take over the remaining chunks.
+	# Two measurements and "arlo" are fitted in closed form on all voxels at once (see METwoPointBatch() and MEARLOFitBatch()), which takes less time than
+	# starting the workers: no chunking then
+	vox_idx = np.where(mask_data==1)
+	Nvox = vox_idx[0].size
+	if ncpu>1 and ((imgsize[3]>2 and algo!="arlo") or kernels):
+		nchunks = min(4*ncpu,Nvox)
+	else:
+		nchunks = min(1,Nvox)
+	chunk_edges = np.round(np.linspace(0,Nvox,nchunks + 1)).astype('int64')
+
+	# Compact the voxels within the fitting mask into one Nvox x Nmeas array, and allocate the fitting output as a 4 x Nvox array (5 x Nvox with "epg").
+	# In shared memory mode, both live in shared memory blocks that workers read and write in place, so that no copy of signals and output is sent to and from workers
+	shared_memory = shared_memory and ncpu>1 and nchunks>1
+	nout = 5 if algo=="epg" else 4      # Rows of the fitting output
+	try:
+		if shared_memory:
+			nbytes = np.dtype(precision).itemsize      # Bytes per floating point value
+			shm_sig = multiprocessing.shared_memory.SharedMemory(create=True,size=nbytes*Nvox*imgsize[3])
+			shm_out = multiprocessing.shared_memory.SharedMemory(create=True,size=nbytes*nout*Nvox)
+			sig_vox = np.ndarray((Nvox,imgsize[3]),precision,buffer=shm_sig.buf)
+			out_vox = np.ndarray((nout,Nvox),precision,buffer=shm_out.buf)
+			out_vox[:] = 0.0
+		else:
+			sig_vox = np.zeros((Nvox,imgsize[3]),precision)
+			out_vox = np.zeros((nout,Nvox),precision)
+		sig_vox[:] = sig_data[vox_idx]
+		s0_vox = out_vox[0,:]
+		txy_vox = out_vox[1,:]
+		exit_vox = out_vox[2,:]
+		mse_vox = out_vox[3,:]
+		if algo=="epg":
+			b1_vox = out_vox[4,:]
+
+		# Fit the data at low resolution to warm-start the optimisation of each voxel if required
+		txy_warm = None
+		if warm_start and (algo=="nonlinear" or algo=="lm"):
+			print('    ... low-resolution fitting for the warm start')
+			txy_warm = MEWarmStart(model,seq,sig_data,mask_data)
+
+		# Clear some memory
+		del sig_data, mask_data
+
+		# Dictionary matching: build the dictionary once, before any worker needs it, so that workers read it from the cache
+		if algo=="dict" or algo=="epg":
+			if dict_cache is None:
+				dict_cache = os.path.dirname(os.path.abspath(seq_text))    # Next to the text file of sequence times
+			if algo=="dict":
+				MEDictionary(model,seq,spec['txy_max'],cache_dir=dict_cache)
+			else:
+				MEDictionaryEPG(model,seq,spec['txy_max'],cache_dir=dict_cache)
+
+		# Create the list of input data
+		inputlist = []
+		for kk in range(0, nchunks):
+			warm_chunk = None
+			if txy_warm is not None:
+				warm_chunk = txy_warm[chunk_edges[kk]:chunk_edges[kk+1]]    # Warm start of the kk-th chunk of voxels
+			if shared_memory:
+				chunkinfo = [shm_sig.name,shm_out.name,Nvox,imgsize[3],chunk_edges[kk],chunk_edges[kk+1],seq,algo,grid_refine,dict_polish,dict_cache,precision,kernels,warm_chunk,linear_gate]  # Position of the kk-th chunk of voxels in the shared memory blocks
+			else:
+				chunkinfo = [sig_vox[chunk_edges[kk]:chunk_edges[kk+1],:],seq,algo,chunk_edges[kk],grid_refine,dict_polish,dict_cache,kernels,warm_chunk,linear_gate]  # List of information relative to the kk-th chunk of voxels
+			inputlist.append(chunkinfo)     # Append each chunk list and create a longer list of chunks whose processing will run in parallel
+
+		# Keep track of the iterations of the optimisation and of how it was initialised
+		fit_nit = 0
+		fit_ngrid = 0
+		fit_nwarm = 0
+		fit_nskip = 0           # Voxels whose linear fitting passes the quality gate
+		fit_time_refine = 0.0   # Time spent by the workers refining the other voxels
+
+		# Call a pool of workers to run the fitting in parallel if parallel processing is required (and if the the number of chunks is > 1)
+		if ncpu>1 and len(inputlist)>1:
+			# Create the parallel pool and give jobs to the workers, one chunk at a time
+			time_pool = time.time()
+			worker_nvox = {}
+			worker_time = {}
+			nvox_done = 0
+			if pool is None:
+				fitpool_context = concurrent.futures.ProcessPoolExecutor(max_workers=ncpu)   # New pool, shut down when fitting is done
+			else:
+				fitpool_context = contextlib.nullcontext(pool)                               # Pool of the caller, left running
+			with fitpool_context as fitpool:
+				fitjobs = {}
+				try:
+					for kk in range(0, len(inputlist)):
+						if shared_memory:
+							fitjobs[fitpool.submit(TxyFitMEshared,model,inputlist[kk])] = kk
+						else:
+							fitjobs[fitpool.submit(TxyFitMEvoxels,model,inputlist[kk])] = kk
+
+					# Collect fitting output of each chunk of voxels as soon as it is ready, keeping track of the voxels fitted by each worker and of the time they spent fitting
+					for fitjob in concurrent.futures.as_completed(fitjobs):
+						fitchunk = fitjob.result()  # Fitting output relative to a chunk (the pool is broken if any worker has died)
+						vstart = chunk_edges[fitjobs[fitjob]]      # Position of the chunk of voxels
+						vend = chunk_edges[fitjobs[fitjob] + 1]
+						if not shared_memory:
+							s0_vox[vstart:vend] = fitchunk[0]    # Parameter S0
+							txy_vox[vstart:vend] = fitchunk[1]   # Parameter Txy
+							exit_vox[vstart:vend] = fitchunk[2]  # Exit code
+							mse_vox[vstart:vend] = fitchunk[3]   # Sum of Squared Errors
+							if algo=="epg":
+								b1_vox[vstart:vend] = fitchunk[10]   # Refocusing factor
+						worker_nvox[fitchunk[5]] = worker_nvox.get(fitchunk[5],0) + vend - vstart
+						worker_time[fitchunk[5]] = worker_time.get(fitchunk[5],0.0) + fitchunk[6]
+						fit_nit = fit_nit + fitchunk[7]
+						fit_ngrid = fit_ngrid + fitchunk[8]
+						fit_nwarm = fit_nwarm + fitchunk[9]
+						fit_nskip = fit_nskip + fitchunk[11]
+						fit_time_refine = fit_time_refine + fitchunk[12]
+
+						# Progress
+						nvox_done = nvox_done + vend - vstart
+						print('\r    ... {} of {} voxels fitted ({:.0f} voxels/s)'.format(nvox_done,Nvox,nvox_done/max(time.time() - time_pool,1e-12)),end='',flush=True)
+				except BaseException as fiterror:
+					# Do not leave the remaining chunks of this map queued in the pool, which may be shared with the caller
+					for fitjob in fitjobs:
+						fitjob.cancel()
+					if isinstance(fiterror,concurrent.futures.process.BrokenProcessPool):
+						print('')
+						print('')
+						if pool is None:
+							print('ERROR: some processes died during parallel fitting. Exiting with 1.')
+							print('')
+							sys.exit(1)     # Shared memory blocks are released on the way out
+						print('ERROR: some processes died during parallel fitting; the pool of the caller is not usable anymore.')
+						print('')
+					raise           # Other errors, or a broken pool of the caller: the caller decides whether to start a new pool and go on
+			print('')
+			time_pool = time.time() - time_pool
+
+			# Report the utilisation of each worker (fraction of the wall time of the parallel fitting spent fitting)
+			print('    ... worker utilisation ({} chunks of voxels in {:.1f} s)'.format(len(inputlist),time_pool))
+			for pid in sorted(worker_nvox):
+				print('        worker {}: {} voxels, {:.1f}% busy'.format(pid,worker_nvox[pid],100.0*worker_time[pid]/max(time_pool,1e-12)))
+
+		# Run serial fitting as no parallel processing is required
+		else:
+			for kk in range(0, len(inputlist)):
+				fitchunk = TxyFitMEvoxels(model,inputlist[kk])   # Fitting output relative to kk-th element in the list
+				vstart = fitchunk[4]      # Position of the kk-th chunk of voxels
+				vend = vstart + fitchunk[0].size
+				s0_vox[vstart:vend] = fitchunk[0]    # Parameter S0
+				txy_vox[vstart:vend] = fitchunk[1]   # Parameter Txy
+				exit_vox[vstart:vend] = fitchunk[2]  # Exit code
+				mse_vox[vstart:vend] = fitchunk[3]   # Sum of Squared Errors
+				if algo=="epg":
+					b1_vox[vstart:vend] = fitchunk[10]   # Refocusing factor
+				fit_nit = fit_nit + fitchunk[7]
+				fit_ngrid = fit_ngrid + fitchunk[8]
+				fit_nwarm = fit_nwarm + fitchunk[9]
+				fit_nskip = fit_nskip + fitchunk[11]
+				fit_time_refine = fit_time_refine + fitchunk[12]
+
+		# Report the iterations of the optimisation per voxel and how the optimisation was initialised
+		if algo=="nonlinear" or algo=="lm":
+			print('    ... {:.2f} iterations per voxel (grid search run on {} voxels, warm start used on {} voxels)'.format(fit_nit/max(Nvox,1),fit_ngrid,fit_nwarm))
+
+		# Report the voxels whose linear fitting passed the quality gate, and the time saved by not refining them (at the mean refinement time of the other voxels)
+		if linear_gate is not None:
+			time_saved = fit_nskip*fit_time_refine/max(Nvox - fit_nskip,1)
+			print('    ... linear fitting kept on {} of {} voxels ({:.1f}%, R2 >= {}): about {:.1f} s of refinement saved'.format(fit_nskip,Nvox,100.0*fit_nskip/max(Nvox,1),linear_gate,time_saved))
+
+		# Scatter fitting results back into the 3D maps (the voxels outside the mask are background)
+		s0_data[vox_idx] = s0_vox
+		txy_data[vox_idx] = txy_vox
+		exit_data[vox_idx] = exit_vox
+		mse_data[vox_idx] = mse_vox
+		if algo=="epg":
+			b1_data[vox_idx] = b1_vox
+	finally:
+		# Release the shared memory blocks, also if fitting has failed or has been interrupted, so that they are not left behind in the system
+		if shared_memory:
+			sig_vox = out_vox = s0_vox = txy_vox = exit_vox = mse_vox = b1_vox = None    # Drop the arrays viewing the blocks before closing them
+			for shm_block in (shm_sig,shm_out):
+				try:
+					shm_block.close()
+				except BufferError:
+					pass      # A view of the block is still referenced by the traceback of an error: it is closed when the traceback is freed
+				shm_block.unlink()
+
+	# Calculate the standard errors of S0 and Txy on all fitted voxels at once if required
+	if uncertainty:
+		print('    ... standard error estimation')
+		s0se_data = np.zeros(imgsize[0:3],precision)
+		txyse_data = np.zeros(imgsize[0:3],precision)
+		s0se_data[vox_idx], txyse_data[vox_idx] = MEUncertaintyBatch(model,seq,s0_data[vox_idx],txy_data[vox_idx],mse_data[vox_idx])
+
+	### Save the output maps
+	print('    ... saving output files')
+	buffer_string=''
+	seq_string = (output_rootname,'_TxyME.nii')
+	txy_outfile = buffer_string.join(seq_string)
+	buffer_string=''
+	seq_string = (output_rootname,'_S0ME.nii')
+	s0_outfile = buffer_string.join(seq_string)
+	buffer_string=''
+	seq_string = (output_rootname,'_ExitME.nii')
+	exit_outfile = buffer_string.join(seq_string)
+	buffer_string=''
+	seq_string = (output_rootname,'_SSEME.nii')
+	mse_outfile = buffer_string.join(seq_string)
+	buffer_header = sig_obj.header
+	buffer_header.set_data_dtype(precision)   # Make sure we save quantitative maps in the requested precision, even if input header indicates a different data type
+	txy_obj = nib.Nifti1Image(txy_data,sig_obj.affine,buffer_header)
+	nib.save(txy_obj, txy_outfile)
+	s0_obj = nib.Nifti1Image(s0_data,sig_obj.affine,buffer_header)
+	nib.save(s0_obj, s0_outfile)
+	exit_obj = nib.Nifti1Image(exit_data,sig_obj.affine,buffer_header)
+	nib.save(exit_obj, exit_outfile)
+	mse_obj = nib.Nifti1Image(mse_data,sig_obj.affine,buffer_header)
+	nib.save(mse_obj, mse_outfile)
+	if algo=="epg":
+		buffer_string=''
+		seq_string = (output_rootname,'_B1ME.nii')
+		b1_outfile = buffer_string.join(seq_string)
+		b1_obj = nib.Nifti1Image(b1_data,sig_obj.affine,buffer_header)
+		nib.save(b1_obj, b1_outfile)
+	if uncertainty:
+		buffer_string=''
+		seq_string = (output_rootname,'_S0SEME.nii')
+		s0se_outfile = buffer_string.join(seq_string)
+		buffer_string=''
+		seq_string = (output_rootname,'_TxySEME.nii')
+		txyse_outfile = buffer_string.join(seq_string)
+		s0se_obj = nib.Nifti1Image(s0se_data,sig_obj.affine,buffer_header)
+		nib.save(s0se_obj, s0se_outfile)
+		txyse_obj = nib.Nifti1Image(txyse_data,sig_obj.affine,buffer_header)
+		nib.save(txyse_obj, txyse_outfile)
+
+	### Done
+	print('')
+
+
+### Signal models available in the engine
+RegisterModel('T2', DecayBasis, DecayBasisDeriv,
+              [10.0, 15.0, 20.0, 25.0, 30.0, 35.0, 40.0, 45.0, 50.0, 55.0, 60.0, 65.0, 70.0, 75.0, 80.0, 85.0, 90.0, 150.0, 200.0, 300.0, 400.0, 600.0, 800.0, 1000.0],
+              [10.0, 24], 2.0, 1200.0, MELinearFitBatch, 'transverse', relaxkernels.KERNEL_DECAY, epg=True, arlo=True)
+RegisterModel('T1', RecoveryBasis, RecoveryBasisDeriv,
+              [1000.0, 1600.0, 2200.0, 2800.0, 3400.0, 4000.0],
+              [1.0, 2], 5.0, 5000.0, MELinearFitBatch, 'longitudinal', relaxkernels.KERNEL_RECOVERY)
@@ -0,0 +1,308 @@
+### Optional Numba-compiled per-voxel kernels of the relaxometry fitting engine (see relaxengine)
+#
+# The kernels fit one voxel at a time in compiled loops: weighted log-linear fitting, the analytic solution of two
+# measurements and the bounded Levenberg-Marquardt solver of algo "lm", so that the voxel-wise fitting does not pay the
+# overhead of the Python interpreter for every voxel. Each kernel follows the steps and stopping rules of its NumPy
+# counterpart in relaxengine, so that the fitted maps only differ by rounding errors (see precisionME.py). There is no
+# compiled L-BFGS-B: algo "nonlinear" always refines voxels with scipy.optimize. They are only compiled when Numba is installed: without Numba,
+# NUMBA_AVAILABLE is False and relaxengine uses its NumPy/scipy implementation instead.
+#
+# Author: Francesco Grussu, University College London
+#		    CDSQuaMRI Project 
+#		   <f.grussu@ucl.ac.uk> <francegrussu@gmail.com>
+#
+# Code released under BSD Two-Clause license
+#
+# Copyright (c) 2019 University College London. 
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+### Load useful modules
+import numpy as np
+try:
+	import numba
+	NUMBA_AVAILABLE = True
+except ImportError:
+	NUMBA_AVAILABLE = False        # Optional dependency: relaxengine falls back to NumPy/scipy
+
+
+### Basis functions of the signal models that can be compiled (see relaxengine.RegisterModel())
+KERNEL_DECAY = 0         # f(t,Txy) = exp(-t/Txy)
+KERNEL_RECOVERY = 1      # f(t,Txy) = k * (1 - exp(-t/Txy)), with k = 1.7315068493150685
+
+
+def KernelBasis(kind,t,txy):
+	''' Basis function f(t,Txy) of the signal model of kind KERNEL_DECAY or KERNEL_RECOVERY for one sequence time t,
+	    equal to 0.0 where Txy <= 0 (as in relaxengine.MEsignalBatch()) '''
+	if txy<=0:
+		return 0.0
+	if kind==KERNEL_RECOVERY:
+		return (1.0 - np.exp((-1.0)*t/txy)) * 1.7315068493150685
+	return np.exp((-1.0)*t/txy)
+
+
+def KernelBasisDeriv(kind,t,txy):
+	''' Derivative df(t,Txy)/d(Txy) of KernelBasis(), equal to 0.0 where Txy <= 0 '''
+	if txy<=0:
+		return 0.0
+	if kind==KERNEL_RECOVERY:
+		return (-1.0)*np.exp((-1.0)*t/txy)*t/(txy*txy) * 1.7315068493150685
+	return np.exp((-1.0)*t/txy)*t/(txy*txy)
+
+
+def KernelSSE(kind,mri_te,meas,s0,txy):
+	''' Sum of squared errors of one voxel (one row of meas) at S0 = s0 and Txy = txy '''
+	sse = 0.0
+	for mm in range(mri_te.size):
+		res = s0*KernelBasis(kind,mri_te[mm],txy) - meas[mm]
+		sse = sse + res*res
+	return sse
+
+
+def KernelLinearFit(kind,mri_te,meas,txy_max,s0_out,txy_out,exit_out,sse_out):
+	''' Weighted log-linear fitting, voxel by voxel
+
+	    INTERFACE
+	    KernelLinearFit(kind,mri_te,meas,txy_max,s0_out,txy_out,exit_out,sse_out)
+
+	    PARAMETERS
+	    - kind: KERNEL_DECAY or KERNEL_RECOVERY (basis function used to measure the quality of fit)
+	    - mri_te: 1D numpy array of sequence times (ms)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas
+	    - txy_max: largest possible Txy value (ms), assigned where fitting provides Txy < 0
+	    - s0_out, txy_out, exit_out, sse_out: 1D numpy arrays of Nvox elements where S0, Txy, exit code and sum of
+						  squared errors are written
+
+		    Same linearised model, plausibility checks and exit codes of relaxengine.MELinearFitBatch().
+
+	    Dependencies (Python packages): numpy, numba (optional)'''
+
+	Nvox = meas.shape[0]
+	Nmeas = meas.shape[1]
+	for vv in range(Nvox):
+
+		# By default fitting has failed
+		s0_out[vv] = 0.0
+		txy_out[vv] = 0.0
+		exit_out[vv] = -1.0
+		sse_out[vv] = 0.0
+
+		# The logarithm of the signal has to be defined
+		valid = True
+		for mm in range(Nmeas):
+			if not meas[vv,mm]>0:
+				valid = False
+		if not valid:
+			continue
+
+		# Solve the 2x2 normal equations ( Q' * W^2 * Q ) * coeffs = Q' * W^2 * log(m) in closed form
+		a11 = 0.0
+		a12 = 0.0
+		a22 = 0.0
+		b1 = 0.0
+		b2 = 0.0
+		for mm in range(Nmeas):
+			wsq = meas[vv,mm]*meas[vv,mm]
+			xval = (-1.0)*mri_te[mm]
+			yval = np.log(meas[vv,mm])
+			a11 = a11 + wsq
+			a12 = a12 + wsq*xval
+			a22 = a22 + wsq*xval*xval
+			b1 = b1 + wsq*yval
+			b2 = b2 + wsq*xval*yval
+		det = a11*a22 - a12*a12
+		coeff0 = (a22*b1 - a12*b2) / det
+		coeff1 = (a11*b2 - a12*b1) / det
+		if not ( np.isfinite(coeff0) and np.isfinite(coeff1) and coeff1!=0.0 ):
+			continue
+
+		# Retrieve signal model parameters and check whether the solution is plausible
+		s0 = np.exp(coeff0)
+		txy = 1.0 / coeff1
+		exit_code = 1.0
+		if txy<0:
+			s0 = 0.0
+			for mm in range(Nmeas):
+				s0 = s0 + meas[vv,mm]
+			s0 = s0 / Nmeas
+			txy = txy_max
+			exit_code = -1.0
+		s0_out[vv] = s0
+		txy_out[vv] = txy
+		exit_out[vv] = exit_code
+		sse_out[vv] = KernelSSE(kind,mri_te,meas[vv,:],s0,txy)
+
+
+def KernelTwoPoint(kind,mri_te,meas,txy_max,s0_out,txy_out,exit_out,sse_out):
+	''' Analytic fitting of two measurements, voxel by voxel
+
+	    INTERFACE
+	    KernelTwoPoint(kind,mri_te,meas,txy_max,s0_out,txy_out,exit_out,sse_out)
+
+	    PARAMETERS
+	    - kind: KERNEL_DECAY or KERNEL_RECOVERY (basis function used to measure the quality of fit)
+	    - mri_te: 1D numpy array of the two sequence times (ms)
+	    - meas: 2D numpy array of measurements of size Nvox x 2
+	    - txy_max: largest possible Txy value (ms), assigned where the solution provides Txy < 0
+	    - s0_out, txy_out, exit_out, sse_out: 1D numpy arrays of Nvox elements where S0, Txy, exit code and sum of
+						  squared errors are written
+
+		    Same solution, plausibility checks and exit codes of the two-measurement case of relaxengine.TxyFitMEvoxels():
+		    voxels where the solution is not defined (the floating point operations would raise an error there)
+		    get S0 = Txy = SSE = 0.0 and exit code -1.
+
+	    Dependencies (Python packages): numpy, numba (optional)'''
+
+	te1 = mri_te[0]
+	te2 = mri_te[1]
+	for vv in range(meas.shape[0]):
+		sig1 = meas[vv,0]
+		sig2 = meas[vv,1]
+
+		# Solution not defined: division by zero or logarithm of a non-positive number
+		s0_out[vv] = 0.0
+		txy_out[vv] = 0.0
+		exit_out[vv] = -1.0
+		sse_out[vv] = 0.0
+		if sig2==0:
+			continue
+		ratio = sig1/sig2
+		if ratio<=0 or ratio==1:
+			continue
+		txy = ( te2 - te1 ) / np.log( ratio )
+		decay = np.exp( (-1.0)*te1 / txy )
+		if decay==0:
+			continue
+
+		# Calculate the solution and check whether it is plausible
+		s0 = sig1 / decay
+		exit_code = 1.0
+		if txy<0:
+			s0 = 0.5*(sig1 + sig2)
+			txy = txy_max
+			exit_code = -1.0
+		if s0<0:
+			s0 = 0.0
+			exit_code = -1.0
+		s0_out[vv] = s0
+		txy_out[vv] = txy
+		exit_out[vv] = exit_code
+		sse_out[vv] = KernelSSE(kind,mri_te,meas[vv,:],s0,txy)
+
+
+def KernelLMFit(kind,mri_te,meas,s0_init,txy_init,fobj_init,s0_max,txy_max,s0_out,txy_out,exit_out,sse_out,nit_out,niter,ftol,xtol):
+	''' Bounded Levenberg-Marquardt fitting, voxel by voxel (compiled counterpart of algo "lm")
+
+	    INTERFACE
+	    KernelLMFit(kind,mri_te,meas,s0_init,txy_init,fobj_init,s0_max,txy_max,s0_out,txy_out,exit_out,sse_out,nit_out,niter,ftol,xtol)
+
+	    PARAMETERS
+	    - kind: KERNEL_DECAY or KERNEL_RECOVERY (basis function of the signal model)
+	    - mri_te: 1D numpy array of sequence times (ms)
+	    - meas: 2D numpy array of measurements of size Nvox x Nmeas
+	    - s0_init, txy_init, fobj_init: 1D numpy arrays of Nvox elements storing the starting point (linear fitting or grid
+					    search) and the sum of squared errors there
+	    - s0_max: 1D numpy array of Nvox elements storing the upper bound of S0 (the lower bound is 0)
+	    - txy_max: upper bound of Txy (ms; the lower bound is 0)
+	    - s0_out, txy_out, exit_out, sse_out: 1D numpy arrays of Nvox elements where S0, Txy, exit code and sum of
+						  squared errors are written
+	    - nit_out: 1D integer numpy array of Nvox elements where the number of iterations of each voxel is written
+	    - niter, ftol, xtol: maximum number of iterations and convergence tolerances (see relaxengine.MELMFitBatch())
+
+		    Each voxel is fitted with the projected Levenberg-Marquardt iterations of relaxengine.MELMFitBatch(), with
+		    the same damping, bounds and stopping rules, in a compiled loop in double precision. As with algo "lm" in
+		    relaxengine.TxyFitMEvoxels(), the output of the optimisation is kept (exit code 1) only where it converged to
+		    a smaller sum of squared errors than the starting point; otherwise the starting point is kept (exit code -1).
+
+	    Dependencies (Python packages): numpy, numba (optional)'''
+
+	Nmeas = meas.shape[1]
+	for vv in range(meas.shape[0]):
+
+		# Starting point projected onto the bounds
+		s0 = min(max(s0_init[vv],0.0),s0_max[vv])
+		txy = min(max(txy_init[vv],0.0),txy_max)
+		fobj = KernelSSE(kind,mri_te,meas[vv,:],s0,txy)
+		lam = 1e-3
+		success = False
+		nit_out[vv] = 0
+
+		for it in range(niter):
+			nit_out[vv] = it + 1
+
+			# Gradient and Gauss-Newton approximation of the Hessian
+			g0 = 0.0
+			g1 = 0.0
+			h00 = 0.0
+			h01 = 0.0
+			h11 = 0.0
+			for mm in range(Nmeas):
+				jac0 = KernelBasis(kind,mri_te[mm],txy)
+				jac1 = s0*KernelBasisDeriv(kind,mri_te[mm],txy)
+				res = s0*jac0 - meas[vv,mm]
+				g0 = g0 + jac0*res
+				g1 = g1 + jac1*res
+				h00 = h00 + jac0*jac0
+				h01 = h01 + jac0*jac1
+				h11 = h11 + jac1*jac1
+
+			# Solve the damped 2x2 system in closed form and project the new point onto the bounds
+			d00 = h00*(1.0 + lam)
+			d11 = h11*(1.0 + lam)
+			det = d00*d11 - h01*h01
+			step0 = (-1.0)*( d11*g0 - h01*g1 ) / det
+			step1 = (-1.0)*( d00*g1 - h01*g0 ) / det
+			if not np.isfinite(step0):
+				step0 = 0.0
+			if not np.isfinite(step1):
+				step1 = 0.0
+			s0_new = min(max(s0 + step0,0.0),s0_max[vv])
+			txy_new = min(max(txy + step1,0.0),txy_max)
+			fobj_new = KernelSSE(kind,mri_te,meas[vv,:],s0_new,txy_new)
+
+			# Accept the step if it decreases the objective function, adapt the damping and check convergence
+			accept = fobj_new<fobj
+			small_step = ( abs(s0_new - s0)<=xtol*(abs(s0) + xtol) ) and ( abs(txy_new - txy)<=xtol*(abs(txy) + xtol) )
+			converged = ( accept and (fobj - fobj_new)<=ftol*fobj ) or small_step or lam>1e12
+			if accept:
+				s0 = s0_new
+				txy = txy_new
+				fobj = fobj_new
+				lam = max(0.1*lam,1e-12)
+			else:
+				lam = 10.0*lam
+			if converged:
+				success = True
+				break
+
+		# Keep the output of the optimisation only if it converged to a smaller value of the objective function
+		if success and fobj<fobj_init[vv]:
+			s0_out[vv] = s0
+			txy_out[vv] = txy
+			exit_out[vv] = 1.0
+			sse_out[vv] = fobj
+		else:
+			s0_out[vv] = s0_init[vv]
+			txy_out[vv] = txy_init[vv]
+			exit_out[vv] = -1.0
+			sse_out[vv] = fobj_init[vv]
+
+
+### Compile the kernels (nopython mode, with numpy semantics for divisions by zero, cached on disk across runs)
+if NUMBA_AVAILABLE:
+	KernelBasis = numba.njit(cache=True,error_model='numpy')(KernelBasis)
+	KernelBasisDeriv = numba.njit(cache=True,error_model='numpy')(KernelBasisDeriv)
+	KernelSSE = numba.njit(cache=True,error_model='numpy')(KernelSSE)
+	KernelLinearFit = numba.njit(cache=True,error_model='numpy')(KernelLinearFit)
+	KernelTwoPoint = numba.njit(cache=True,error_model='numpy')(KernelTwoPoint)
+	KernelLMFit = numba.njit(cache=True,error_model='numpy')(KernelLMFit)